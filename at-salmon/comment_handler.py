@@ -30,6 +30,7 @@ import magicsig
 import webfingerclient.webfinger as webfinger
 import simplejson as json
 import datamodel
+import discovery
 import profile_handler
 
 # TODO: refactor this into datamodel or somewhere shared.
@@ -57,7 +58,9 @@ def to_atom_entry(c):
   args = (c.key(), c.author_profile.display_name, c.author_profile.profile_url, c.content, c.posted_at)
   return ATOM_ENTRY_TMPL % args
 
-def private_signing_key(author):
+def private_signing_key(author_profile):
+  if author_profile.private_key:
+    return author_profile.private_key
   return  ('RSA.mVgY8RN6URBTstndvmUUPb4UZTdwvwmddSKE5z_jvKUEK6yk1'
              'u3rrC9yN8k6FilGj9K0eeUPe2hf4Pj-5CmHww=='
              '.AQAB'
@@ -65,7 +68,7 @@ def private_signing_key(author):
              'ub3kuBHHk4M39i3TduIkcrjcsiWQb77D8Q==')
 
 def do_salmon_slaps(mentions, c):
-  client = webfinger.Client()
+  client = discovery.CLIENT
   for id in mentions:
     try:
       logging.info('Looking up id %s' % id)
@@ -85,7 +88,7 @@ def do_salmon_slaps(mentions, c):
           raw_data_to_sign=text,
           data_type='application/atom+xml',
           signer_uri=c.author_profile.profile_url,
-          signer_key=private_signing_key(c.author_profile.profile_url))
+          signer_key=private_signing_key(c.author_profile))
         
         # Now send the envelope:
         body_to_send = envelope.ToXML()
@@ -129,7 +132,7 @@ class CommentHandler(webapp.RequestHandler):
 
   def DEPRECATED___decorate_comment(self, comment):
     comment.decorated_content = comment.content
-    client = webfinger.Client()
+    client = discovery.CLIENT
     for mention in comment.mentions:
       replacer = re.compile(mention)
       # relying on memcache to make this not painful.  Should probably store this with the original
@@ -152,7 +155,7 @@ class CommentHandler(webapp.RequestHandler):
     comment_text = self.request.get('comment-text')
     comment_mentions = extract_mentions(comment_text)
     comment_text = self.request.get('comment-text')
-    client = webfinger.Client()
+    client = discovery.CLIENT
     profile_uris = ['about:blank']
     try:
       xrd_list = client.lookup(users.get_current_user().email())
@@ -30,6 +30,9 @@ class Profile(db.Expando):
   # A public key affiliated with the user, in magic signature format.
   public_key = db.StringProperty(required=False)
 
+  # The matching private key, for local profiles only.
+  private_key = db.TextProperty(required=False)
+
 
 class Comment(db.Expando):
   """Data for a comment.
@@ -52,4 +55,15 @@ class Comment(db.Expando):
   posted_at = db.DateTimeProperty(required=True)
   content = db.TextProperty(required=True)
   mentions = db.StringListProperty()
-  
\ No newline at end of file
+  
+
+
+class PooledKeypair(db.Model):
+  """A pre-generated keypair waiting to be handed to a new profile.
+
+  See keypool.py; keys are in magic signature format.
+  """
+
+  public_key = db.StringProperty(required=True)
+  private_key = db.TextProperty(required=True)
+  create_time = db.DateTimeProperty(required=True, auto_now_add=True)
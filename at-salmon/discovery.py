@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""The webfinger client shared by everything in this instance.
+
+One client rather than one per call means concurrent lookups of the
+same id (say, a signer's key and their profile page) share a single
+set of fetches, and host-meta documents are shared between instances
+through memcache.
+"""
+
+from google.appengine.api import memcache
+
+import imports
+import webfingerclient.webfinger as webfinger
+
+CLIENT = webfinger.Client(
+    host_meta_cache=webfinger.HostMetaCache(backend=memcache))
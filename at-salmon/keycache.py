@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""In-process cache of signers' public keys.
+
+Looking up a public key means a full webfinger discovery (host-meta,
+LRDD, XRD parse) per inbound salmon.  CachingKeyRetriever sits in front
+of any magicsig.KeyRetriever and remembers the answers: for as long as
+the XRD's Expires says when the retriever can tell, and for a shorter
+time when there is no key to be found.
+"""
+
+import time
+
+import imports
+import magicsig
+from magicsig_hjfreyer import cache
+
+# Seconds to keep a key when the XRD doesn't say when it expires.
+DEFAULT_TTL = 3600
+
+# Upper bound on any key's time in the cache, whatever Expires says.
+MAX_TTL = 24 * 3600
+
+# Seconds to remember that a signer has no key.
+NEGATIVE_TTL = 300
+
+# Most signers kept in the cache.
+MAX_ENTRIES = 1000
+
+# Distinguishes a miss from a cached None ("no key") in the LruCache.
+_MISSING = object()
+
+
+class CachingKeyRetriever(magicsig.KeyRetriever):
+  """Caches another KeyRetriever's public keys.
+
+  If the wrapped retriever has a LookupPublicKeyAndExpiry(signer_uri)
+  method returning (key, expires) -- expires in seconds since epoch, or
+  None if unknown -- keys are kept until they expire (up to max_ttl).
+  Otherwise keys are kept for default_ttl.  A None key is kept for
+  negative_ttl.  Private key lookups are passed straight through.
+  """
+
+  def __init__(self, retriever, max_entries=MAX_ENTRIES,
+               default_ttl=DEFAULT_TTL, max_ttl=MAX_TTL,
+               negative_ttl=NEGATIVE_TTL, clock=time.time):
+    self.retriever = retriever
+    self.default_ttl = default_ttl
+    self.max_ttl = max_ttl
+    self.negative_ttl = negative_ttl
+    self._clock = clock
+    self._keys = cache.LruCache(max_size=max_entries, clock=clock)
+
+  def LookupPublicKey(self, signer_uri):
+    key = self._keys.Get(signer_uri, _MISSING)
+    if key is not _MISSING:
+      return key
+
+    # Concurrent misses for one signer may both go to the network, but
+    # neither blocks other signers.
+    now = self._clock()
+    key, expires = self._lookup(signer_uri)
+    if key is None:
+      ttl = self.negative_ttl
+    elif expires is None:
+      ttl = self.default_ttl
+    else:
+      ttl = min(expires - now, self.max_ttl)
+    if ttl > 0:
+      self._keys.Put(signer_uri, key, ttl=ttl)
+    return key
+
+  def LookupPrivateKey(self, signer_uri):
+    return self.retriever.LookupPrivateKey(signer_uri)
+
+  def Forget(self, signer_uri):
+    """Drops any cached key for signer_uri, e.g. after a failed verify."""
+    self._keys.Delete(signer_uri)
+
+  def Stats(self):
+    """Returns cache size and hit/miss counters as a dict."""
+    return self._keys.Stats()
+
+  def _lookup(self, signer_uri):
+    lookup = getattr(self.retriever, 'LookupPublicKeyAndExpiry', None)
+    if lookup is not None:
+      return lookup(signer_uri)
+    return self.retriever.LookupPublicKey(signer_uri), None
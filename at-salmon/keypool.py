@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Pool of pre-generated RSA keypairs for new profiles.
+
+Generating a 2048 bit keypair in pure Python takes far too long to do
+inline in a user request, so keypairs are generated in the background
+(cron and task queue hits on /keypool/refill) and stored in the
+datastore.  Profile creation just takes one off the pool.
+"""
+
+import os
+import time
+from google.appengine.ext import webapp
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext.webapp import logging
+
+import imports
+import Crypto.PublicKey.RSA
+import magicsig.magicsigalg as magicsigalg
+import simplejson as json
+import datamodel
+
+# Size of generated keys, in bits.
+KEYPAIR_BITS = 2048
+
+# Number of keypairs a refill tops the pool up to.
+POOL_TARGET = 20
+
+# Taking a keypair when fewer than this many remain schedules a refill.
+LOW_WATER_MARK = 5
+
+# Seconds a single refill request may spend generating keys before
+# handing off to a follow-up task.  Refills only run in cron and task
+# queue requests, which get a 10 minute deadline; the rest is slack for
+# a key that takes longer than any seen before.
+REFILL_TIME_BUDGET = 8 * 60
+
+# Seconds one keypair is assumed to take at worst until a slower one
+# has been timed.  The prime search makes generation times vary widely.
+KEYGEN_WORST_CASE = 60
+
+REFILL_URL = '/keypool/refill'
+
+_GENERATED_COUNTER = 'keypool-generated'
+_TAKEN_COUNTER = 'keypool-taken'
+_EMPTY_COUNTER = 'keypool-empty'
+_SLOWEST_KEYGEN = 'keypool-slowest-keygen'
+
+
+def generate_keypair(bits=KEYPAIR_BITS):
+  """Generates a fresh keypair.
+
+  Returns:
+    A (public_key, private_key) tuple of magic signature key strings.
+    The private key is in the extended format carrying p and q, so it
+    signs with CRT.
+  """
+  key = Crypto.PublicKey.RSA.generate(bits, os.urandom)
+  alg = magicsigalg.SignatureAlgRsaSha256((key.n, key.e, key.d, key.p, key.q))
+  return alg.ToString(full_key_pair=False), alg.ToString()
+
+
+def pool_depth(limit=1000):
+  """Returns the number of keypairs waiting in the pool (up to limit)."""
+  return datamodel.PooledKeypair.all(keys_only=True).count(limit)
+
+
+def take_keypair():
+  """Removes one keypair from the pool.
+
+  Returns:
+    A (public_key, private_key) tuple, or None if the pool is empty.
+  """
+  candidates = datamodel.PooledKeypair.all(keys_only=True).order(
+      'create_time').fetch(LOW_WATER_MARK + 1)
+
+  def _take(key):
+    pooled = db.get(key)
+    if pooled is None:
+      return None  # Somebody else got it first.
+    pooled.delete()
+    return pooled.public_key, pooled.private_key
+
+  keypair = None
+  for key in candidates:
+    try:
+      keypair = db.run_in_transaction(_take, key)
+    except db.TransactionFailedError:
+      keypair = None
+    if keypair:
+      break
+
+  if keypair:
+    memcache.incr(_TAKEN_COUNTER, initial_value=0)
+  else:
+    memcache.incr(_EMPTY_COUNTER, initial_value=0)
+    logging.warning('Keypair pool is empty')
+
+  remaining = len(candidates)
+  if keypair:
+    remaining -= 1
+  if remaining < LOW_WATER_MARK:
+    schedule_refill()
+
+  return keypair
+
+
+def schedule_refill():
+  """Asks the task queue to top up the pool."""
+  try:
+    taskqueue.add(url=REFILL_URL)
+  except taskqueue.Error, e:
+    logging.warning('Could not schedule keypool refill: %s' % e)
+
+
+def refill(time_budget=REFILL_TIME_BUDGET, clock=time.time):
+  """Generates keypairs until the pool is full or time runs out.
+
+  A key is only started if it would finish within time_budget even if
+  it took as long as the slowest one timed so far, except that every
+  call generates at least one key, so a slow generator still makes
+  progress.
+
+  Returns:
+    True if the pool reached POOL_TARGET, False if more work remains.
+  """
+  deadline = clock() + time_budget
+  worst_case = max(memcache.get(_SLOWEST_KEYGEN) or 0, KEYGEN_WORST_CASE)
+  generated = 0
+  depth = pool_depth(POOL_TARGET)
+  while depth < POOL_TARGET:
+    started = clock()
+    if generated and started + worst_case > deadline:
+      return False
+    public_key, private_key = generate_keypair()
+    took = clock() - started
+    if took > worst_case:
+      worst_case = took
+      memcache.set(_SLOWEST_KEYGEN, took)
+    datamodel.PooledKeypair(public_key=public_key,
+                            private_key=private_key).put()
+    memcache.incr(_GENERATED_COUNTER, initial_value=0)
+    generated += 1
+    depth += 1
+  return True
+
+
+def get_stats():
+  """Returns pool depth and activity counters as a dict."""
+  counters = memcache.get_multi([_GENERATED_COUNTER, _TAKEN_COUNTER,
+                                 _EMPTY_COUNTER])
+  return dict(depth=pool_depth(),
+              target=POOL_TARGET,
+              low_water_mark=LOW_WATER_MARK,
+              generated=counters.get(_GENERATED_COUNTER, 0),
+              taken=counters.get(_TAKEN_COUNTER, 0),
+              empty=counters.get(_EMPTY_COUNTER, 0))
+
+
+class RefillHandler(webapp.RequestHandler):
+  """Tops up the keypair pool; hit by cron and the task queue."""
+
+  def get(self):
+    if not (self.request.headers.get('X-AppEngine-Cron') or
+            self.request.headers.get('X-AppEngine-QueueName')):
+      # An admin's browser request has too short a deadline for even
+      # one key; hand the work to the task queue.
+      schedule_refill()
+      self.response.set_status(202)
+      return
+    if not refill():
+      # Out of time for this request; carry on in a fresh task.
+      schedule_refill()
+    self.response.set_status(200)
+
+  def post(self):
+    self.get()
+
+
+class StatsHandler(webapp.RequestHandler):
+  """Reports keypair pool depth metrics as JSON."""
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(get_stats()))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for keypool.py; needs the App Engine SDK on the path."""
+
+import unittest
+
+import keypool
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000000000
+
+  def __call__(self):
+    return self.now
+
+
+class FakeMemcache(object):
+
+  def __init__(self):
+    self.values = dict()
+
+  def get(self, key):
+    return self.values.get(key)
+
+  def set(self, key, value):
+    self.values[key] = value
+
+  def incr(self, key, initial_value=0):
+    self.values[key] = self.values.get(key, initial_value) + 1
+
+
+class FakeKeypair(object):
+  stored = []
+
+  def __init__(self, public_key, private_key):
+    self.keypair = (public_key, private_key)
+
+  def put(self):
+    FakeKeypair.stored.append(self.keypair)
+
+
+class FakeDatamodel(object):
+  PooledKeypair = FakeKeypair
+
+
+class RefillTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.keygen_seconds = 50
+    self.saved = (keypool.generate_keypair, keypool.pool_depth,
+                  keypool.memcache, keypool.datamodel)
+    keypool.generate_keypair = self._SlowGenerator
+    keypool.pool_depth = lambda limit=1000: len(FakeKeypair.stored)
+    keypool.memcache = FakeMemcache()
+    keypool.datamodel = FakeDatamodel
+    FakeKeypair.stored = []
+
+  def tearDown(self):
+    (keypool.generate_keypair, keypool.pool_depth,
+     keypool.memcache, keypool.datamodel) = self.saved
+
+  def _SlowGenerator(self):
+    self.clock.now += self.keygen_seconds
+    return 'public', 'private'
+
+  def testStopsBeforeAKeyCouldOverrun(self):
+    # 50s per key against a 60s worst case: the third key could end
+    # past the 150s budget, so it isn't started.
+    self.assertFalse(keypool.refill(time_budget=150, clock=self.clock))
+    self.assertEquals(2, len(FakeKeypair.stored))
+
+  def testLearnsSlowestKey(self):
+    self.keygen_seconds = 200
+    self.assertFalse(keypool.refill(time_budget=300, clock=self.clock))
+    self.assertEquals(1, len(FakeKeypair.stored))
+    self.assertEquals(200, keypool.memcache.get(keypool._SLOWEST_KEYGEN))
+
+    # Later refills budget for the slow key from the start, but still
+    # make progress:
+    self.keygen_seconds = 10
+    self.assertFalse(keypool.refill(time_budget=150, clock=self.clock))
+    self.assertEquals(2, len(FakeKeypair.stored))
+
+  def testFillsPool(self):
+    self.keygen_seconds = 1
+    self.assertTrue(keypool.refill(clock=self.clock))
+    self.assertEquals(keypool.POOL_TARGET, len(FakeKeypair.stored))
+
+
+if __name__ == '__main__':
+  unittest.main()
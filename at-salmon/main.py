@@ -29,9 +29,13 @@ import xml.etree.ElementTree as et
 import imports
 import magicsig
 import webfingerclient.webfinger as webfinger
+import webfingerclient.xrd as xrd
 import simplejson as json
 import datamodel
 import comment_handler
+import discovery
+import keycache
+import keypool
 import profile_handler
 
 class MainHandler(webapp.RequestHandler):
@@ -42,45 +46,90 @@ class MainHandler(webapp.RequestHandler):
 
 class RealKeyRetriever(magicsig.KeyRetriever):
   """Retrieves public or private keys for a signer identifier (URI)."""
-  client = webfinger.Client()
-  
+  client = discovery.CLIENT
+
+  # TODO(jpanzer): Yeah, we need key identifiers.
+  KEY_RE = re.compile('data:application/magic-public-key,(RSA.+)')
+
   def LookupPublicKey(self, signer_uri):
+    return self.LookupPublicKeyAndExpiry(signer_uri)[0]
+
+  def LookupPublicKeyAndExpiry(self, signer_uri):
+    """Looks up signer_uri's public key via webfinger.
+
+    Returns:
+      A (key, expires) tuple.  key is None if no key could be found;
+      expires is the earliest Expires of the XRDs consulted, in seconds
+      since epoch, or None if none of them said.
+    """
+    return self.LookupPublicKeyWithSource(signer_uri)[:2]
+
+  def LookupPublicKeyWithSource(self, signer_uri):
+    """Looks up signer_uri's public key via webfinger.
+
+    Returns:
+      A (key, expires, source) tuple.  key and expires are as for
+      LookupPublicKeyAndExpiry; source is the XRD the key was found in,
+      as JSON, or None if no key was found.
+    """
     logging.info('Looking up public key for %s' % signer_uri)
     if not signer_uri:
-      return None
-    xrd_list = self.client.lookup(signer_uri)
+      return None, None, None
+    try:
+      xrd_list = self.client.lookup(signer_uri)
+    except (webfinger.FetchError, webfinger.ParseError), e:
+      logging.info('Webfinger lookup for %s failed: %s' % (signer_uri, e))
+      return None, None, None
+
+    key = None
+    source = None
+    expires = None
     for item in xrd_list:
-      logging.info("Got webfinger result for %s: %s" % (id, item))
       # item is a Xrd proto2, not a string, no need to decode.
-      subject = item.subject
-      key_urls = [link.href for link in item.links if link.rel == 'magic-public-key']
-      logging.info('Found magic public keys: subject %s, %s' % (subject, key_urls))    
-
-    # TODO(jpanzer): Yeah, we need key identifiers.
-    KEY_RE=re.compile("data:application/magic-public-key,(RSA.+)")
-    match = KEY_RE.match(key_urls[0])
-    if match:
-      return match.group(1)
-    else:
-      return None
+      item_expires = xrd.parse_expires(item.expires)
+      if item_expires is not None and (expires is None or
+                                       item_expires < expires):
+        expires = item_expires
+      for link in item.links:
+        if key is None and link.rel == 'magic-public-key':
+          match = self.KEY_RE.match(link.href)
+          if match:
+            key = match.group(1)
+            source = xrd.JsonMarshaller().to_json(item)
+    logging.info('Found magic public key for %s: %s' % (signer_uri, key))
+    return key, expires, source
+
+
+# Shared by all requests this instance serves.
+KEY_RETRIEVER = keycache.CachingKeyRetriever(RealKeyRetriever())
+
 
 class SalmonSlapHandler(webapp.RequestHandler):
   def post(self):
-    # Retrieve putative Salmon from input body.
-    body = self.request.body
+    # Retrieve putative Salmon from input body.  The envelope is read
+    # straight off the request stream and checked cheapest-first, so
+    # forged or malformed posts are dropped before any RSA or payload
+    # parsing happens.
     mime_type = self.request.headers['Content-Type']
 
     protocol = magicsig.MagicEnvelopeProtocol()
-    protocol.key_retriever = RealKeyRetriever()
-    logging.info("Saw body:\n%s\n" % body)
-    envelope = magicsig.Envelope(
-        protocol,
-        document=body,
-        mime_type=mime_type)
+    protocol.key_retriever = KEY_RETRIEVER
+    try:
+      envelope = magicsig.Envelope(
+          protocol,
+          stream=self.request.body_file,
+          mime_type=mime_type)
+      # Scanning for the signer, and parsing, hit the payload's own
+      # markup, which may be malformed (SyntaxError is ElementTree's
+      # ParseError).
+      entry = envelope.GetParsedData().getroot()
+    except (magicsig.EnvelopeError, ValueError, SyntaxError), e:
+      logging.info('Rejected salmon: %s' % e)
+      self.response.set_status(400)
+      return
     # If we got here, the Salmon validated.
 
     # Grab out the fields of interest:
-    entry = envelope.GetParsedData().getroot()
 
     s = et.tostring(entry,encoding='utf-8')
     logging.info('Saw entry:\n%s\n' % s)
@@ -167,6 +216,8 @@ def main():
           ('/salmon-slap', SalmonSlapHandler),
           ('/.well-known/host-meta', GhettoHostMeta),
           ('/user', GhettoUserXRD),
+          (keypool.REFILL_URL, keypool.RefillHandler),
+          ('/keypool/stats', keypool.StatsHandler),
       ],
       debug=True)
   util.run_wsgi_app(application)
@@ -30,6 +30,8 @@ import magicsig
 import webfingerclient.webfinger as webfinger
 import simplejson as json
 import datamodel
+import discovery
+import keypool
 
 def query_mentions(user_uri):
   mentions = []
@@ -48,7 +50,7 @@ def decorate_comment(comment):
   logging.info("Author_uri = %s" % comment.author_uri)
   comment.author_display_name = comment.author_profile.display_name
   
-  client = webfinger.Client()
+  client = discovery.CLIENT
   for mention in comment.mentions:
     replacer = re.compile(mention)
     # relying on memcache to make this not painful.  Should probably store this with the original
@@ -130,16 +132,24 @@ def prepare_profile_for_user(user, host_authority):
     localname = localname_base + str(counter)
   
   # (Small race condition here we don't care about for a demo)
-  # (Using a default public key here instead of generating one on the fly.  Should
-  # probably use None instead until the user writes a comment and then generate one.)
+  # Take a pre-generated keypair from the pool; generating one here
+  # would take far too long.  If the pool has run dry, fall back to
+  # the shared default test key.
+  keypair = keypool.take_keypair()
+  if keypair:
+    public_key, private_key = keypair
+  else:
+    public_key = ('RSA.mVgY8RN6URBTstndvmUUPb4UZTdwvwmddSKE5z_jvKUEK6yk1'
+                  'u3rrC9yN8k6FilGj9K0eeUPe2hf4Pj-5CmHww=='
+                  '.AQAB')
+    private_key = None
   p = datamodel.Profile(
     local_owner = user,
     foreign_aliases = [],
     profile_url = url,
     display_name = localname,  # Just a default.
-    public_key = 'RSA.mVgY8RN6URBTstndvmUUPb4UZTdwvwmddSKE5z_jvKUEK6yk1'
-                 'u3rrC9yN8k6FilGj9K0eeUPe2hf4Pj-5CmHww=='
-                 '.AQAB')
+    public_key = public_key,
+    private_key = private_key)
   return p
 
 def ensure_virtual_profile(author_uri):
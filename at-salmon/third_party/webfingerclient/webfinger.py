@@ -21,8 +21,11 @@ import imports
 import email.utils
 import httplib2
 import logging
+import Queue
 import re
 import sys
+import threading
+import time
 import urllib
 import urlparse
 import xrd
@@ -46,6 +49,15 @@ DOMAIN_LEVEL_XRD_TEMPLATE = 'http://%s%s/.well-known/host-meta'
 # The rel value used to indicate a user lookup service
 WEBFINGER_SERVICE_REL_VALUE = 'lrdd'
 
+# Seconds to cache a host-meta document that doesn't say when it expires
+HOST_META_TTL = 3600
+
+# Upper bound on how long a host-meta document is cached
+HOST_META_MAX_TTL = 24 * 3600
+
+# Key prefix for host-meta documents in a shared cache backend
+HOST_META_KEY_PREFIX = 'webfinger-host-meta:'
+
 class ParseError(Exception):
   """Raised in the event an id can not be parsed."""
   pass
@@ -62,14 +74,179 @@ class WebfingerError(Exception):
   """Raised if services found are not valid WebFinger documents."""
   pass
 
+class SingleFlight(object):
+  """Coalesces concurrent calls made with the same key into one.
+
+  While a call for a key is outstanding, further calls for that key
+  wait for it and get its result (the same object) or its exception,
+  instead of doing the work again.  Once it returns, the next call for
+  the key starts afresh.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = dict()  # key -> _Call
+
+  def do(self, key, function, *args):
+    """Returns function(*args), sharing the work with concurrent callers.
+
+    Args:
+      key: Identifies the work; calls with equal keys are coalesced
+      function: The function to call
+      args: Its arguments
+    Returns:
+      function's result
+    Raises:
+      Whatever function raised
+    """
+    self._lock.acquire()
+    try:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _Call()
+    finally:
+      self._lock.release()
+
+    if leader:
+      try:
+        try:
+          call.result = function(*args)
+          call.returned = True
+        except Exception:
+          call.error = sys.exc_info()
+      finally:
+        # Also on a BaseException such as App Engine's
+        # DeadlineExceededError, which the leader re-raises as is;
+        # otherwise later calls for key would wait forever.
+        self._lock.acquire()
+        try:
+          del self._calls[key]
+        finally:
+          self._lock.release()
+        call.done.set()
+    else:
+      call.done.wait()
+
+    if call.error:
+      raise call.error[0], call.error[1], call.error[2]
+    if not call.returned:
+      raise WebfingerError('Coalesced call for %r was interrupted' % (key,))
+    return call.result
+
+
+class _Call(object):
+  """An outstanding SingleFlight call."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.returned = False
+    self.error = None
+
+
+class HostMetaCache(object):
+  """Caches host-meta webfinger service links per domain.
+
+  Parsed links are kept in process.  If a backend is given, the raw
+  host-meta documents are also shared through it, so other processes
+  (e.g. other App Engine instances) can skip the fetch.  Entries expire
+  as the host-meta's Expires element says, or after ttl seconds if it
+  doesn't say, but never after more than max_ttl seconds.
+  """
+
+  def __init__(self, backend=None, ttl=HOST_META_TTL,
+               max_ttl=HOST_META_MAX_TTL, max_entries=1000, clock=time.time):
+    """Constructs a new host-meta cache.
+
+    Args:
+      backend: A memcache-like object with get(key) and
+        set(key, value, time=seconds) [optional]
+      ttl: Seconds to keep documents with no Expires
+      max_ttl: Most seconds to keep any document
+      max_entries: Most domains kept in process
+      clock: A function returning the current time in seconds
+    """
+    self._backend = backend
+    self._ttl = ttl
+    self._max_ttl = max_ttl
+    self._max_entries = max_entries
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._entries = dict()  # domain URL -> (expiry, links)
+
+  def get_links(self, domain_url):
+    """Returns the cached service links for a domain, or None."""
+    self._lock.acquire()
+    try:
+      entry = self._entries.get(domain_url)
+      if entry is None:
+        return None
+      if entry[0] <= self._clock():
+        del self._entries[domain_url]
+        return None
+      return entry[1]
+    finally:
+      self._lock.release()
+
+  def get_document(self, domain_url):
+    """Returns a host-meta document from the shared backend, or None."""
+    if self._backend is None:
+      return None
+    return self._backend.get(HOST_META_KEY_PREFIX + domain_url)
+
+  def put(self, domain_url, links, expires=None, document=None):
+    """Caches the service links parsed out of a host-meta document.
+
+    Args:
+      domain_url: The host-meta URL
+      links: A list of xrd_pb2.Link instances
+      expires: The document's expiry in seconds since the epoch [optional]
+      document: The document, to share through the backend [optional]
+    """
+    ttl = self._ttl
+    if expires is not None:
+      ttl = expires - self._clock()
+    ttl = min(ttl, self._max_ttl)
+    if ttl <= 0:
+      return
+    self._lock.acquire()
+    try:
+      if (domain_url not in self._entries and
+          len(self._entries) >= self._max_entries):
+        self._evict()
+      self._entries[domain_url] = (self._clock() + ttl, links)
+    finally:
+      self._lock.release()
+    if document is not None and self._backend is not None:
+      self._backend.set(HOST_META_KEY_PREFIX + domain_url, document,
+                        time=int(ttl))
+
+  def _evict(self):
+    """Drops expired entries, or the soonest to expire if none are."""
+    now = self._clock()
+    for domain_url, entry in self._entries.items():
+      if entry[0] <= now:
+        del self._entries[domain_url]
+    if len(self._entries) >= self._max_entries:
+      soonest = min(self._entries.items(), key=lambda item: item[1][0])
+      del self._entries[soonest[0]]
+
+
 class Client(object):
 
-  def __init__(self, http_client=None, xrd_parser=None):
+  def __init__(self, http_client=None, xrd_parser=None, host_meta_cache=None,
+               single_flight=None):
     """Construct a new WebFinger client.
 
     Args:
       http_client: A httplib2-like instance [optional]
       xrd_parser: An XRD parser [optional]
+      host_meta_cache: A HostMetaCache; defaults to an in-process one
+        [optional]
+      single_flight: A SingleFlight through which concurrent lookups of
+        the same id (and fetches of the same host-meta) are coalesced;
+        defaults to one per client [optional]
     """
     if http_client:
       self._http_client = http_client
@@ -79,6 +256,14 @@ class Client(object):
       self._xrd_parser = xrd_parser
     else:
       self._xrd_parser = xrd.Parser()
+    if host_meta_cache:
+      self._host_meta_cache = host_meta_cache
+    else:
+      self._host_meta_cache = HostMetaCache()
+    if single_flight:
+      self._single_flight = single_flight
+    else:
+      self._single_flight = SingleFlight()
 
   def lookup(self, id):
     """Look up a webfinger resource by (email-like) id.
@@ -94,6 +279,12 @@ class Client(object):
     logging.info('Incoming id is %s' % id)
     id = self._normalize_id(id)
     logging.info('Normalized id to %s' % id)
+    # Concurrent lookups of the same id share one set of fetches.  The
+    # list returned is shared too, so callers mustn't change it.
+    return self._single_flight.do(('lookup', id), self._lookup, id)
+
+  def _lookup(self, id):
+    """Looks up a normalized id; see lookup."""
     try:
       addr, scheme, local_part, domain, opt_port = self._parse_id(id)
     except ParseError:
@@ -101,15 +292,25 @@ class Client(object):
       domain = r.netloc
       opt_port = None
     links = self._get_webfinger_service_links(domain, opt_port)
-    service_descriptions = list()
+    templates = list()
     for link in links:
       if link.template:
-        service_descriptions.append(
-            self._get_service_description(link.template, id))
+        templates.append(link.template)
       if link.href:
-        service_descriptions.append(
-            self._get_service_description(link.href, id))
-    return service_descriptions
+        templates.append(link.href)
+    return self._get_service_descriptions(templates, id)
+
+  def _get_service_descriptions(self, templates, id):
+    """Retrieves the service descriptions for each of a list of templates.
+
+    Args:
+      templates: A list of URI template strings or URI strings
+      id: An account identifier
+    Returns:
+      A list of xrd_pb2.Xrd instances, in the order of templates.
+    """
+    return [self._get_service_description(template, id)
+            for template in templates]
 
   def _normalize_id(self, id):
     """Normalize the account identifier.
@@ -165,13 +366,33 @@ class Client(object):
     if not opt_port:
       opt_port = ''
     domain_url = DOMAIN_LEVEL_XRD_TEMPLATE % (domain, opt_port)
-    logging.info('Fetching domain url %s' % domain_url)
-    content = self._fetch_url(domain_url)
+    links = self._host_meta_cache.get_links(domain_url)
+    if links is not None:
+      return links
+    return self._single_flight.do(('host-meta', domain_url),
+                                  self._load_webfinger_service_links,
+                                  domain_url)
+
+  def _load_webfinger_service_links(self, domain_url):
+    """Fetches a domain's host-meta and caches its service links.
+
+    Args:
+      The domain-level XRD URL
+    Returns:
+      A list of xrd_pb2.Link instances of the webfinger service type
+    """
+    content = self._host_meta_cache.get_document(domain_url)
+    fetched = None
+    if content is None:
+      logging.info('Fetching domain url %s' % domain_url)
+      content = fetched = self._fetch_url(domain_url)
     domain_xrd = self._xrd_parser.parse(content)
     links = list()
     for link in domain_xrd.links:
       if link.rel == WEBFINGER_SERVICE_REL_VALUE:
         links.append(link)
+    self._host_meta_cache.put(domain_url, links,
+                              xrd.parse_expires(domain_xrd.expires), fetched)
     return links
 
   def _parse_id(self, id):
@@ -203,7 +424,7 @@ class Client(object):
       FetchError if the URL can not be retrieved
     """
     try:
-      response, content = self._http_client.request(url)
+      response, content = self._request(url)
     except Exception, e:  # This is hackish
       raise FetchError('Could not fetch %s. Host down? %s' % (url, e))
     if response.status != 200:
@@ -211,6 +432,206 @@ class Client(object):
         'Could not fetch %s. Status %d.' % (url, response.status))
     return content
 
+  def _request(self, url):
+    """Makes an HTTP GET request, returning (response, content)."""
+    return self._http_client.request(url)
+
+
+class ConcurrentClient(Client):
+  """A WebFinger client that fetches concurrently.
+
+  lookup behaves as Client.lookup, but fetches all of an identifier's
+  LRDD documents at once; lookup_many resolves a batch of identifiers
+  at once.  Fetches run on a fixed set of max_concurrency worker
+  threads, started on first use and shared by all calls (one
+  httplib2.Http per thread, as they aren't thread safe), never more
+  than max_concurrency at a time overall nor max_per_host at a time to
+  any one host.
+  """
+
+  def __init__(self, http_client_factory=None, xrd_parser=None,
+               host_meta_cache=None, max_concurrency=10, max_per_host=2,
+               single_flight=None):
+    """Construct a new concurrent WebFinger client.
+
+    Args:
+      http_client_factory: A function returning a new httplib2-like
+        instance, called once per thread [optional]
+      xrd_parser: An XRD parser [optional]
+      host_meta_cache: A HostMetaCache [optional]
+      max_concurrency: Most requests in flight at once
+      max_per_host: Most requests in flight at once to any one host
+      single_flight: A SingleFlight [optional]
+    """
+    if not http_client_factory:
+      http_client_factory = httplib2.Http
+    Client.__init__(self, http_client_factory(), xrd_parser, host_meta_cache,
+                    single_flight)
+    self._http_client_factory = http_client_factory
+    self._local = threading.local()
+    self._max_concurrency = max_concurrency
+    self._max_per_host = max_per_host
+    self._slots = threading.BoundedSemaphore(max_concurrency)
+    # host -> [BoundedSemaphore, requests holding or waiting for it];
+    # a host's entry goes once nobody is using it, so hosts seen once
+    # don't pile up.
+    self._host_slots = dict()
+    self._host_slots_lock = threading.Lock()
+    self._tasks = None  # Queue.Queue feeding the workers, once started
+    self._workers_lock = threading.Lock()
+
+  def lookup_many(self, ids, errors=None):
+    """Looks up a batch of webfinger resources at once.
+
+    Args:
+      ids: A list of account identifiers
+      errors: A dict to which each id that fails is added, mapped to
+        the FetchError, ParseError or other exception it raised
+        [optional]
+    Returns:
+      A dict mapping each id that succeeded to its list of discovered
+      xrd_pb2.Xrd instances.
+    """
+    results, failures = self._map(self.lookup, ids)
+    found = dict()
+    for id, result, failure in zip(ids, results, failures):
+      if failure:
+        if errors is not None:
+          errors[id] = failure[1]
+      else:
+        found[id] = result
+    return found
+
+  def _get_service_descriptions(self, templates, id):
+    results, failures = self._map(
+        lambda template: self._get_service_description(template, id),
+        templates)
+    for failure in failures:
+      if failure:
+        raise failure[0], failure[1], failure[2]
+    return results
+
+  def _map(self, function, items):
+    """Calls function on each of items, on up to max_concurrency threads.
+
+    The calling thread works through items too, alongside any idle
+    workers, so a call made from a worker (as lookup_many's lookups
+    make for their LRDD documents) always makes progress even when
+    every worker is busy.
+
+    Returns:
+      A tuple of two lists in the order of items: the results, and for
+      calls that raised, the exception's sys.exc_info() (else None).
+    """
+    results = [None] * len(items)
+    failures = [None] * len(items)
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+    pending = [len(items)]
+    finished = threading.Event()
+
+    def work():
+      while True:
+        lock.acquire()
+        try:
+          try:
+            i = indexes.next()
+          except StopIteration:
+            return
+        finally:
+          lock.release()
+        try:
+          try:
+            results[i] = function(items[i])
+          except Exception:
+            failures[i] = sys.exc_info()
+        finally:
+          lock.acquire()
+          try:
+            pending[0] -= 1
+            if not pending[0]:
+              finished.set()
+          finally:
+            lock.release()
+
+    if not items:
+      return results, failures
+    for i in range(min(self._max_concurrency, len(items)) - 1):
+      self._submit(work)
+    work()
+    # Items still pending are being run by workers that took them.
+    finished.wait()
+    return results, failures
+
+  def _submit(self, task):
+    """Queues task for the workers, starting them on first use."""
+    self._workers_lock.acquire()
+    try:
+      if self._tasks is None:
+        self._tasks = Queue.Queue()
+        for i in range(self._max_concurrency):
+          worker = threading.Thread(target=self._work,
+                                    name='webfinger-worker-%d' % i)
+          worker.setDaemon(True)
+          worker.start()
+    finally:
+      self._workers_lock.release()
+    self._tasks.put(task)
+
+  def _work(self):
+    while True:
+      task = self._tasks.get()
+      try:
+        task()
+      except:
+        logging.exception('webfinger worker task failed')
+
+  def _request(self, url):
+    http_client = getattr(self._local, 'http_client', None)
+    if http_client is None:
+      http_client = self._local.http_client = self._http_client_factory()
+    host = urlparse.urlparse(url)[1]
+    host_slots = self._get_host_slots(host)
+    try:
+      # Wait for the host before taking a global slot, so a slow host
+      # doesn't hold up requests to the others.
+      host_slots.acquire()
+      try:
+        self._slots.acquire()
+        try:
+          return http_client.request(url)
+        finally:
+          self._slots.release()
+      finally:
+        host_slots.release()
+    finally:
+      self._put_host_slots(host)
+
+  def _get_host_slots(self, host):
+    """Returns host's semaphore, counting the caller as one of its users."""
+    self._host_slots_lock.acquire()
+    try:
+      entry = self._host_slots.get(host)
+      if entry is None:
+        entry = self._host_slots[host] = [
+            threading.BoundedSemaphore(self._max_per_host), 0]
+      entry[1] += 1
+      return entry[0]
+    finally:
+      self._host_slots_lock.release()
+
+  def _put_host_slots(self, host):
+    """Undoes _get_host_slots, dropping host's entry when it is unused."""
+    self._host_slots_lock.acquire()
+    try:
+      entry = self._host_slots[host]
+      entry[1] -= 1
+      if not entry[1]:
+        del self._host_slots[host]
+    finally:
+      self._host_slots_lock.release()
+
+
 def main(argv):
   if len(argv) < 2:
     raise UsageError('Usage webfinger.py id')
@@ -0,0 +1,291 @@
+#!/usr/bin/python2.5
+#
+# Tests the WebFinger client.
+#
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+import time
+import unittest
+import webfinger
+
+HOST_META = '''<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">
+  %s
+  <Link rel="lrdd" template="http://example.com/xrd?q={uri}"/>
+</XRD>'''
+
+MULTI_LRDD_HOST_META = '''<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">
+  <Link rel="lrdd" template="http://a.example.com/xrd?q={uri}"/>
+  <Link rel="lrdd" template="http://b.example.com/xrd?q={uri}"/>
+  <Link rel="lrdd" template="http://c.example.com/xrd?q={uri}"/>
+</XRD>'''
+
+SUBJECT_XRD = '''<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">
+  <Subject>%s</Subject>
+</XRD>'''
+
+USER_XRD = '''<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">
+  <Subject>acct:bob@example.com</Subject>
+</XRD>'''
+
+
+class FakeResponse(object):
+
+  def __init__(self, status):
+    self.status = status
+
+
+class FakeHttp(object):
+  """Serves host-meta and user XRDs, counting requests per kind."""
+
+  def __init__(self, expires=''):
+    self.host_meta = HOST_META % expires
+    self.requests = []
+
+  def request(self, url):
+    self.requests.append(url)
+    if url.endswith('/.well-known/host-meta'):
+      return FakeResponse(200), self.host_meta
+    return FakeResponse(200), USER_XRD
+
+  def host_meta_fetches(self):
+    return len([url for url in self.requests
+                if url.endswith('/.well-known/host-meta')])
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000000000
+
+  def __call__(self):
+    return self.now
+
+
+class FakeMemcache(object):
+
+  def __init__(self):
+    self.values = dict()
+
+  def get(self, key):
+    return self.values.get(key)
+
+  def set(self, key, value, time=0):
+    self.values[key] = value
+
+
+class ClientTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+
+  def make_client(self, http, backend=None):
+    cache = webfinger.HostMetaCache(backend=backend, ttl=60,
+                                    clock=self.clock)
+    return webfinger.Client(http_client=http, host_meta_cache=cache)
+
+  def testHostMetaFetchedOncePerDomain(self):
+    http = FakeHttp()
+    client = self.make_client(http)
+    for i in range(100):
+      descriptions = client.lookup('acct:user%d@example.com' % i)
+      self.assertEquals(1, len(descriptions))
+      self.assertEquals('acct:bob@example.com', descriptions[0].subject)
+    self.assertEquals(1, http.host_meta_fetches())
+    self.assertEquals(101, len(http.requests))
+
+  def testHostMetaExpires(self):
+    http = FakeHttp()
+    client = self.make_client(http)
+    client.lookup('acct:bob@example.com')
+    self.clock.now += 61
+    client.lookup('acct:bob@example.com')
+    self.assertEquals(2, http.host_meta_fetches())
+
+  def testHostMetaHonorsXrdExpires(self):
+    # Expires 10 seconds from the fake clock's now:
+    http = FakeHttp('<Expires>2001-09-09T01:46:50Z</Expires>')
+    client = self.make_client(http)
+    client.lookup('acct:bob@example.com')
+    self.clock.now += 9
+    client.lookup('acct:bob@example.com')
+    self.assertEquals(1, http.host_meta_fetches())
+    self.clock.now += 1
+    client.lookup('acct:bob@example.com')
+    self.assertEquals(2, http.host_meta_fetches())
+
+  def testHostMetaSharedThroughBackend(self):
+    backend = FakeMemcache()
+    first = FakeHttp()
+    self.make_client(first, backend).lookup('acct:bob@example.com')
+    second = FakeHttp()
+    self.make_client(second, backend).lookup('acct:bob@example.com')
+    self.assertEquals(1, first.host_meta_fetches())
+    self.assertEquals(0, second.host_meta_fetches())
+
+
+class SlowHttp(object):
+  """Answers after a short delay, tracking requests in flight."""
+
+  def __init__(self, host_meta=MULTI_LRDD_HOST_META):
+    self.host_meta = host_meta
+    self.lock = threading.Lock()
+    self.in_flight = dict()  # host -> requests in flight
+    self.max_in_flight = 0
+    self.max_in_flight_per_host = 0
+    self.requests = []
+
+  def request(self, url):
+    host = url.split('/')[2]
+    self.lock.acquire()
+    try:
+      self.requests.append(url)
+      self.in_flight[host] = self.in_flight.get(host, 0) + 1
+      self.max_in_flight = max(self.max_in_flight,
+                               sum(self.in_flight.values()))
+      self.max_in_flight_per_host = max(self.max_in_flight_per_host,
+                                        self.in_flight[host])
+    finally:
+      self.lock.release()
+    time.sleep(0.01)
+    self.lock.acquire()
+    try:
+      self.in_flight[host] -= 1
+    finally:
+      self.lock.release()
+    if url.endswith('/.well-known/host-meta'):
+      return FakeResponse(200), self.host_meta
+    if 'missing' in url:
+      return FakeResponse(404), ''
+    return FakeResponse(200), SUBJECT_XRD % url.split('/')[2]
+
+
+class SingleFlightTest(unittest.TestCase):
+
+  def run_threads(self, count, function):
+    threads = [threading.Thread(target=function) for i in range(count)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def testConcurrentLookupsShareFetches(self):
+    http = SlowHttp()
+    client = webfinger.Client(http)
+    found = []
+    def lookup():
+      found.append(client.lookup('acct:bob@example.com'))
+    self.run_threads(10, lookup)
+    self.assertEquals(10, len(found))
+    self.assertEquals(3, len(found[0]))
+    # One host-meta plus three LRDD documents, however many callers:
+    self.assertEquals(4, len(http.requests))
+
+  def testSharedErrorReachesEveryCaller(self):
+    http = SlowHttp(HOST_META % '')
+    client = webfinger.Client(http)
+    errors = []
+    def lookup():
+      try:
+        client.lookup('acct:missing@example.com')
+      except webfinger.FetchError, e:
+        errors.append(e)
+    self.run_threads(5, lookup)
+    self.assertEquals(5, len(errors))
+    self.assertEquals(2, len(http.requests))
+
+  def testBaseExceptionReleasesKey(self):
+    class Deadline(BaseException):
+      pass
+    def expire():
+      raise Deadline()
+    flight = webfinger.SingleFlight()
+    self.assertRaises(Deadline, flight.do, 'key', expire)
+    # The key is free again, not stuck behind the interrupted call:
+    self.assertEquals(42, flight.do('key', lambda: 42))
+
+  def testNextCallStartsAfresh(self):
+    http = SlowHttp()
+    client = webfinger.Client(http)
+    client.lookup('acct:bob@example.com')
+    client.lookup('acct:bob@example.com')
+    # The second lookup reuses the cached host-meta, not the result:
+    self.assertEquals(7, len(http.requests))
+
+
+class ConcurrentClientTest(unittest.TestCase):
+
+  def testLookupMatchesClient(self):
+    http = SlowHttp()
+    client = webfinger.ConcurrentClient(http_client_factory=lambda: http)
+    descriptions = client.lookup('acct:bob@example.com')
+    self.assertEquals(['a.example.com', 'b.example.com', 'c.example.com'],
+                      [d.subject for d in descriptions])
+    self.assertEquals(
+        [d.subject for d in webfinger.Client(http).lookup(
+            'acct:bob@example.com')],
+        [d.subject for d in descriptions])
+
+  def testLookupManyHonorsLimits(self):
+    http = SlowHttp()
+    client = webfinger.ConcurrentClient(http_client_factory=lambda: http,
+                                        max_concurrency=4, max_per_host=2)
+    ids = ['acct:user%d@example.com' % i for i in range(12)]
+    found = client.lookup_many(ids)
+    self.assertEquals(sorted(ids), sorted(found.keys()))
+    self.assertEquals(3, len(found[ids[0]]))
+    self.assertTrue(http.max_in_flight <= 4)
+    self.assertTrue(http.max_in_flight_per_host <= 2)
+    self.assertTrue(http.max_in_flight > 1)
+
+  def testHostSlotsAreDropped(self):
+    http = SlowHttp()
+    client = webfinger.ConcurrentClient(http_client_factory=lambda: http)
+    client.lookup_many(['acct:user%d@example.com' % i for i in range(4)])
+    self.assertTrue(http.max_in_flight_per_host > 0)
+    self.assertEquals({}, client._host_slots)
+
+  def testWorkersAreReused(self):
+    http = SlowHttp()
+    client = webfinger.ConcurrentClient(http_client_factory=lambda: http,
+                                        max_concurrency=3)
+    ids = ['acct:user%d@example.com' % i for i in range(6)]
+    client.lookup_many(ids)
+    threads = threading.activeCount()
+    for i in range(3):
+      self.assertEquals(6, len(client.lookup_many(ids)))
+    self.assertEquals(threads, threading.activeCount())
+
+  def testLookupManyReportsErrors(self):
+    http = SlowHttp(HOST_META % '')
+    client = webfinger.ConcurrentClient(http_client_factory=lambda: http)
+    errors = dict()
+    found = client.lookup_many(['acct:bob@example.com',
+                                'acct:missing@example.com'], errors)
+    self.assertEquals(['acct:bob@example.com'], found.keys())
+    self.assertEquals(['acct:missing@example.com'], errors.keys())
+    self.assertTrue(isinstance(errors['acct:missing@example.com'],
+                               webfinger.FetchError))
+
+
+def suite():
+  suite = unittest.TestSuite()
+  suite.addTests(unittest.makeSuite(ClientTest))
+  suite.addTests(unittest.makeSuite(SingleFlightTest))
+  suite.addTests(unittest.makeSuite(ConcurrentClientTest))
+  return suite
+
+if __name__ == '__main__':
+  unittest.main()
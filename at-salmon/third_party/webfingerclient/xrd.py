@@ -17,6 +17,9 @@
 #   limitations under the License.
 
 import imports
+import calendar
+import re
+import time
 import xrd_pb2
 
 # As specified in:
@@ -43,11 +46,39 @@ ID_ATTRIBUTE           = '{%s}%s' % (XML_NAMESPACE, 'id')
 LANG_ATTRIBUTE         = '{%s}%s' % (XML_NAMESPACE, 'lang')
 NIL_ATTRIBUTE          = '{%s}%s' % (XSI_NAMESPACE, 'nil')
 
+# An xs:dateTime, as used by the Expires element
+DATETIME_RE = re.compile(
+    r'^\s*(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?'
+    r'(Z|[+-]\d{2}:\d{2})?\s*$')
+
 class ParseError(Exception):
   """Raised in the event an XRD document can not be parsed."""
   pass
 
 
+def parse_expires(text):
+  """Converts an Expires value (xs:dateTime) into seconds since the epoch.
+
+  Args:
+    text: The Expires text, e.g. from xrd_pb2.Xrd.expires
+  Returns:
+    The expiry time, or None if text is empty or not a dateTime.  Times
+    without a zone are taken to be UTC.
+  """
+  match = DATETIME_RE.match(text or '')
+  if not match:
+    return None
+  when = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+  zone = match.group(2)
+  if zone and zone != 'Z':
+    offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+    if zone[0] == '+':
+      when -= offset
+    else:
+      when += offset
+  return when
+
+
 class Parser(object):
   """Converts XML documents into xrd_pb2.Xrd instances."""
 
@@ -73,14 +104,7 @@ class Parser(object):
     Raises:
       ParseError if the element can not be parsed
     """
-    if not string:
-      raise ParseError('Empty input string.')
-    try:
-      document = self._etree.fromstring(string)
-    except SyntaxError, e:
-      raise ParseError('Could not parse %s\nError: %s' % (string, e))
-    if document.tag != XRD_QNAME:
-      raise ParseError('Root is not an <XRD/> element: %s' % document)
+    document = self._parse_document(string)
     description = xrd_pb2.Xrd()
     self._parse_id(document, description)
     self._parse_expires(document, description)
@@ -90,6 +114,26 @@ class Parser(object):
     self._parse_links(document, description)
     return description
 
+  def _parse_document(self, string):
+    """Parses an XML string, checking that its root is an XRD element.
+
+    Args:
+      string: A string containing an XML XRD document.
+    Returns:
+      The root Element
+    Raises:
+      ParseError if the element can not be parsed
+    """
+    if not string:
+      raise ParseError('Empty input string.')
+    try:
+      document = self._etree.fromstring(string)
+    except SyntaxError, e:
+      raise ParseError('Could not parse %s\nError: %s' % (string, e))
+    if document.tag != XRD_QNAME:
+      raise ParseError('Root is not an <XRD/> element: %s' % document)
+    return document
+
   def _parse_id(self, xrd_element, description):
     """Finds a xml:id attribute and adds it to the Xrd proto.
 
@@ -189,6 +233,186 @@ class Parser(object):
         title.value = title_element.text
 
 
+class Xrd(object):
+  """A plain XRD description, with the same fields as xrd_pb2.Xrd.
+
+  Code that only reads descriptions can take either form.  Building one
+  of these is far cheaper than building the protocol buffer, whose
+  pure-Python implementation routes every field set and repeated add
+  through generated descriptors.
+  """
+  __slots__ = ('id', 'expires', 'subject', 'aliases', 'properties', 'links')
+
+  def __init__(self):
+    self.id = ''
+    self.expires = ''
+    self.subject = ''
+    self.aliases = []
+    self.properties = []
+    self.links = []
+
+
+class Link(object):
+  """A plain XRD Link, with the same fields as xrd_pb2.Link."""
+  __slots__ = ('rel', 'type', 'href', 'template', 'titles', 'properties')
+
+  def __init__(self, rel='', type='', href='', template=''):
+    self.rel = rel
+    self.type = type
+    self.href = href
+    self.template = template
+    self.titles = []
+    self.properties = []
+
+
+class Property(object):
+  """A plain XRD Property, with the same fields as xrd_pb2.Property."""
+  __slots__ = ('nil', 'type', 'value')
+
+  def __init__(self, nil=False, type='', value=''):
+    self.nil = nil
+    self.type = type
+    self.value = value
+
+
+class Title(object):
+  """A plain XRD Title, with the same fields as xrd_pb2.Title."""
+  __slots__ = ('lang', 'value')
+
+  def __init__(self, lang='', value=''):
+    self.lang = lang
+    self.value = value
+
+
+class LightParser(Parser):
+  """Converts XML documents into Xrd instances.
+
+  Produces the same descriptions as Parser, in plain objects rather than
+  protocol buffers, walking each element's children once.  Use
+  to_proto where an xrd_pb2.Xrd is needed.
+  """
+
+  def parse(self, string):
+    """Converts XML strings into Xrd instances
+
+    Args:
+      string: A string containing an XML XRD document.
+    Returns:
+      A Xrd instance.
+    Raises:
+      ParseError if the element can not be parsed
+    """
+    document = self._parse_document(string)
+    description = Xrd()
+    description.id = document.get(ID_ATTRIBUTE, '')
+    expires = subject = None
+    for element in document:
+      tag = element.tag
+      if tag == LINK_QNAME:
+        description.links.append(self._light_link(element))
+      elif tag == PROPERTY_QNAME:
+        description.properties.append(self._light_property(element))
+      elif tag == ALIAS_QNAME:
+        description.aliases.append(element.text or '')
+      elif tag == SUBJECT_QNAME and subject is None:
+        subject = element
+        description.subject = element.text or ''
+      elif tag == EXPIRES_QNAME and expires is None:
+        expires = element
+        description.expires = element.text or ''
+    return description
+
+  def _light_link(self, link_element):
+    """Converts a Link element into a Link."""
+    get = link_element.get
+    link = Link(get('rel', ''), get('type', ''), get('href', ''),
+                get('template', ''))
+    for element in link_element:
+      if element.tag == TITLE_QNAME:
+        link.titles.append(Title(element.get(LANG_ATTRIBUTE, ''),
+                                 element.text or ''))
+      elif element.tag == PROPERTY_QNAME:
+        link.properties.append(self._light_property(element))
+    return link
+
+  def _light_property(self, property_element):
+    """Converts a Property element into a Property."""
+    return Property(property_element.get(NIL_ATTRIBUTE) == 'true',
+                    property_element.get('type', ''),
+                    property_element.text or '')
+
+
+def to_proto(description):
+  """Converts a Xrd into an xrd_pb2.Xrd.
+
+  Args:
+    description: A Xrd instance
+  Returns:
+    An equivalent xrd_pb2.Xrd instance
+  """
+  description_pb = xrd_pb2.Xrd()
+  if description.id:
+    description_pb.id = description.id
+  if description.expires:
+    description_pb.expires = description.expires
+  if description.subject:
+    description_pb.subject = description.subject
+  description_pb.aliases.extend(description.aliases)
+  _properties_to_proto(description.properties, description_pb.properties)
+  for link in description.links:
+    link_pb = description_pb.links.add()
+    for field in ('rel', 'type', 'href', 'template'):
+      value = getattr(link, field)
+      if value:
+        setattr(link_pb, field, value)
+    for title in link.titles:
+      title_pb = link_pb.titles.add()
+      if title.lang:
+        title_pb.lang = title.lang
+      if title.value:
+        title_pb.value = title.value
+    _properties_to_proto(link.properties, link_pb.properties)
+  return description_pb
+
+
+def _properties_to_proto(properties, properties_pb):
+  for property in properties:
+    property_pb = properties_pb.add()
+    property_pb.nil = property.nil
+    if property.type:
+      property_pb.type = property.type
+    if property.value:
+      property_pb.value = property.value
+
+
+def from_proto(description_pb):
+  """Converts an xrd_pb2.Xrd into a Xrd.
+
+  Args:
+    description_pb: An xrd_pb2.Xrd instance
+  Returns:
+    An equivalent Xrd instance
+  """
+  description = Xrd()
+  description.id = description_pb.id
+  description.expires = description_pb.expires
+  description.subject = description_pb.subject
+  description.aliases = list(description_pb.aliases)
+  description.properties = _properties_from_proto(description_pb.properties)
+  for link_pb in description_pb.links:
+    link = Link(link_pb.rel, link_pb.type, link_pb.href, link_pb.template)
+    link.titles = [Title(title_pb.lang, title_pb.value)
+                   for title_pb in link_pb.titles]
+    link.properties = _properties_from_proto(link_pb.properties)
+    description.links.append(link)
+  return description
+
+
+def _properties_from_proto(properties_pb):
+  return [Property(property_pb.nil, property_pb.type, property_pb.value)
+          for property_pb in properties_pb]
+
+
 class JsonMarshaller(object):
 
   def __init__(self):
@@ -221,6 +445,7 @@ class JsonMarshaller(object):
     if description.aliases:
       output['aliases'] = [str(alias) for alias in description.aliases]
     if description.properties:
+      output['properties'] = list()
       for p in description.properties:
         output['properties'].append({'type': p.type, 'value': p.value})
     if description.links:
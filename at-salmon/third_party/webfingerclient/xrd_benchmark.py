@@ -0,0 +1,116 @@
+#!/usr/bin/python2.5
+#
+# Benchmarks the XRD parsers.
+#
+# Copyright 2010 Google Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Compares xrd.Parser (protocol buffers) with xrd.LightParser.
+
+Run directly:  python xrd_benchmark.py [xrd files...]
+
+With no arguments, a generated corpus of host-meta and user XRDs of
+increasing size is used.
+"""
+
+import sys
+import timeit
+import xrd
+
+HEADER = ('<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0"'
+          ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+
+HOST_META = HEADER + '''  <Link rel="lrdd"
+      template="http://example.com/xrd?q={uri}">
+    <Title>Resource Descriptor</Title>
+  </Link>
+</XRD>'''
+
+USER_LINK = '''  <Link rel="http://example.com/rel/%d" type="text/html"
+      href="http://example.com/bob/%d">
+    <Title xml:lang="en">Link %d</Title>
+    <Property type="http://example.com/prop">%d</Property>
+  </Link>
+'''
+
+
+def user_xrd(links):
+  """Returns a user XRD with the given number of links."""
+  parts = [HEADER,
+           '  <Expires>2010-01-30T09:30:00Z</Expires>\n',
+           '  <Subject>acct:bob@example.com</Subject>\n',
+           '  <Alias>http://example.com/bob</Alias>\n',
+           '  <Property type="http://example.com/type" xsi:nil="true"/>\n']
+  for i in range(links):
+    parts.append(USER_LINK % (i, i, i, i))
+  parts.append('</XRD>')
+  return ''.join(parts)
+
+
+def default_corpus():
+  """Returns a list of (name, document) pairs."""
+  corpus = [('host-meta', HOST_META)]
+  for links in (4, 16, 64):
+    corpus.append(('user, %d links' % links, user_xrd(links)))
+  return corpus
+
+
+def _time(function, iterations):
+  """Returns the best per-call time of function, in microseconds."""
+  timer = timeit.Timer(function)
+  best = min(timer.repeat(repeat=3, number=iterations))
+  return best * 1e6 / iterations
+
+
+def benchmark_parsers(corpus, iterations=500):
+  """Times each parser over each document.
+
+  Args:
+    corpus: A list of (name, document) pairs
+    iterations: Parses per timing run
+  Returns:
+    A list of dicts with per-parse microseconds for the protocol buffer
+    parser, the light parser, and the light parser plus to_proto.
+  """
+  parser = xrd.Parser()
+  light_parser = xrd.LightParser()
+  results = list()
+  for name, document in corpus:
+    # Both parsers must agree before their speed is worth comparing.
+    assert parser.parse(document) == xrd.to_proto(light_parser.parse(document))
+    results.append(dict(
+        name=name,
+        size=len(document),
+        proto=_time(lambda: parser.parse(document), iterations),
+        light=_time(lambda: light_parser.parse(document), iterations),
+        light_to_proto=_time(
+            lambda: xrd.to_proto(light_parser.parse(document)), iterations)))
+  return results
+
+
+def main(argv):
+  if argv[1:]:
+    corpus = [(filename, open(filename).read()) for filename in argv[1:]]
+  else:
+    corpus = default_corpus()
+  print '%-20s %7s %10s %10s %6s %12s' % (
+      'document', 'bytes', 'proto us', 'light us', '(x)', '+to_proto us')
+  for r in benchmark_parsers(corpus):
+    print '%-20s %7d %10.1f %10.1f %5.1fx %12.1f' % (
+        r['name'][-20:], r['size'], r['proto'], r['light'],
+        r['proto'] / r['light'], r['light_to_proto'])
+
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -19,6 +19,24 @@
 import unittest
 import xrd
 
+ALL_XRD = '''<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xml:id="foo">
+  <Expires>1970-01-01T00:00:00Z</Expires>
+  <Subject>http://example.com/gpburdell</Subject>
+  <Property type="http://spec.example.net/type/person" xsi:nil="true" />
+  <Alias>http://people.example.com/gpburdell</Alias>
+  <Alias>acct:gpburdell@example.com</Alias>
+  <Link rel="http://spec.example.net/auth/1.0"
+      href="http://services.example.com/auth" />
+  <Link rel="lrdd" template="http://example.com/xrd?q={uri}" />
+  <Link rel="http://spec.example.net/photo/1.0" type="image/jpeg"
+      href="http://photos.example.com/gpburdell.jpg">
+    <Title xml:lang="en">User Photo</Title>
+    <Title>Photo</Title>
+    <Property type="http://spec.example.net/created">2009</Property>
+  </Link>
+</XRD>'''
+
 class ParserTest(unittest.TestCase):
 
   def testParseEmptyString(self):
@@ -70,6 +88,14 @@ class ParserTest(unittest.TestCase):
     self.assertEquals('http://www.google.com/profiles/brad.fitz',
                       description.aliases[1])
 
+  def testParseExpires(self):
+    self.assertEquals(1000000000, xrd.parse_expires('2001-09-09T01:46:40Z'))
+    self.assertEquals(1000000000,
+                      xrd.parse_expires('2001-09-09T03:46:40.25+02:00'))
+    self.assertEquals(1000000000, xrd.parse_expires('2001-09-09T01:46:40'))
+    self.assertEquals(None, xrd.parse_expires(''))
+    self.assertEquals(None, xrd.parse_expires('tomorrow'))
+
   def testParseAll(self):
     parser = xrd.Parser()
     description = parser.parse(
@@ -115,9 +141,53 @@ class ParserTest(unittest.TestCase):
     self.assertEquals('User Photo', description.links[1].titles[0].value)
     self.assertEquals('en', description.links[1].titles[0].lang)
 
+
+class LightParserTest(unittest.TestCase):
+
+  def testParseEmptyString(self):
+    self.assertRaises(xrd.ParseError, xrd.LightParser().parse, '')
+
+  def testParseWrongRoot(self):
+    self.assertRaises(xrd.ParseError, xrd.LightParser().parse, '<XRDS/>')
+
+  def testMatchesParser(self):
+    description = xrd.LightParser().parse(ALL_XRD)
+    self.assertEquals(xrd.Parser().parse(ALL_XRD), xrd.to_proto(description))
+
+  def testFields(self):
+    description = xrd.LightParser().parse(ALL_XRD)
+    self.assertEquals('foo', description.id)
+    self.assertEquals('1970-01-01T00:00:00Z', description.expires)
+    self.assertEquals('http://example.com/gpburdell', description.subject)
+    self.assertEquals(True, description.properties[0].nil)
+    self.assertEquals(['http://people.example.com/gpburdell',
+                       'acct:gpburdell@example.com'], description.aliases)
+    self.assertEquals(['http://spec.example.net/auth/1.0', 'lrdd',
+                       'http://spec.example.net/photo/1.0'],
+                      [link.rel for link in description.links])
+    self.assertEquals('http://example.com/xrd?q={uri}',
+                      description.links[1].template)
+    self.assertEquals('', description.links[1].href)
+    photo = description.links[2]
+    self.assertEquals([('en', 'User Photo'), ('', 'Photo')],
+                      [(title.lang, title.value) for title in photo.titles])
+    self.assertEquals('2009', photo.properties[0].value)
+    self.assertEquals(False, photo.properties[0].nil)
+
+  def testFromProto(self):
+    description_pb = xrd.Parser().parse(ALL_XRD)
+    self.assertEquals(description_pb,
+                      xrd.to_proto(xrd.from_proto(description_pb)))
+
+  def testSlots(self):
+    description = xrd.LightParser().parse(ALL_XRD)
+    self.assertRaises(AttributeError, setattr, description, 'extra', 1)
+
+
 def suite():
   suite = unittest.TestSuite()
   suite.addTests(unittest.makeSuite(ParserTest))
+  suite.addTests(unittest.makeSuite(LightParserTest))
   return suite
 
 if __name__ == '__main__':
@@ -44,6 +44,12 @@ import magicsigalg
 
 
 _WHITESPACE_RE = re.compile(r'\s+')
+_BASE64URL_RE = re.compile(r'[A-Za-z0-9_\-]*={0,2}$')
+
+# Bounds on decoded signature length: 512 to 8192 bit keys, allowing
+# for signers that drop leading zero bytes.
+_MIN_SIG_BYTES = 60
+_MAX_SIG_BYTES = 1024
 
 
 class Error(Exception):
@@ -125,6 +131,109 @@ __register_namespace('atom', _ATOM_NS_URL)
 __register_namespace('me', _ME_NS_URL)
 __register_namespace('thr', 'http://purl.org/syndication/thread/1.0')
 
+# Bytes read per call when parsing envelopes from a stream.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _EnvelopeStreamTarget(object):
+  """XMLParser target that collects magic envelope fields from a stream.
+
+  No element tree is built.  Character data of me:data and me:sig is
+  stripped of whitespace chunk by chunk as the parser hands it over, so
+  the only sizeable thing kept is one squeezed copy of the payload.
+  Only the first me:env or me:provenance element (and its first me:sig)
+  is used.
+  """
+
+  _FIELDS = frozenset(_ME_NS + name
+                      for name in ('data', 'encoding', 'alg', 'sig'))
+
+  def __init__(self):
+    self.data_type = None
+    self.chunks = {}  # tag -> list of text chunks
+    self.found = False
+    self._in_env = False
+    self._field = None
+
+  def start(self, tag, attrib):
+    if not self._in_env:
+      if not self.found and tag in (_ME_NS+'env', _ME_NS+'provenance'):
+        self._in_env = self.found = True
+      return
+    if tag not in self._FIELDS or tag in self.chunks:
+      return
+    self._field = self.chunks[tag] = []
+    if tag == _ME_NS+'data':
+      self.data_type = attrib.get('type')
+
+  def data(self, chunk):
+    if self._field is not None:
+      self._field.append(re.sub(_WHITESPACE_RE, '', chunk))
+
+  def end(self, tag):
+    if tag in (_ME_NS+'env', _ME_NS+'provenance'):
+      self._in_env = False
+    self._field = None
+
+  def close(self):
+    return self
+
+  def GetField(self, name):
+    """Returns the squeezed text of the me:<name> element, or None."""
+    chunks = self.chunks.get(_ME_NS + name)
+    if chunks is None:
+      return None
+    return ''.join(chunks)
+
+
+class _SignerFound(Exception):
+  """Stops _SignerScanTarget's parse once the signer URI is known."""
+
+  def __init__(self, uri):
+    Exception.__init__(self, uri)
+    self.uri = uri
+
+
+class _SignerAmbiguous(Exception):
+  """Raised by _SignerScanTarget when only a full parse can be trusted."""
+
+
+class _SignerScanTarget(object):
+  """XMLParser target that looks for the first atom:author/atom:uri.
+
+  Finds the same text as findall('author/uri') on the root of a fully
+  parsed tree, but builds no elements and raises _SignerFound as soon
+  as the URI is complete, so the rest of the document is never parsed.
+  A URI element with child elements raises _SignerAmbiguous instead.
+  """
+
+  def __init__(self):
+    self._depth = 0
+    self._in_author = False
+    self._uri_chunks = None  # Text chunks of the atom:uri being read
+
+  def start(self, tag, attrib):
+    self._depth += 1
+    if self._uri_chunks is not None:
+      raise _SignerAmbiguous()
+    if self._depth == 2:
+      self._in_author = tag == _ATOM_NS+'author'
+    elif self._in_author and self._depth == 3 and tag == _ATOM_NS+'uri':
+      self._uri_chunks = []
+
+  def data(self, chunk):
+    if self._uri_chunks is not None and self._depth == 3:
+      self._uri_chunks.append(chunk)
+
+  def end(self, tag):
+    if self._uri_chunks is not None and self._depth == 3:
+      raise _SignerFound(''.join(self._uri_chunks) or None)
+    self._depth -= 1
+
+  def close(self):
+    return None
+
+
 class MagicEnvelopeProtocol(object):
   """Implementation of Magic Envelope protocol."""
 
@@ -148,19 +257,28 @@ class MagicEnvelopeProtocol(object):
     in the input and act as if that is the only author.
 
     Args:
-      data: The message, either pre-parsed or a string.
+      data: The message, either pre-parsed or a string.  Strings are
+        scanned only as far as the first author URI; a tree is built
+        only if the author markup is too odd for the scan to be sure.
     Returns:
       The URI of the author of the message.
     """
-    if isinstance(data, et.ElementTree):
-      d = data
-    else:
-      d = et.ElementTree()
-      d._setroot(et.XML(data))
+    if not isinstance(data, et.ElementTree):
+      parser = et.XMLParser(target=_SignerScanTarget())
+      try:
+        parser.feed(data)
+        parser.close()
+      except _SignerFound, found:
+        return NormalizeUserIdToUri(found.uri)
+      except _SignerAmbiguous:
+        data = et.ElementTree(et.fromstring(data))
+      else:
+        return None
 
-    auth_uris = d.getroot().findall(_ATOM_NS+'author/'+_ATOM_NS+'uri')
+    auth_uris = data.getroot().findall(_ATOM_NS+'author/'+_ATOM_NS+'uri')
     for u in auth_uris:
       return NormalizeUserIdToUri(u.text)
+    return None
 
   def IsAllowedSigner(self, data, userid_uri):
     """Checks that userid_uri is identified as an allowed signer.
@@ -260,6 +378,38 @@ class MagicEnvelopeProtocol(object):
       raise ValueError('Unknown encoding %s' % encoding)
     return base64.urlsafe_b64decode(encoded_text_data.encode('utf-8'))
 
+  def CheckSignedFields(self, data, sig):
+    """Cheap structural checks on an inbound envelope's encoded fields.
+
+    Runs before anything is decoded, looked up or parsed, so that junk
+    is turned away for next to no CPU.  Passing says nothing about
+    whether the signature verifies.
+
+    Args:
+      data: The encoded payload, with whitespace removed.
+      sig: The encoded signature, with whitespace removed.
+    Raises:
+      ValueError: The fields can not belong to a valid envelope.
+    """
+    if not _BASE64URL_RE.match(sig):
+      raise ValueError('Signature is not base64url')
+    sig_bytes = len(sig.rstrip('=')) * 3 / 4
+    if not _MIN_SIG_BYTES <= sig_bytes <= _MAX_SIG_BYTES:
+      raise ValueError('Implausible signature length %d' % sig_bytes)
+    if not _BASE64URL_RE.match(data):
+      raise ValueError('Data is not base64url')
+
+  def CheckDataType(self, mime_type):
+    """Checks that payloads of the given MIME type are supported.
+
+    Args:
+      mime_type: Type of the textual data.  application/atom+xml supported
+    Raises:
+      ValueError: The MIME type is not supported.
+    """
+    if mime_type != 'application/atom+xml':
+      raise ValueError('Unknown MIME type %s' % mime_type)
+
   def ParseData(self, raw_text_data, mime_type):
     """Parses the payload of a magic envelope's data field.
 
@@ -271,8 +421,7 @@ class MagicEnvelopeProtocol(object):
     Returns:
       Parsed data suitable for passing in to other methods of this object.
     """
-    if mime_type != 'application/atom+xml':
-      raise ValueError('Unknown MIME type %s' % mime_type)
+    self.CheckDataType(mime_type)
 
     d = et.ElementTree()
     d._setroot(et.XML(raw_text_data))
@@ -322,6 +471,46 @@ class MagicEnvelopeProtocol(object):
     )
 
 
+  def ParseStream(self, stream, chunk_size=_STREAM_CHUNK_SIZE):
+    """Parses a magic envelope from a file-like object.
+
+    Like Parse, but the input is fed to the XML parser chunk_size bytes
+    at a time and only the envelope fields are kept, so peak memory
+    stays close to one copy of the payload.
+
+    Args:
+      stream: File-like object with a read(size) method, holding an
+        application/magic-envelope+xml or application/atom+xml document.
+      chunk_size: Number of bytes to read per call.
+    Raises:
+      ValueError: The input format was unrecognized or badly formed.
+    Returns:
+      Magic envelope fields in dict format per section 3.1 of spec.
+    """
+    target = _EnvelopeStreamTarget()
+    parser = et.XMLParser(target=target)
+    try:
+      while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+          break
+        parser.feed(chunk)
+      parser.close()
+    except SyntaxError, e:  # ElementTree's ParseError
+      raise ValueError('Badly formed XML: %s' % e)
+
+    if not target.found:
+      raise ValueError('Unrecognized input format')
+
+    return dict(
+        data=target.GetField('data'),
+        encoding=target.GetField('encoding'),
+        data_type=target.data_type,
+        alg=target.GetField('alg'),
+        sig=target.GetField('sig'),
+    )
+
+
 class EnvelopeError(Error):
   """Error thrown on failure to initialize an Envelope."""
   invalid_envelope = None  # The failed envelope
@@ -349,7 +538,8 @@ class Envelope(object):
   _alg = None  # The algorithm used ("RSA")
   _sig = None  # The signature string
 
-  _parsed_data = None  # The data as a parsed object
+  _raw_data = None  # The decoded payload
+  _parsed_data = None  # The data as a parsed object, built on demand
   _signer_uri = None  # URI of signer
   _signer_key = None  # Key(pair) associated w/signature
 
@@ -385,11 +575,15 @@ class Envelope(object):
     # Input from serialized text document if provided:
     self._mime_type = kwargs.get('mime_type', None)
     self._document = kwargs.get('document', None)
+    stream = kwargs.get('stream', None)
 
     if self._document:
       # If document provided, use it to parse out fields:
       fields = self._protocol.Parse(self._document, self._mime_type)
       kwargs.update(fields)
+    elif stream:
+      # Same for a file-like document, without holding all of it:
+      kwargs.update(self._protocol.ParseStream(stream))
 
     # Pull structured data from kwargs and sanity check:
     self._data = kwargs.get('data', None)
@@ -416,24 +610,33 @@ class Envelope(object):
       assert not self._data
       assert 'signer_uri' in kwargs
       assert 'signer_key' in kwargs  # And it better be a keypair too!
+      self._protocol.CheckDataType(self._data_type)
 
-      self._parsed_data = self._protocol.ParseData(raw_data,
-                                                   self._data_type)
       self._data = self._protocol.EncodeData(raw_data,
                                              self._encoding)
       self._signer_uri = kwargs['signer_uri']
       self._signer_key = kwargs['signer_key']
     elif self._sig:
       # If passed a signature, the envelope goes into verify mode.
+      # Inbound envelopes are checked in stages, cheapest first:
+      # structure here, then author scan, key lookup and RSA in
+      # _PerformVerification.  The payload is only parsed into a tree
+      # once it has verified.
       if not self._data:
         raise EnvelopeError(self, 'No data to verify')
+      try:
+        self._protocol.CheckDataType(self._data_type)
+        self._protocol.CheckSignedFields(self._data, self._sig)
+      except ValueError, e:
+        raise EnvelopeError(self, str(e))
       raw_data = self._protocol.DecodeData(self._data, self._encoding)
     else:
       # No raw data and no signature, give up.
       raise EnvelopeError(self, 'Insufficient data to initialize envelope.')
 
-    # Cache a parsed representation of the raw data:
-    self._parsed_data = self._protocol.ParseData(raw_data, self._data_type)
+    # Keep the decoded payload; it is only parsed into a tree if
+    # somebody asks for it (see GetParsedData).
+    self._raw_data = raw_data
 
     # At this point the envelope is initialized but is not yet valid.
     # (It needs to be either verified or signed.)
@@ -449,7 +652,7 @@ class Envelope(object):
     """Signs an envelope given appropriate key inputs."""
     assert self._signer_uri
     assert self._signer_key
-    assert self._protocol.IsAllowedSigner(self._parsed_data, self._signer_uri)
+    assert self._protocol.IsAllowedSigner(self._raw_data, self._signer_uri)
 
     signature_alg = self._protocol.GetSigningAlg(self._signer_key)
     self._sig = signature_alg.Sign(self._data)
@@ -463,12 +666,15 @@ class Envelope(object):
 
   def _PerformVerification(self):
     """Performs signature verification on parsed data."""
-    # Decode data to text, cache parsed representation,
-    # and find the key to use:
-    text = base64.urlsafe_b64decode(self._data.encode('utf-8'))
-    self._parsed_data = self._protocol.ParseData(text, self._data_type)
-    self._signer_uri = self._protocol.GetSignerURI(self._parsed_data)
+    # Find the author and the key to use; the payload was decoded
+    # once already, and needs no full parse for this.
+    self._signer_uri = self._protocol.GetSignerURI(self._raw_data)
+    if not self._signer_uri:
+      raise EnvelopeError(self, 'No author found in data.')
     self._signer_public_key = self._protocol.GetPublicKey(self._signer_uri)
+    if not self._signer_public_key:
+      raise EnvelopeError(self, 'No public key found for %s.' %
+                          self._signer_uri)
 
     # Get a verifier for that key:
     verifier = self._protocol.GetVerifierAlg(self._signer_public_key)
@@ -530,10 +736,7 @@ class Envelope(object):
       An Atom entry XML document with an me:provenance element
       containing the original magic signature data.
     """
-    if not self._parsed_data:
-      self._parsed_data = self._protocol.ParseData(text, self._data_type)
-
-    d = self._parsed_data
+    d = self.GetParsedData()
     assert d.getroot().tag == _ATOM_NS+'entry'
 
     # Create a provenance and add it in.
@@ -567,14 +770,13 @@ class Envelope(object):
 
   def GetData(self):
     """Returns envelope's verified data."""
-    return self._protocol.Decode(self._data, self._encoding)
+    return self._raw_data
 
   def GetParsedData(self):
     """Returns envelope's verified data in parsed form."""
     if not self._parsed_data:
-      self._parsed_data = self._protocol.ParseData(
-          self._protocol.Decode(self._data),
-          self._data_type)
+      self._parsed_data = self._protocol.ParseData(self._raw_data,
+                                                   self._data_type)
     return self._parsed_data
 
   def GetDataWithProvenance(self):
@@ -0,0 +1,469 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark suite for the magicsig and magicsig_hjfreyer packages.
+
+Micro benchmarks time key parsing, EMSA encoding, signing and verifying
+across key and payload sizes.  Macro benchmarks time full round trips
+(sign, serialize, parse, verify) through each package's envelope API,
+including magicsig_hjfreyer's JSON and compact token forms, plus
+magicsig's inbound parse-and-verify on its own.  A memory benchmark
+reports the per-envelope cost of holding a large verification backlog
+of magicsig_hjfreyer envelopes, against a plain dict-based layout.
+
+Results can be written as JSON and compared against a previously saved
+run; timings more than --tolerance slower than the baseline are
+reported as regressions and make the run exit non-zero.
+
+Run directly (with lib/python on PYTHONPATH):
+
+  python magicsig_benchmark.py --output baseline.json
+  python magicsig_benchmark.py --baseline baseline.json
+"""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import optparse
+import os
+import sys
+import time
+import timeit
+
+# json is standard with Python >=2.6.
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+from Crypto.PublicKey import RSA
+
+import magicsig
+import magicsig.magicsigalg as magicsigalg
+import magicsig_hjfreyer
+
+KEY_SIZES = (512, 1024, 2048, 4096)
+PAYLOAD_SIZES = (1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+
+QUICK_KEY_SIZES = (512, 2048)
+QUICK_PAYLOAD_SIZES = (1024, 100 * 1024)
+
+# Envelopes held in memory by the backlog benchmark.
+ENVELOPE_COUNT = 1000000
+QUICK_ENVELOPE_COUNT = 100000
+
+# Minimum wall time, in seconds, of a single timing run.
+_MIN_RUN_TIME = 0.2
+
+_AUTHOR = 'acct:test@example.com'
+
+_ATOM_TEMPLATE = """<?xml version='1.0' encoding='UTF-8'?>
+<entry xmlns='http://www.w3.org/2005/Atom'>
+  <id>tag:example.com,2009:cmt-0.44775718</id>
+  <author><name>test@example.com</name><uri>acct:test@example.com</uri>
+  </author>
+  <content>%s</content>
+  <title>Salmon swim upstream!</title>
+  <updated>2009-12-18T20:04:03Z</updated>
+</entry>
+"""
+
+_keys = {}
+
+
+def _Time(fn, min_run_time=_MIN_RUN_TIME):
+  """Returns the best per-call time of fn, in microseconds.
+
+  The number of calls per run is scaled so that a run takes at least
+  min_run_time seconds; the best of three runs is reported.
+  """
+  timer = timeit.Timer(fn)
+  number = 1
+  elapsed = timer.timeit(number)
+  if elapsed < min_run_time:
+    number = int(min_run_time / max(elapsed, 1e-6)) + 1
+  best = min(timer.repeat(repeat=3, number=number))
+  return best * 1e6 / number
+
+
+def _Result(name, key_bits, payload_bytes, usec):
+  return dict(name=name,
+              key_bits=key_bits,
+              payload_bytes=payload_bytes,
+              usec=usec)
+
+
+def _ResultId(result):
+  return '%(name)s/%(key_bits)d/%(payload_bytes)d' % result
+
+
+def GetKey(bits):
+  """Returns a magic signature keypair string of the given size.
+
+  Keys are generated on first use and reused for the rest of the run.
+  """
+  if bits not in _keys:
+    key = RSA.generate(bits, os.urandom)
+    alg = magicsigalg.SignatureAlgRsaSha256(
+        (key.n, key.e, key.d, key.p, key.q))
+    _keys[bits] = alg.ToString()
+  return _keys[bits]
+
+
+def MakePayload(size):
+  """Returns a deterministic string of size bytes."""
+  pattern = 'Salmon swim upstream! '
+  return (pattern * (size / len(pattern) + 1))[:size]
+
+
+def MakeAtom(size):
+  """Returns an Atom entry authored by _AUTHOR, about size bytes long."""
+  padding = size - len(_ATOM_TEMPLATE % '')
+  return _ATOM_TEMPLATE % MakePayload(max(padding, 1))
+
+
+class _FixedKeyRetriever(magicsig.KeyRetriever):
+  """Returns the same keypair for every signer."""
+
+  def __init__(self, key):
+    self.key = key
+
+  def LookupPublicKey(self, signer_uri):
+    return self.key
+
+
+class _FixedHjfreyerKeyRetriever(magicsig_hjfreyer.KeyRetriever):
+  """Returns the same keypair for every signer."""
+
+  def __init__(self, key):
+    self.key = key
+
+  def LookupPublicKey(self, signer_uri):
+    return self.key
+
+  def LookupPrivateKey(self, signer_uri):
+    return self.key
+
+
+def BenchmarkKeyParse(key_sizes):
+  """Times parsing a magic signature keypair string."""
+  results = []
+  for bits in key_sizes:
+    key = GetKey(bits)
+    results.append(_Result(
+        'key_parse', bits, 0,
+        _Time(lambda: magicsigalg.SignatureAlgRsaSha256(key))))
+  return results
+
+
+def BenchmarkAlg(key_sizes, payload_sizes):
+  """Times EMSA encoding, signing and verifying raw payloads."""
+  results = []
+  for bits in key_sizes:
+    alg = magicsigalg.SignatureAlgRsaSha256(GetKey(bits))
+    modulus_size = alg._modulus_bytes
+    for size in payload_sizes:
+      payload = MakePayload(size)
+      sig = alg.Sign(payload)
+      results.append(_Result(
+          'emsa', bits, size,
+          _Time(lambda: alg._MakeEmsaMessageSha256(payload, modulus_size))))
+      results.append(_Result(
+          'sign', bits, size, _Time(lambda: alg.Sign(payload))))
+      results.append(_Result(
+          'verify', bits, size, _Time(lambda: alg.Verify(payload, sig))))
+  return results
+
+
+def BenchmarkRoundTrip(key_sizes, payload_sizes):
+  """Times sign, serialize, parse and verify through both envelope APIs."""
+  results = []
+  for bits in key_sizes:
+    key = GetKey(bits)
+
+    protocol = magicsig.MagicEnvelopeProtocol()
+    protocol.key_retriever = _FixedKeyRetriever(key)
+
+    hjfreyer_protocol = magicsig_hjfreyer.MagicEnvelopeProtocol(
+        key_retriever=_FixedHjfreyerKeyRetriever(key),
+        algs=magicsig_hjfreyer.magicsigalg.DefaultAlgorithms(),
+        auto_verify=False)
+
+    for size in payload_sizes:
+      atom = MakeAtom(size)
+
+      def RoundTrip():
+        envelope = magicsig.Envelope(protocol,
+                                     raw_data_to_sign=atom,
+                                     signer_uri=_AUTHOR,
+                                     signer_key=key,
+                                     data_type='application/atom+xml')
+        # Parsing a document verifies it.
+        magicsig.Envelope(protocol,
+                          mime_type='application/magic-envelope+xml',
+                          document=envelope.ToXML())
+
+      signed = magicsig.Envelope(protocol,
+                                 raw_data_to_sign=atom,
+                                 signer_uri=_AUTHOR,
+                                 signer_key=key,
+                                 data_type='application/atom+xml').ToXML()
+
+      def ParseAndVerify():
+        magicsig.Envelope(protocol,
+                          mime_type='application/magic-envelope+xml',
+                          document=signed)
+
+      def HjfreyerRoundTrip():
+        envelope = hjfreyer_protocol.WrapAndSign(atom,
+                                                 'application/atom+xml')
+        parsed = hjfreyer_protocol.FromString(
+            hjfreyer_protocol.ToXmlString(envelope))
+        assert hjfreyer_protocol.VerifyEnvelope(parsed)
+
+      def HjfreyerJsonRoundTrip():
+        envelope = hjfreyer_protocol.WrapAndSign(atom,
+                                                 'application/atom+xml')
+        parsed = hjfreyer_protocol.FromString(
+            hjfreyer_protocol.ToJsonString(envelope),
+            magicsig_hjfreyer.utils.Mimes.JSON_ME)
+        assert hjfreyer_protocol.VerifyEnvelope(parsed)
+
+      def HjfreyerCompactRoundTrip():
+        envelope = hjfreyer_protocol.WrapAndSign(atom,
+                                                 'application/atom+xml')
+        parsed = hjfreyer_protocol.FromCompactString(
+            hjfreyer_protocol.ToCompactString(envelope))
+        assert hjfreyer_protocol.VerifyEnvelope(parsed)
+
+      results.append(_Result('magicsig_round_trip', bits, size,
+                             _Time(RoundTrip)))
+      results.append(_Result('magicsig_parse_verify', bits, size,
+                             _Time(ParseAndVerify)))
+      results.append(_Result('hjfreyer_round_trip', bits, size,
+                             _Time(HjfreyerRoundTrip)))
+      results.append(_Result('hjfreyer_json_round_trip', bits, size,
+                             _Time(HjfreyerJsonRoundTrip)))
+      results.append(_Result('hjfreyer_compact_round_trip', bits, size,
+                             _Time(HjfreyerCompactRoundTrip)))
+  return results
+
+
+class _DictEnvelope(object):
+  """Envelope fields held the plain way, in a per-instance dict.
+
+  Mirrors magicsig_hjfreyer.Envelope's fields, as a reference point for
+  BenchmarkEnvelopeMemory.
+  """
+
+  def __init__(self, data, data_type, sig, keyhash='',
+               encoding='base64url', alg='RSA-SHA256'):
+    squeeze = magicsig_hjfreyer.utils.Squeeze
+    self.data = squeeze(data)
+    self.data_type = squeeze(data_type)
+    self.sig = squeeze(sig)
+    self.keyhash = squeeze(keyhash)
+    self.encoding = squeeze(encoding)
+    self.alg = squeeze(alg)
+    self.extra_sigs = []
+
+
+def _EnvelopeBytes(envelope, shared):
+  """Returns the bytes an envelope and its field values take up.
+
+  Values shared between many envelopes (interned strings, the empty
+  tuple, None) are counted only the first time they are seen; shared
+  holds the ids of those already counted.
+  """
+  size = sys.getsizeof(envelope)
+  fields = getattr(envelope, '__dict__', None)
+  if fields is not None:
+    size += sys.getsizeof(fields)
+    values = fields.values()
+  else:
+    values = [getattr(envelope, name) for name in envelope.__slots__]
+  for value in values:
+    # A value held by just this envelope has a handful of references
+    # (its field, values, value and getrefcount's argument).
+    if sys.getrefcount(value) > 10:
+      if id(value) in shared:
+        continue
+      shared.add(id(value))
+    size += sys.getsizeof(value)
+  return size
+
+
+def BenchmarkEnvelopeMemory(count):
+  """Measures the memory taken by a backlog of count envelopes.
+
+  Each envelope gets its own small payload and signature, and its other
+  fields are built afresh, as they would be when parsed off the wire.
+
+  Returns:
+    A list of dicts (name, envelopes, bytes_per_envelope,
+    overhead_per_envelope); the overhead excludes the payload and
+    signature characters themselves.
+  """
+  def Fresh(text):
+    return text[:1] + text[1:]  # An equal string, but a new object
+
+  sig = magicsigalg.SignatureAlgRsaSha256(GetKey(512)).Sign('x')
+  results = []
+  for name, cls in (('hjfreyer_envelope', magicsig_hjfreyer.Envelope),
+                    ('dict_envelope', _DictEnvelope)):
+    backlog = []
+    for i in xrange(count):
+      backlog.append(cls(data='PGVudHJ5Lz4-%010d' % i,
+                         data_type=Fresh('application/atom+xml'),
+                         sig=sig[:-10] + '%010d' % i,
+                         encoding=Fresh('base64url'),
+                         alg=Fresh('RSA-SHA256')))
+    shared = set()
+    total = 0
+    content = 0
+    for envelope in backlog:
+      total += _EnvelopeBytes(envelope, shared)
+      content += len(envelope.data) + len(envelope.sig)
+    del backlog
+    results.append(dict(name=name,
+                        envelopes=count,
+                        bytes_per_envelope=float(total) / count,
+                        overhead_per_envelope=float(total - content) / count))
+  return results
+
+
+def RunAll(key_sizes=KEY_SIZES, payload_sizes=PAYLOAD_SIZES,
+           envelope_count=ENVELOPE_COUNT):
+  """Runs every benchmark.
+
+  Returns:
+    A JSON-serializable dict describing the run and its results.
+  """
+  results = []
+  results.extend(BenchmarkKeyParse(key_sizes))
+  results.extend(BenchmarkAlg(key_sizes, payload_sizes))
+  results.extend(BenchmarkRoundTrip(key_sizes, payload_sizes))
+  memory = []
+  if envelope_count:
+    memory = BenchmarkEnvelopeMemory(envelope_count)
+  return dict(timestamp=time.time(),
+              python=sys.version.split()[0],
+              backend=magicsigalg.GetBackend().name,
+              results=results,
+              memory=memory)
+
+
+def CompareToBaseline(run, baseline, tolerance=0.25):
+  """Finds benchmarks that got slower than a baseline run.
+
+  Args:
+    run: A dict as returned by RunAll().
+    baseline: A previous RunAll() dict.
+    tolerance: Allowed slowdown, as a fraction of the baseline time.
+  Returns:
+    A list of dicts (id, baseline_usec, usec, ratio) for each benchmark
+    present in both runs that is more than tolerance slower, worst first.
+  """
+  baseline_usec = dict((_ResultId(r), r['usec'])
+                       for r in baseline['results'])
+  regressions = []
+  for result in run['results']:
+    result_id = _ResultId(result)
+    if result_id not in baseline_usec:
+      continue
+    ratio = result['usec'] / baseline_usec[result_id]
+    if ratio > 1 + tolerance:
+      regressions.append(dict(id=result_id,
+                              baseline_usec=baseline_usec[result_id],
+                              usec=result['usec'],
+                              ratio=ratio))
+  regressions.sort(key=lambda r: r['ratio'], reverse=True)
+  return regressions
+
+
+def _ParseSizes(text):
+  return tuple(int(s) for s in text.split(','))
+
+
+def main(argv):
+  parser = optparse.OptionParser()
+  parser.add_option('--quick', action='store_true', default=False,
+                    help='Run a reduced set of key and payload sizes.')
+  parser.add_option('--key-sizes', type='string',
+                    help='Comma separated key sizes in bits.')
+  parser.add_option('--payload-sizes', type='string',
+                    help='Comma separated payload sizes in bytes.')
+  parser.add_option('--envelopes', type='int',
+                    help='Envelopes held by the memory benchmark; 0 skips it.')
+  parser.add_option('--output', type='string',
+                    help='Write results as JSON to this file.')
+  parser.add_option('--baseline', type='string',
+                    help='Compare results against this JSON file.')
+  parser.add_option('--tolerance', type='float', default=0.25,
+                    help='Allowed slowdown before reporting a regression.')
+  options, _ = parser.parse_args(argv[1:])
+
+  if options.quick:
+    key_sizes, payload_sizes = QUICK_KEY_SIZES, QUICK_PAYLOAD_SIZES
+    envelope_count = QUICK_ENVELOPE_COUNT
+  else:
+    key_sizes, payload_sizes = KEY_SIZES, PAYLOAD_SIZES
+    envelope_count = ENVELOPE_COUNT
+  if options.key_sizes:
+    key_sizes = _ParseSizes(options.key_sizes)
+  if options.payload_sizes:
+    payload_sizes = _ParseSizes(options.payload_sizes)
+  if options.envelopes is not None:
+    envelope_count = options.envelopes
+
+  run = RunAll(key_sizes, payload_sizes, envelope_count)
+
+  print '%-28s %6s %10s %14s' % ('benchmark', 'bits', 'bytes', 'us/call')
+  for r in run['results']:
+    print '%-28s %6d %10d %14.1f' % (r['name'], r['key_bits'],
+                                     r['payload_bytes'], r['usec'])
+  if run['memory']:
+    print
+    print '%-28s %10s %14s %14s' % ('memory', 'envelopes', 'bytes/env',
+                                    'overhead/env')
+  for r in run['memory']:
+    print '%-28s %10d %14.1f %14.1f' % (r['name'], r['envelopes'],
+                                        r['bytes_per_envelope'],
+                                        r['overhead_per_envelope'])
+
+  if options.output:
+    f = open(options.output, 'w')
+    try:
+      json.dump(run, f, indent=2, sort_keys=True)
+    finally:
+      f.close()
+
+  if options.baseline:
+    f = open(options.baseline)
+    try:
+      baseline = json.load(f)
+    finally:
+      f.close()
+    regressions = CompareToBaseline(run, baseline, options.tolerance)
+    for r in regressions:
+      print 'REGRESSION %-36s %12.1f -> %12.1f us (%.2fx)' % (
+          r['id'], r['baseline_usec'], r['usec'], r['ratio'])
+    if regressions:
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -19,6 +19,7 @@
 __author__ = 'jpanzer@google.com (John Panzer)'
 
 import re
+import StringIO
 import unittest
 try:
   import google3  # GOOGLE local modification
@@ -84,6 +85,24 @@ class TestMagicEnvelopeProtocol(unittest.TestCase):
     a = self.magicenv.GetSignerURI(self.test_atom_multi_author)
     self.assertEquals(a, 'acct:alice@example.com')
 
+  def testGetSignerURIScanMatchesTree(self):
+    nested = """<entry xmlns='http://www.w3.org/2005/Atom'>
+      <source><author><uri>acct:feed@example.com</uri></author></source>
+      <author><name>x</name><uri>acct:alice@example.com</uri></author>
+    </entry>"""
+    mixed = self.test_atom.replace('acct:test@example.com</uri>',
+                                   'acct:test@example.com<b>x</b></uri>')
+    for text in (self.test_atom, self.test_atom_multi_author, nested, mixed,
+                 "<entry xmlns='http://www.w3.org/2005/Atom'/>"):
+      tree = self.magicenv.ParseData(text, 'application/atom+xml')
+      self.assertEquals(self.magicenv.GetSignerURI(tree),
+                        self.magicenv.GetSignerURI(text))
+
+    # The scan stops at the author; what follows is never parsed.
+    truncated = self.test_atom[:self.test_atom.index('</author>')]
+    self.assertEquals('acct:test@example.com',
+                      self.magicenv.GetSignerURI(truncated + '</uri>'))
+
   def testIsAllowedSigner(self):
     # Check that we can recognize the author
     self.assertTrue(self.magicenv.IsAllowedSigner(self.test_atom,
@@ -175,6 +194,44 @@ class TestMagicEnvelope(unittest.TestCase):
 
     # Getting here without an exception is success.
 
+  def testPayloadParsedOnDemand(self):
+    signed = magicsig.Envelope(
+        self.protocol,
+        raw_data_to_sign=self.test_atom,
+        signer_uri='acct:test@example.com',
+        signer_key=TEST_PRIVATE_KEY,
+        data_type='application/atom+xml')
+    envelope = magicsig.Envelope(
+        self.protocol,
+        mime_type='application/magic-envelope+xml',
+        document=signed.ToXML())
+
+    self.assertEquals(None, envelope._parsed_data)
+    self.assertEquals(self.test_atom, envelope.GetData())
+    tree = envelope.GetParsedData()
+    self.assertEquals('{http://www.w3.org/2005/Atom}entry', tree.getroot().tag)
+    self.assertTrue(tree is envelope.GetParsedData())
+
+  def testStreamParsing(self):
+    envelope = magicsig.Envelope(
+        self.protocol,
+        raw_data_to_sign=self.test_atom,
+        signer_uri='acct:test@example.com',
+        signer_key=TEST_PRIVATE_KEY,
+        data_type='application/atom+xml')
+
+    for text in (envelope.ToXML(), envelope.ToAtom()):
+      # Tiny chunks split tags, text and whitespace across reads.
+      self.assertEquals(
+          self.protocol.Parse(text),
+          self.protocol.ParseStream(StringIO.StringIO(text), chunk_size=5))
+
+    magicsig.Envelope(self.protocol,
+                      stream=StringIO.StringIO(envelope.ToXML()))
+
+    self.assertRaises(ValueError, self.protocol.ParseStream,
+                      StringIO.StringIO('<foo/>'))
+
   def testToAtom(self):
     envelope = magicsig.Envelope(
         self.protocol,
@@ -209,5 +266,35 @@ class TestMagicEnvelope(unittest.TestCase):
                       mime_type='application/magic-envelope+xml',
                       document=re.sub('U2FsbW9', 'U2GsbW9', xml))
 
+  def testRejectedBeforeParsing(self):
+    envelope = magicsig.Envelope(
+        self.protocol,
+        raw_data_to_sign=self.test_atom,
+        signer_uri='acct:test@example.com',
+        signer_key=TEST_PRIVATE_KEY,
+        data_type='application/atom+xml')
+    xml = envelope.ToXML()
+    sig = envelope._sig
+
+    def WithSig(new_sig):
+      return re.sub(r'(?s)<me:sig>.*</me:sig>',
+                    '<me:sig>%s</me:sig>' % new_sig, xml)
+
+    # None of these get as far as looking up a key:
+    protocol = magicsig.MagicEnvelopeProtocol()
+    protocol.key_retriever = None
+    for forged in (WithSig('AQAB'),
+                   WithSig(sig[:40] + '!' + sig[41:]),
+                   WithSig(sig * 30),
+                   xml.replace('application/atom+xml', 'text/html')):
+      self.assertRaises(magicsig.EnvelopeError,
+                        magicsig.Envelope,
+                        protocol,
+                        mime_type='application/magic-envelope+xml',
+                        document=forged)
+
+    self.assertRaises(ValueError, magicsig.Envelope, self.protocol,
+                      stream=StringIO.StringIO('<me:env'))
+
 if __name__ == '__main__':
   unittest.main()
@@ -25,6 +25,7 @@ __author__ = 'jpanzer@google.com (John Panzer)'
 
 
 import base64
+import binascii
 import re
 
 # PyCrypto: Note that this is not available in the
@@ -34,9 +35,9 @@ import re
 # project's path rather than somewhere more sane.
 import Crypto.PublicKey
 import Crypto.PublicKey.RSA
-from Crypto.Util import number
 
 import hashlib
+import os
 
 
 # Note that PyCrypto is a very low level library and its documentation
@@ -48,6 +49,7 @@ import hashlib
 #     (n, e) - public key
 #     (n, d) - private key
 #     (p, q) - the (private) primes from which the keypair is derived.
+#     u - the CRT coefficient p^-1 mod q (PyCrypto keeps p < q).
 
 # Thus a public key is a tuple (n,e) and a public/private key pair
 # is a tuple (n,e,d).  Often the exponent is 65537 so for convenience
@@ -67,14 +69,41 @@ def GenSampleSignature(text):
 
 
 # Utilities
+def _BytesToLong(s):
+  """Converts a big-endian byte string to a bignum.
+
+  Much faster than Crypto.Util.number.bytes_to_long, which loops over
+  4-byte chunks in Python; hexlify and long() both run in C.
+  """
+  if not s:
+    return 0L
+  return long(binascii.hexlify(s), 16)
+
+
+def _LongToBytes(num, width=0):
+  """Converts a bignum to a big-endian byte string.
+
+  Args:
+    num: The non-negative bignum to convert.
+    width: If given, left pad the result with zero bytes to this many
+      bytes (e.g. the modulus size).  Numbers that need more bytes are
+      never truncated.
+  Returns:
+    The byte string; at least one byte long.
+  """
+  hex_num = '%x' % num
+  width = max(width, (len(hex_num) + 1) / 2)
+  return binascii.unhexlify(hex_num.zfill(2 * width))
+
+
 def _NumToB64(num):
   """Turns a bignum into a urlsafe base64 encoded string."""
-  return base64.urlsafe_b64encode(number.long_to_bytes(num))
+  return base64.urlsafe_b64encode(_LongToBytes(num))
 
 
 def _B64ToNum(b64):
   """Turns a urlsafe base64 encoded string into a bignum."""
-  return number.bytes_to_long(base64.urlsafe_b64decode(b64))
+  return _BytesToLong(base64.urlsafe_b64decode(b64))
 
 # Patterns for parsing serialized keys
 _WHITESPACE_RE = re.compile(r'\s+')
@@ -85,20 +114,253 @@ _KEY_RE = re.compile(
       (?P<exp>[^\.]+)
       (?:\.
         (?P<private_exp>[^\.]+)
+        (?:\.
+          (?P<p>[^\.]+)
+          \.
+          (?P<q>[^\.]+)
+        )?
       )?""",
     re.VERBOSE)
 
 
+# Bignum backends.  The RSA primitives are delegated to a backend so
+# that faster math libraries can be used where they are installed, in
+# the same spirit as tlslite's cryptomath.  Every backend must produce
+# bit-identical signatures.  Backends are tried in _BACKEND_PREFERENCE
+# order at import time; the MAGICSIG_BACKEND environment variable or
+# SetBackend() override the choice.
+
+
+class PythonBackend(object):
+  """RSA using Python's builtin long arithmetic.  Always available."""
+
+  name = 'python'
+
+  def IsAvailable(cls):
+    return True
+  IsAvailable = classmethod(IsAvailable)
+
+  def PowMod(self, base, exponent, modulus):
+    """Returns base**exponent % modulus."""
+    return pow(base, exponent, modulus)
+
+  def SignDigest(self, alg, digest):
+    """Signs a SHA-256 digest with alg's private key.
+
+    Args:
+      alg: The SignatureAlgRsaSha256 holding the key.
+      digest: The SHA-256 digest of the bytes to sign.
+    Returns:
+      The signature as a bignum.
+    Raises:
+      ValueError: alg has no private key.
+    """
+    keypair = alg.keypair
+    if not getattr(keypair, 'd', None):
+      raise ValueError('Private key not available in this object')
+    m = _BytesToLong(alg._MakeEmsaMessageFromDigest(digest, alg._size))
+    if alg._crt:
+      return self._SignCrt(alg, m)
+    return self.PowMod(m, keypair.d, keypair.n)
+
+  def _SignCrt(self, alg, m):
+    """Computes m^d mod n using the CRT parameters (Garner's formula).
+
+    Args:
+      alg: The SignatureAlgRsaSha256 holding the CRT parameters.
+      m: The message representative, as a bignum.
+    Returns:
+      The signature as a bignum.
+    """
+    p, q, dp, dq, u = alg._crt
+    m1 = self.PowMod(m % p, dp, p)
+    m2 = self.PowMod(m % q, dq, q)
+    h = ((m2 - m1) * u) % q
+    s = m1 + h * p
+
+    # Guard against faulty CRT results leaking the factorization;
+    # checking with the public exponent is cheap.
+    keypair = alg.keypair
+    if self.PowMod(s, keypair.e, keypair.n) != m:
+      return self.PowMod(m, keypair.d, keypair.n)
+    return s
+
+  def VerifyDigest(self, alg, digest, signature):
+    """Checks a signature over a SHA-256 digest with alg's public key.
+
+    Args:
+      alg: The SignatureAlgRsaSha256 holding the key.
+      digest: The SHA-256 digest of the signed bytes.
+      signature: The putative signature, as a bignum.
+    Returns:
+      True if the signature is valid, False otherwise.
+    """
+    keypair = alg.keypair
+    if signature >= keypair.n:
+      return False
+    m = _BytesToLong(alg._MakeEmsaMessageFromDigest(digest, alg._size))
+    return self.PowMod(signature, keypair.e, keypair.n) == m
+
+
+class GmpyBackend(PythonBackend):
+  """RSA with modular exponentiation done by GMP via gmpy2 or gmpy."""
+
+  name = 'gmpy'
+
+  def IsAvailable(cls):
+    return _gmpy_powmod is not None
+  IsAvailable = classmethod(IsAvailable)
+
+  def PowMod(self, base, exponent, modulus):
+    """Returns base**exponent % modulus."""
+    return long(_gmpy_powmod(base, exponent, modulus))
+
+
+class CryptographyBackend(object):
+  """RSA done entirely by the pyca/cryptography library (OpenSSL)."""
+
+  name = 'cryptography'
+
+  def IsAvailable(cls):
+    return _cryptography is not None
+  IsAvailable = classmethod(IsAvailable)
+
+  def _PublicKey(self, alg):
+    key = alg._backend_keys.get('cryptography.public')
+    if key is None:
+      rsa = _cryptography['rsa']
+      key = rsa.RSAPublicNumbers(alg.keypair.e, alg.keypair.n).public_key(
+          _cryptography['backend'])
+      alg._backend_keys['cryptography.public'] = key
+    return key
+
+  def _PrivateKey(self, alg):
+    key = alg._backend_keys.get('cryptography.private')
+    if key is None:
+      rsa = _cryptography['rsa']
+      keypair = alg.keypair
+      if not getattr(keypair, 'd', None):
+        raise ValueError('Private key not available in this object')
+      if alg._crt:
+        p, q = alg._crt[:2]
+      else:
+        p, q = rsa.rsa_recover_prime_factors(keypair.n, keypair.e, keypair.d)
+      d = keypair.d
+      key = rsa.RSAPrivateNumbers(
+          p, q, d, rsa.rsa_crt_dmp1(d, p), rsa.rsa_crt_dmq1(d, q),
+          rsa.rsa_crt_iqmp(p, q),
+          rsa.RSAPublicNumbers(keypair.e, keypair.n)).private_key(
+              _cryptography['backend'])
+      alg._backend_keys['cryptography.private'] = key
+    return key
+
+  def SignDigest(self, alg, digest):
+    """See PythonBackend.SignDigest."""
+    c = _cryptography
+    signature = self._PrivateKey(alg).sign(
+        digest, c['padding'].PKCS1v15(), c['Prehashed'](c['hashes'].SHA256()))
+    return _BytesToLong(signature)
+
+  def VerifyDigest(self, alg, digest, signature):
+    """See PythonBackend.VerifyDigest."""
+    c = _cryptography
+    keypair = alg.keypair
+    if signature >= keypair.n:
+      return False
+    signature_bytes = _LongToBytes(signature, alg._modulus_bytes)
+    try:
+      self._PublicKey(alg).verify(signature_bytes, digest,
+                                  c['padding'].PKCS1v15(),
+                                  c['Prehashed'](c['hashes'].SHA256()))
+    except c['InvalidSignature']:
+      return False
+    return True
+
+
+# Optional math libraries:
+try:
+  import gmpy2
+  _gmpy_powmod = gmpy2.powmod
+except ImportError:
+  try:
+    import gmpy
+    def _gmpy_powmod(base, exponent, modulus):
+      return pow(gmpy.mpz(base), gmpy.mpz(exponent), gmpy.mpz(modulus))
+  except ImportError:
+    _gmpy_powmod = None
+
+try:
+  from cryptography import exceptions as _cryptography_exceptions
+  from cryptography.hazmat import backends as _cryptography_backends
+  from cryptography.hazmat.primitives import hashes as _cryptography_hashes
+  from cryptography.hazmat.primitives.asymmetric import (
+      padding as _cryptography_padding,
+      rsa as _cryptography_rsa,
+      utils as _cryptography_utils)
+  _cryptography = dict(
+      backend=_cryptography_backends.default_backend(),
+      hashes=_cryptography_hashes,
+      padding=_cryptography_padding,
+      rsa=_cryptography_rsa,
+      Prehashed=_cryptography_utils.Prehashed,
+      InvalidSignature=_cryptography_exceptions.InvalidSignature)
+except ImportError:
+  _cryptography = None
+
+_BACKEND_PREFERENCE = [CryptographyBackend, GmpyBackend, PythonBackend]
+
+
+def GetAvailableBackends():
+  """Returns the names of usable backends, most preferred first."""
+  return [cls.name for cls in _BACKEND_PREFERENCE if cls.IsAvailable()]
+
+
+def SetBackend(name):
+  """Selects the backend used by keys created without an explicit one.
+
+  Args:
+    name: One of the names returned by GetAvailableBackends().
+  Raises:
+    ValueError: The backend is unknown or not installed.
+  """
+  global _backend
+  for cls in _BACKEND_PREFERENCE:
+    if cls.name == name:
+      if not cls.IsAvailable():
+        raise ValueError('Backend %s is not available' % name)
+      _backend = cls()
+      return
+  raise ValueError('Unknown backend %s' % name)
+
+
+def GetBackend():
+  """Returns the default backend instance."""
+  return _backend
+
+
+_backend = None
+if os.environ.get('MAGICSIG_BACKEND'):
+  SetBackend(os.environ['MAGICSIG_BACKEND'])
+else:
+  SetBackend(GetAvailableBackends()[0])
+
+
+# Signatures this many bytes shorter than the modulus still get checked.
+_SIGNATURE_LENGTH_SLACK = 4
+
+
 # Implementation of the Magic Envelope signature algorithm
 class SignatureAlgRsaSha256(object):
   """Signature algorithm for RSA-SHA256 Magic Envelope."""
 
-  def __init__(self, rsa_key):
+  def __init__(self, rsa_key, backend=None):
     """Initializes algorithm with key information.
 
     Args:
       rsa_key: Key in either string form or a tuple in the
                format expected by Crypto.PublicKey.RSA.
+      backend: Bignum backend instance to use; defaults to the module
+               wide backend (see SetBackend).
     Raises:
       ValueError: The input format was incorrect.
     """
@@ -106,6 +368,18 @@ class SignatureAlgRsaSha256(object):
       self.keypair = Crypto.PublicKey.RSA.construct(rsa_key)
     else:
       self._InitFromString(rsa_key)
+    self._InitCrt()
+    self._key_id = None
+
+    # keypair.size() counts bits in a Python loop; only do it once.
+    self._size = self.keypair.size()
+    self._modulus_bytes = (self._size + 8) / 8
+    self._backend = backend
+    self._backend_keys = {}  # Backend specific key objects
+
+  def GetBackend(self):
+    """Returns the bignum backend this key uses."""
+    return self._backend or _backend
 
   def ToString(self, full_key_pair=True):
     """Serializes key to a safe string storage format.
@@ -115,16 +389,20 @@ class SignatureAlgRsaSha256(object):
     Returns:
       The string representation of the key in the format:
 
-        RSA.mod.exp[.optional_private_exp]
+        RSA.mod.exp[.optional_private_exp[.optional_p.optional_q]]
 
       Each component is a urlsafe-base64 encoded representation of
-      the corresponding RSA key field.
+      the corresponding RSA key field.  The primes are only written
+      out if the key was constructed with them.
     """
     mod = _NumToB64(self.keypair.n)
     exp = '.' + _NumToB64(self.keypair.e)
     private_exp = ''
-    if full_key_pair and self.keypair.d:
+    if full_key_pair and getattr(self.keypair, 'd', None):
       private_exp = '.' + _NumToB64(self.keypair.d)
+      if self._crt:
+        private_exp += ('.' + _NumToB64(self.keypair.p) +
+                        '.' + _NumToB64(self.keypair.q))
     return 'RSA.' + mod + exp + private_exp
 
   def _InitFromString(self, text):
@@ -149,15 +427,47 @@ class SignatureAlgRsaSha256(object):
       private_exp = _B64ToNum(private_exp)
     else:
       private_exp = None
-    self.keypair = Crypto.PublicKey.RSA.construct(
-        (_B64ToNum(match.group('mod')),
-         _B64ToNum(match.group('exp')),
-         private_exp))
+    key_tuple = (_B64ToNum(match.group('mod')),
+                 _B64ToNum(match.group('exp')),
+                 private_exp)
+    if match.group('p'):
+      # Extended format; construct() derives u from the primes.
+      key_tuple += (_B64ToNum(match.group('p')),
+                    _B64ToNum(match.group('q')))
+    self.keypair = Crypto.PublicKey.RSA.construct(key_tuple)
+
+  def _InitCrt(self):
+    """Precomputes Chinese Remainder Theorem parameters if possible.
+
+    Only keys carrying their prime factors can be signed with CRT;
+    for anything else self._crt is None and signing falls back to a
+    full-width modular exponentiation.
+    """
+    self._crt = None
+    keypair = self.keypair
+    if not (getattr(keypair, 'd', None) and getattr(keypair, 'p', None) and
+            getattr(keypair, 'q', None)):
+      return
+    p, q = keypair.p, keypair.q
+    if p * q != keypair.n:
+      raise ValueError('Key primes do not match modulus')
+    self._crt = (p, q, keypair.d % (p - 1), keypair.d % (q - 1), keypair.u)
 
   def GetName(self):
     """Returns string identifier for algorithm used."""
     return 'RSA-SHA256'
 
+  def GetKeyId(self):
+    """Returns the key_id fingerprint of this key.
+
+    This is the base64url encoded SHA-256 hash of the public key's
+    magicsig representation, as suggested by the spec.
+    """
+    if self._key_id is None:
+      self._key_id = base64.urlsafe_b64encode(
+          hashlib.sha256(self.ToString(full_key_pair=False)).digest())
+    return self._key_id
+
   def _MakeEmsaMessageSha256(self, msg, modulus_size, logf=None):
     """Algorithm EMSA_PKCS1-v1_5 from PKCS 1 version 2.
 
@@ -171,12 +481,25 @@ class SignatureAlgRsaSha256(object):
     Returns:
       The byte sequence of the message to be signed.
     """
-    magic_sha256_header = [0x30, 0x31, 0x30, 0xd, 0x6, 0x9, 0x60, 0x86, 0x48,
-                           0x1, 0x65, 0x3, 0x4, 0x2, 0x1, 0x5, 0x0, 0x4, 0x20]
-
     hash_of_msg = hashlib.sha256(msg).digest() #???
 
-    self._Log(logf, 'sha256 digest of msg %s: [%s]' % (msg, hash_of_msg.encode('hex')))
+    if logf:
+      self._Log(logf, 'sha256 digest of msg %s: [%s]' % (
+          msg, hash_of_msg.encode('hex')))
+
+    return self._MakeEmsaMessageFromDigest(hash_of_msg, modulus_size)
+
+  def _MakeEmsaMessageFromDigest(self, hash_of_msg, modulus_size):
+    """EMSA_PKCS1-v1_5 encoding of an already computed SHA-256 digest.
+
+    Args:
+      hash_of_msg: The SHA-256 digest of the message to sign.
+      modulus_size: The size of the key (in bits) used.
+    Returns:
+      The byte sequence of the message to be signed.
+    """
+    magic_sha256_header = [0x30, 0x31, 0x30, 0xd, 0x6, 0x9, 0x60, 0x86, 0x48,
+                           0x1, 0x65, 0x3, 0x4, 0x2, 0x1, 0x5, 0x0, 0x4, 0x20]
 
     encoded = ''.join([chr(c) for c in magic_sha256_header]) + hash_of_msg
 
@@ -205,19 +528,25 @@ class SignatureAlgRsaSha256(object):
 
     self._Log(logf, 'keypair size : %s' % self.keypair.size())
 
-    # Generate the PKCS1-v1_5 compatible message, which includes
-    # magic ASN.1 bytes and padding:
-    emsa_msg = self._MakeEmsaMessageSha256(bytes_to_sign, self.keypair.size(), logf)
-    # TODO(jpanzer): Check whether we need to use max keysize above
-    # or just keypair.size
+    if logf:
+      # The backend builds the PKCS1-v1_5 compatible message, which
+      # includes magic ASN.1 bytes and padding; rebuild it for the log.
+      emsa_msg = self._MakeEmsaMessageSha256(bytes_to_sign,
+                                             self.keypair.size(), logf)
+      # TODO(jpanzer): Check whether we need to use max keysize above
+      # or just keypair.size
+
+      self._Log(logf, 'emsa_msg = [%s]' % emsa_msg.encode('hex'))
 
-    self._Log(logf, 'emsa_msg = [%s]' % emsa_msg.encode('hex'))
+    return self._SignDigest(hashlib.sha256(bytes_to_sign).digest(), logf)
 
+  def _SignDigest(self, digest, logf=None):
+    """Signs a SHA-256 digest; returns the base64url signature."""
     # Compute the signature:
-    signature_long = self.keypair.sign(emsa_msg, None)[0]
+    signature_long = self.GetBackend().SignDigest(self, digest)
 
     # Encode the signature as armored text:
-    signature_bytes = number.long_to_bytes(signature_long)
+    signature_bytes = _LongToBytes(signature_long, self._modulus_bytes)
 
     self._Log(logf, 'signature_bytes = [%s]' % signature_bytes.encode('hex'))
 
@@ -232,14 +561,93 @@ class SignatureAlgRsaSha256(object):
     Returns:
       True if the request validated, False otherwise.
     """
-    # Generate the PKCS1-v1_5 compatible message, which includes
-    # magic ASN.1 bytes and padding:
-    emsa_msg = self._MakeEmsaMessageSha256(signed_bytes,
-                                           self.keypair.size())
+    # Reject malformed signatures before hashing a possibly large buffer.
+    if not self.IsPlausibleSignature(signature_b64):
+      return False
+    return self._VerifyDigest(hashlib.sha256(signed_bytes).digest(),
+                              signature_b64)
+
+  def IsPlausibleSignature(self, signature_b64):
+    """Cheaply checks that a signature's length fits this key.
 
+    A valid signature is never longer than the modulus.  Some signers
+    drop leading zero bytes, so up to _SIGNATURE_LENGTH_SLACK bytes
+    short is still accepted.
+
+    Args:
+      signature_b64: string The putative signature, base64-encoded.
+    Returns:
+      False if the signature can not possibly verify, True otherwise.
+    """
+    length = len(signature_b64.rstrip('=')) * 3 / 4
+    return (self._modulus_bytes - _SIGNATURE_LENGTH_SLACK <= length <=
+            self._modulus_bytes)
+
+  def _VerifyDigest(self, digest, signature_b64):
+    """Checks a base64url signature against a SHA-256 digest."""
     # Get putative signature:
     putative_signature = base64.urlsafe_b64decode(signature_b64.encode('utf-8'))
-    putative_signature = number.bytes_to_long(putative_signature)
+    putative_signature = _BytesToLong(putative_signature)
 
     # Verify signature given public key:
-    return self.keypair.verify(emsa_msg, (putative_signature,))
+    return self.GetBackend().VerifyDigest(self, digest, putative_signature)
+
+  def NewSigner(self):
+    """Returns a SigningStream that signs data fed to it incrementally."""
+    return SigningStream(self)
+
+  def NewVerifier(self, signature_b64):
+    """Returns a VerifyingStream checking signature_b64 incrementally."""
+    return VerifyingStream(self, signature_b64)
+
+
+# Read size used when hashing file-like objects.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _HashingStream(object):
+  """Accumulates the SHA-256 hash of signed bytes as they arrive.
+
+  Mirrors the hashlib update() interface, so large payloads never need
+  to be held in memory as one string.
+  """
+
+  def __init__(self, alg):
+    self._alg = alg
+    self._hash = hashlib.sha256()
+
+  def update(self, chunk):
+    """Adds a chunk of the signed bytes.
+
+    Args:
+      chunk: A string, or any buffer such as an mmap region.
+    """
+    self._hash.update(chunk)
+
+  def update_from_file(self, fileobj, chunk_size=_STREAM_CHUNK_SIZE):
+    """Adds everything read from fileobj (a file or mmap object)."""
+    read = fileobj.read
+    chunk = read(chunk_size)
+    while chunk:
+      self._hash.update(chunk)
+      chunk = read(chunk_size)
+
+
+class SigningStream(_HashingStream):
+  """Incremental equivalent of SignatureAlgRsaSha256.Sign."""
+
+  def finalize(self):
+    """Returns the signature in base64url encoded format."""
+    return self._alg._SignDigest(self._hash.digest())
+
+
+class VerifyingStream(_HashingStream):
+  """Incremental equivalent of SignatureAlgRsaSha256.Verify."""
+
+  def __init__(self, alg, signature_b64):
+    _HashingStream.__init__(self, alg)
+    self._signature_b64 = signature_b64
+
+  def finalize(self):
+    """Returns True if the signature covers the bytes seen, else False."""
+    return self._alg._VerifyDigest(self._hash.digest(), self._signature_b64)
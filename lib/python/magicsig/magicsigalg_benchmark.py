@@ -0,0 +1,75 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmarks for magicsigalg.py.
+
+Run directly:  python magicsigalg_benchmark.py
+"""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import timeit
+
+from Crypto.Util import number
+import magicsig.magicsigalg as magicsigalg
+
+
+def _Time(fn, iterations):
+  """Returns the best per-call time of fn, in microseconds."""
+  timer = timeit.Timer(fn)
+  best = min(timer.repeat(repeat=3, number=iterations))
+  return best * 1e6 / iterations
+
+
+def BenchmarkCodec(sizes=(1024, 2048, 4096), iterations=2000):
+  """Compares PyCrypto's bytes/bignum conversions with magicsigalg's.
+
+  Args:
+    sizes: Bignum sizes, in bits, to measure.
+    iterations: Calls per timing run.
+  Returns:
+    A list of dicts with per-call microseconds for each conversion.
+  """
+  results = []
+  for bits in sizes:
+    n = pow(3, bits) % pow(2, bits) | pow(2, bits - 1)
+    s = number.long_to_bytes(n)
+    width = len(s)
+    results.append(dict(
+        bits=bits,
+        bytes_to_long=_Time(lambda: number.bytes_to_long(s), iterations),
+        fast_bytes_to_long=_Time(lambda: magicsigalg._BytesToLong(s),
+                                 iterations),
+        long_to_bytes=_Time(lambda: number.long_to_bytes(n, width),
+                            iterations),
+        fast_long_to_bytes=_Time(lambda: magicsigalg._LongToBytes(n, width),
+                                 iterations)))
+  return results
+
+
+def main():
+  print '%6s %22s %22s' % ('bits', 'bytes->long us (x)', 'long->bytes us (x)')
+  for r in BenchmarkCodec():
+    print '%6d %9.2f -> %5.2f (%4.1fx) %9.2f -> %5.2f (%4.1fx)' % (
+        r['bits'],
+        r['bytes_to_long'], r['fast_bytes_to_long'],
+        r['bytes_to_long'] / r['fast_bytes_to_long'],
+        r['long_to_bytes'], r['fast_long_to_bytes'],
+        r['long_to_bytes'] / r['fast_long_to_bytes'])
+
+
+if __name__ == '__main__':
+  main()
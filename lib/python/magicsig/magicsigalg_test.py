@@ -18,13 +18,17 @@
 
 __author__ = 'jpanzer@google.com (John Panzer)'
 
+import mmap
 import re
+import StringIO
+import tempfile
 import unittest
 try:
   import google3  # GOOGLE local modification
 except ImportError:
   pass
 import magicsig.magicsigalg as magicsigalg  # GOOGLE local mod
+from Crypto.Util import number
 
 
 def _StripWS(s):
@@ -44,6 +48,11 @@ class TestMagicSigAlg(unittest.TestCase):
                    '.Lgy_yL3hsLBngkFdDw1Jy9TmSRMiH6yihYetQ8jy-jZXdsZXd8V5'
                    'ub3kuBHHk4M39i3TduIkcrjcsiWQb77D8Q==')
 
+  # Same keypair in the extended format carrying the primes p and q:
+  _test_crt_keypair = (_test_keypair +
+                       '.qD3a0hIGr18BgDmrCF9zTUwuW73GnQBxzm0FUX1o_Xs='
+                       '.6VToBh8FDiKZFPG3IKuNl6NT4xYIG-rZcGNJMaGbuFk=')
+
   def setUp(self):
     # Well known keys to use for testing:
     self.signer = magicsigalg.SignatureAlgRsaSha256(self._test_keypair)
@@ -61,6 +70,21 @@ class TestMagicSigAlg(unittest.TestCase):
     b64 = magicsigalg._NumToB64(n)
     self.assertEquals(magicsigalg._B64ToNum(b64), n)
 
+  def testBytesCodec(self):
+    # The fast codec must agree with PyCrypto's reference conversions:
+    for bits in (8, 31, 32, 33, 1024, 2048, 4096):
+      n = pow(3, bits) % pow(2, bits) + 1
+      s = number.long_to_bytes(n)
+      self.assertEquals(s, magicsigalg._LongToBytes(n))
+      self.assertEquals(n, magicsigalg._BytesToLong(s))
+    self.assertEquals('\x00', magicsigalg._LongToBytes(0))
+    self.assertEquals(0, magicsigalg._BytesToLong(''))
+    self.assertEquals(0, magicsigalg._BytesToLong('\x00\x00'))
+
+    # Fixed width output pads but never truncates:
+    self.assertEquals('\x00\x00\x01\x00', magicsigalg._LongToBytes(256, 4))
+    self.assertEquals('\x01\x00', magicsigalg._LongToBytes(256, 1))
+
   def testBadKey(self):
     # Bad input should raise appropriate exceptions
     self.assertRaises(ValueError,
@@ -79,6 +103,102 @@ class TestMagicSigAlg(unittest.TestCase):
     # Even tiny modifications to the text should not validate:
     self.assertFalse(self.verifier.Verify(text+'a', sig))
 
+  def testCrtSignature(self):
+    crt_signer = magicsigalg.SignatureAlgRsaSha256(self._test_crt_keypair)
+    text = 'Signed with the Chinese Remainder Theorem'
+    sig = crt_signer.Sign(text)
+
+    # PKCS1-v1_5 is deterministic, so CRT must match the plain signature:
+    self.assertEquals(self.signer.Sign(text), sig)
+    self.assertTrue(self.verifier.Verify(text, sig))
+    self.assertFalse(self.verifier.Verify(text+'a', sig))
+
+  def testCrtBadPrimes(self):
+    bad_keypair = (self._test_keypair +
+                   '.qD3a0hIGr18BgDmrCF9zTUwuW73GnQBxzm0FUX1o_Xs='
+                   '.qD3a0hIGr18BgDmrCF9zTUwuW73GnQBxzm0FUX1o_Xs=')
+    self.assertRaises(ValueError,
+                      magicsigalg.SignatureAlgRsaSha256, bad_keypair)
+
+  def testCrtSerialization(self):
+    crt_signer = magicsigalg.SignatureAlgRsaSha256(self._test_crt_keypair)
+    self.assertEquals(_StripWS(crt_signer.ToString()),
+                      _StripWS(self._test_crt_keypair))
+    self.assertEquals(_StripWS(crt_signer.ToString(full_key_pair=False)),
+                      _StripWS(self._test_publickey))
+
+  def testStreamingSignature(self):
+    text = 'A large payload. ' * 1000
+    signer = self.signer.NewSigner()
+    for i in range(0, len(text), 100):
+      signer.update(text[i:i+100])
+    sig = signer.finalize()
+    self.assertEquals(self.signer.Sign(text), sig)
+
+    verifier = self.verifier.NewVerifier(sig)
+    verifier.update_from_file(StringIO.StringIO(text), chunk_size=333)
+    self.assertTrue(verifier.finalize())
+
+    verifier = self.verifier.NewVerifier(sig)
+    verifier.update(text + 'a')
+    self.assertFalse(verifier.finalize())
+
+  def testStreamingFromMmap(self):
+    text = 'Memory mapped salmon. ' * 500
+    sig = self.signer.Sign(text)
+    f = tempfile.TemporaryFile()
+    try:
+      f.write(text)
+      f.flush()
+      region = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      verifier = self.verifier.NewVerifier(sig)
+      verifier.update(region)
+      self.assertTrue(verifier.finalize())
+      region.close()
+    finally:
+      f.close()
+
+  def testBackendParity(self):
+    text = 'Every backend signs alike'
+    reference = magicsigalg.SignatureAlgRsaSha256(
+        self._test_keypair, backend=magicsigalg.PythonBackend())
+    expected = reference.Sign(text)
+    for name in magicsigalg.GetAvailableBackends():
+      magicsigalg.SetBackend(name)
+      try:
+        for keypair in (self._test_keypair, self._test_crt_keypair):
+          signer = magicsigalg.SignatureAlgRsaSha256(keypair)
+          self.assertEquals(name, signer.GetBackend().name)
+          self.assertEquals(expected, signer.Sign(text))
+        verifier = magicsigalg.SignatureAlgRsaSha256(self._test_publickey)
+        self.assertTrue(verifier.Verify(text, expected))
+        self.assertFalse(verifier.Verify(text + 'a', expected))
+      finally:
+        magicsigalg.SetBackend(magicsigalg.GetAvailableBackends()[0])
+
+  def testSetBackend(self):
+    self.assertTrue('python' in magicsigalg.GetAvailableBackends())
+    self.assertRaises(ValueError, magicsigalg.SetBackend, 'abacus')
+
+  def testVerifyOversizedSignature(self):
+    # A "signature" larger than the modulus can never verify:
+    sig = magicsigalg._NumToB64(pow(2, 600))
+    self.assertFalse(self.verifier.Verify('text', sig))
+
+  def testIsPlausibleSignature(self):
+    sig = self.signer.Sign('text')
+    self.assertTrue(self.verifier.IsPlausibleSignature(sig))
+    self.assertFalse(self.verifier.IsPlausibleSignature(''))
+    self.assertFalse(self.verifier.IsPlausibleSignature(sig[:20]))
+    self.assertFalse(self.verifier.IsPlausibleSignature(sig + sig))
+    # Implausible signatures are turned away without any RSA work:
+    self.assertFalse(self.verifier.Verify('text', sig[:20]))
+
+  def testKeyId(self):
+    # The key_id only depends on the public part of the key:
+    self.assertEquals(self.signer.GetKeyId(), self.verifier.GetKeyId())
+    self.assertEquals(44, len(self.signer.GetKeyId()))
+
   def testSerialization(self):
     # Round tripping should produce equal strings, modulo whitespace.
     self.assertEquals(_StripWS(self.signer.ToString()),
@@ -24,13 +24,17 @@ layer in magicsigalg.py, hiding the low level crypto details.
 
 __author__ = 'jpanzer@google.com (John Panzer)'
 
+import base64
+import hashlib
 import re
 import sys
+import threading
 import time
-import weakref
 
 # ElementTree is standard with Python >=2.5, needs
 # environment support for 2.4 and lower.
+import xml.sax.saxutils as saxutils
+
 try:
   import xml.etree.ElementTree as et  # Python >=2.5
 except ImportError:
@@ -39,13 +43,184 @@ except ImportError:
   except ImportError:
     raise
 
+# json is standard with Python >=2.6.
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+# concurrent.futures is standard with Python >=3.2; on Python 2 it
+# comes from the optional "futures" backport.  Without it, batch
+# verification simply runs in process.
+try:
+  import concurrent.futures as futures
+except ImportError:
+  futures = None
+
+import cache
 import exceptions
 import magicsigalg
 import utils
 
+# A parsed XML tree takes several times the memory of its source text;
+# this rough, markup-dependent factor is used to charge trees against
+# the envelope cache's memory budget.
+_XML_TREE_SIZE_FACTOR = 4
+
+# Policies for envelopes carrying several signatures; see
+# MagicEnvelopeProtocol.VerifySignatures.
+ANY_OF = 'any-of'
+ALL_OF = 'all-of'
+THRESHOLD = 'threshold'
+
+# Bytes read per call when parsing envelopes from a stream.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Threads used to look up several signers' public keys at once.
+_LOOKUP_WORKERS = 8
+
+# Verification algorithms used inside worker processes.
+_worker_algs = None
+
+
+def _VerifyOrFalse(algs, public_key, data, sig, alg):
+  """algs.Verify, but False for a sig or key that won't even decode.
+
+  Batch verification reports each signature on its own; one garbled
+  signature mustn't take the others down with it.
+  """
+  try:
+    return algs.Verify(public_key, data, sig, alg)
+  except (TypeError, ValueError):
+    return False
+
+
+def _VerifyChunk(chunk):
+  """Verifies a chunk of (data, sig) pairs against a single key.
+
+  Runs inside a worker process for MagicEnvelopeProtocol.VerifyMany, so
+  it must stay a module level function.
+
+  Args:
+    chunk: Tuple (public_key, alg, [(data, sig), ...]).
+  Returns:
+    A list of booleans, one per (data, sig) pair.
+  """
+  global _worker_algs
+  if _worker_algs is None:
+    _worker_algs = magicsigalg.DefaultAlgorithms()
+  public_key, alg, pairs = chunk
+  return [_VerifyOrFalse(_worker_algs, public_key, data, sig, alg)
+          for data, sig in pairs]
+
+
+def _VerifyWithAnyKey(check):
+  """Verifies one signature against a list of candidate keys.
+
+  Runs inside a worker for MagicEnvelopeProtocol.VerifySignatures, so
+  it must stay a module level function.
+
+  Args:
+    check: Tuple (public_keys, alg, data, sig).
+  Returns:
+    The key that verifies the signature, or None if none of them do.
+  """
+  global _worker_algs
+  if _worker_algs is None:
+    _worker_algs = magicsigalg.DefaultAlgorithms()
+  public_keys, alg, data, sig = check
+  for public_key in public_keys:
+    if _VerifyOrFalse(_worker_algs, public_key, data, sig, alg):
+      return public_key
+  return None
+
+
+class _EnvelopeStreamTarget(object):
+  """XMLParser target that collects magic envelope fields from a stream.
+
+  No element tree is built.  Character data of me:data and me:sig is
+  squeezed chunk by chunk as the parser hands it over, so the only
+  sizeable thing kept is one whitespace-free copy of the payload.  The
+  first me:env or me:provenance element found is used; anything after
+  it is ignored.
+  """
+
+  _FIELDS = frozenset(utils.Namespaces.ME_NS + name
+                      for name in ('data', 'encoding', 'alg', 'sig'))
+
+  def __init__(self):
+    self.data_type = None
+    self.chunks = {}  # tag -> list of chunks, for data, encoding and alg
+    self.sigs = []  # (list of chunks, key_id, signer) per me:sig
+    self.found = False
+    self._in_env = False
+    self._field = None
+
+  def start(self, tag, attrib):
+    ns = utils.Namespaces.ME_NS
+    if not self._in_env:
+      if not self.found and tag in (ns+'env', ns+'provenance'):
+        self._in_env = self.found = True
+      return
+    if tag not in self._FIELDS:
+      return
+    self._field = []
+    if tag == ns+'sig':
+      self.sigs.append((self._field,
+                        attrib.get(ns+'key_id', attrib.get('keyhash', '')),
+                        attrib.get(ns+'signer', '')))
+    else:
+      self.chunks[tag] = self._field
+      if tag == ns+'data':
+        self.data_type = attrib.get('type')
+
+  def data(self, chunk):
+    if self._field is not None:
+      self._field.append(utils.Squeeze(chunk))
+
+  def end(self, tag):
+    ns = utils.Namespaces.ME_NS
+    if tag in (ns+'env', ns+'provenance'):
+      self._in_env = False
+    self._field = None
+
+  def close(self):
+    return self
+
+  def GetField(self, name):
+    """Returns the squeezed text of the me:<name> element, or None."""
+    chunks = self.chunks.get(utils.Namespaces.ME_NS + name)
+    if chunks is None:
+      return None
+    return ''.join(chunks)
+
+
+def _JsonStr(value):
+  """Returns a JSON string value as a byte string ('' for None)."""
+  if value is None:
+    return ''
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  if not isinstance(value, str):
+    raise TypeError('expected a string, not %r' % (value,))
+  return value
+
+
+def _AsCompleted(pending):
+  """Yields futures as they finish, or in order without concurrent.futures."""
+  if futures:
+    return futures.as_completed(pending)
+  return pending
+
 
 class KeyRetriever(object):
-  """Retrieves public or private keys for a signer identifier (URI)."""
+  """Retrieves public or private keys for a signer identifier (URI).
+
+  LookupPublicKey may return either a single key string or, for
+  signers with several keys, a list of key strings.  Verification picks
+  the key named by the envelope's keyhash when there is one, and
+  otherwise tries each key in turn.
+  """
 
   def LookupPublicKey(self, signer_uri):
     # TODO(jpanzer): Really look this up with Webfinger.
@@ -77,20 +252,50 @@ class MagicEnvelopeProtocol(object):
                algs=magicsigalg.DefaultAlgorithms(),
                author_extractor=utils.DefaultAuthorExtractor(),
                auto_verify=True,
-               reverify_period=(24 * 3600)):
+               reverify_period=(24 * 3600),
+               verify_workers=None,
+               verify_chunk_size=64,
+               envelope_cache_size=1000,
+               envelope_cache_bytes=(64 * 1024 * 1024),
+               envelope_cache_ttl=None):
     self.key_retriever = key_retriever
     self.encoder = encoder
     self.algs = algs
     self.author_extractor = author_extractor
     self.auto_verify = auto_verify
     self.reverify_period = reverify_period
-
-    # Internal caches
-    self._last_verified = weakref.WeakKeyDictionary()
-    self._decoded_cache = weakref.WeakKeyDictionary()
-    self._xml_tree_cache = weakref.WeakKeyDictionary()
-    self._atom_cache = weakref.WeakKeyDictionary()
-    self._json_cache = weakref.WeakKeyDictionary()
+    self.verify_workers = verify_workers
+    self.verify_chunk_size = verify_chunk_size
+
+    # Verification times and decoded payloads, keyed by (kind, envelope
+    # digest) so that equal envelopes share entries.  Verification
+    # times are useless once older than reverify_period, so that is
+    # the default time to live.
+    if envelope_cache_ttl is None:
+      envelope_cache_ttl = reverify_period
+    self._envelope_cache = cache.LruCache(max_size=envelope_cache_size,
+                                          ttl=envelope_cache_ttl,
+                                          max_bytes=envelope_cache_bytes)
+
+    # Set by reverify.ReverifyScheduler to keep verified envelopes fresh
+    # off the request path.
+    self.reverify_scheduler = None
+
+    # Worker pools, created on first use and kept until Close; starting
+    # worker processes costs far more than the checks they run.
+    self._pools = {}
+    self._pools_lock = threading.Lock()
+
+  def Close(self):
+    """Shuts down any worker pools the protocol has started."""
+    self._pools_lock.acquire()
+    try:
+      pools = self._pools.values()
+      self._pools = {}
+    finally:
+      self._pools_lock.release()
+    for pool in pools:
+      pool.shutdown(wait=False)
 
   def WrapAndSign(self,
                   data,
@@ -113,14 +318,12 @@ class MagicEnvelopeProtocol(object):
           after it is constructed.
       KeyNotFoundError: If the author's public key could not be found.
     """
-    author_uris = self.author_extractor.ExtractAuthors(data, data_type)
-    if not author_uris:
-      raise exceptions.AuthorNotFoundError(
-          'Author not extracted from data: ', data)
-
     # Just uses the first author.
     # TODO: Support multiple signers?
-    author_uri = author_uris[0]
+    author_uri = self._ExtractFirstAuthor(data, data_type)
+    if not author_uri:
+      raise exceptions.AuthorNotFoundError(
+          'Author not extracted from data: ', data)
 
     private_key = self.key_retriever.LookupPrivateKey(author_uri)
     if not private_key:
@@ -159,31 +362,385 @@ class MagicEnvelopeProtocol(object):
     """
     decoded_data = self.encoder.Decode(envelope.data, envelope.encoding)
 
+    # Just uses the first author.
+    # TODO: Support multiple signers?
+    author_uri = self._ExtractFirstAuthor(decoded_data, envelope.data_type)
+    if not author_uri:
+      raise exceptions.AuthorNotFoundError(
+          'Author not extracted from data: ', decoded_data)
+
+    public_keys = self.key_retriever.LookupPublicKey(author_uri)
+    if not public_keys:
+      raise exceptions.KeyNotFoundError(
+          'Public Key could not be found for author: ', author_uri)
+
+    result = False
+    for public_key in self._CandidateKeys(public_keys, envelope.keyhash):
+      result = self.algs.Verify(public_key,
+                                envelope.GetSignedBytes(),
+                                envelope.sig,
+                                envelope.alg)
+      if result:
+        break
+
+    if result:
+      self._SetLastVerified(envelope, time.time())
+
+    return result
+
+  def VerifyMany(self, envelopes, executor=None, unresolved=None):
+    """Verifies a batch of magic envelopes.
+
+    Envelopes are grouped by author so each author's public key is
+    looked up once, and the RSA checks are spread over a process pool
+    when one is available.
+
+    Args:
+      envelopes: A sequence of envelopes to verify.
+      executor: Optional concurrent.futures style executor to run the
+          checks on.  If not given and verify_workers is set, the
+          protocol's process pool of that size is used.
+      unresolved: Optional list to which the indexes of envelopes whose
+          author's public key lookup raised or found nothing are
+          appended, to tell them apart from bad signatures.
+    Returns:
+      A list of booleans in the same order as envelopes.  Envelopes
+      that can't be decoded, or whose author or public key can not be
+      found, are reported as False rather than raising.
+    """
+    results = [False] * len(envelopes)
+
+    # Group envelope indexes by (author, alg):
+    groups = {}
+    for i, envelope in enumerate(envelopes):
+      # Bad encoding or unreadable markup fails that envelope alone.
+      try:
+        decoded_data = self.encoder.Decode(envelope.data, envelope.encoding)
+        author_uri = self._ExtractFirstAuthor(decoded_data,
+                                              envelope.data_type)
+      except Exception:
+        continue
+      if not author_uri:
+        continue
+      groups.setdefault((author_uri, envelope.alg), []).append(i)
+
+    # Resolve each author's keys once, pick a key per envelope and cut
+    # the work into chunks:
+    chunks = []
+    chunk_indexes = []
+    size = self.verify_chunk_size
+    other_keys = {}  # index -> keys still worth trying if the first fails
+    for (author_uri, alg), indexes in groups.iteritems():
+      try:
+        public_keys = self.key_retriever.LookupPublicKey(author_uri)
+      except Exception:
+        public_keys = None
+      if not public_keys:
+        if unresolved is not None:
+          unresolved.extend(indexes)
+        continue
+      by_key = {}
+      for i in indexes:
+        candidates = self._CandidateKeys(public_keys, envelopes[i].keyhash)
+        by_key.setdefault(candidates[0], []).append(i)
+        if len(candidates) > 1:
+          other_keys[i] = candidates[1:]
+      for public_key, key_indexes in by_key.iteritems():
+        for start in range(0, len(key_indexes), size):
+          part = key_indexes[start:start + size]
+          chunks.append((public_key, alg,
+                         [(envelopes[i].GetSignedBytes(), envelopes[i].sig)
+                          for i in part]))
+          chunk_indexes.append(part)
+
+    for part, chunk_results in zip(chunk_indexes,
+                                   self._VerifyChunks(chunks, executor)):
+      for i, result in zip(part, chunk_results):
+        results[i] = result
+
+    # Envelopes without a usable keyhash fall back to trying the rest of
+    # their author's keys:
+    for i, public_keys in other_keys.iteritems():
+      envelope = envelopes[i]
+      for public_key in public_keys:
+        if results[i]:
+          break
+        results[i] = _VerifyOrFalse(self.algs, public_key,
+                                    envelope.GetSignedBytes(),
+                                    envelope.sig, envelope.alg)
+
+    now = time.time()
+    for envelope, result in zip(envelopes, results):
+      if result:
+        self._SetLastVerified(envelope, now)
+
+    return results
+
+  def AddSignature(self, envelope, signer_uri):
+    """Countersigns an envelope, e.g. as a relay passing it on.
+
+    Args:
+      envelope: The envelope to countersign.
+      signer_uri: URI of the additional signer.
+    Returns:
+      A new Envelope carrying envelope's signatures plus one by
+      signer_uri, labelled with signer_uri and that key's key_id so
+      verifiers know whose keys to check it against.
+
+    Raises:
+      KeyNotFoundError: If the signer's private key could not be found.
+    """
+    private_key = self.key_retriever.LookupPrivateKey(signer_uri)
+    if not private_key:
+      raise exceptions.KeyNotFoundError(
+          'Private Key could not be found for signer: ', signer_uri)
+
+    sig = Signature(self.algs.Sign(private_key, envelope.data, envelope.alg),
+                    self.algs.GetKeyId(private_key),
+                    signer_uri)
+
+    return Envelope(data=envelope.data,
+                    data_type=envelope.data_type,
+                    sig=envelope.sig,
+                    keyhash=envelope.keyhash,
+                    encoding=envelope.encoding,
+                    alg=envelope.alg,
+                    extra_sigs=tuple(envelope.extra_sigs) + (sig,),
+                    sig_base=envelope.sig_base)
+
+  def VerifySignatures(self, envelope, policy=ALL_OF, threshold=None,
+                       executor=None):
+    """Verifies an envelope that may carry several signatures.
+
+    A signature that names its signer (as countersignatures added by
+    AddSignature do) is checked against that signer's keys; any other
+    is checked against the keys of the authors extracted from the data.
+    All these public keys are looked up concurrently, each signature is
+    matched to a key by its key_id where possible, and the RSA checks
+    run in parallel.  Only distinct keys count towards the policy, so
+    one signature repeated does not make several signers.  Checking
+    stops as soon as the outcome is decided, so ANY_OF returns on the
+    first good signature.
+
+    Args:
+      envelope: The envelope to verify.
+      policy: ANY_OF, ALL_OF or THRESHOLD.
+      threshold: Number of signatures that must verify under THRESHOLD.
+      executor: Optional concurrent.futures style executor for key
+          lookups and RSA checks.  If not given, lookups use the
+          protocol's thread pool and, if verify_workers is set, checks
+          use its process pool.
+    Returns:
+      True iff enough signatures verify to satisfy the policy.
+
+    Raises:
+      AuthorNotFoundError: If no author could be extracted from the data.
+      KeyNotFoundError: If none of the signers' public keys were found.
+      ValueError: If policy or threshold is invalid.
+    """
+    sigs = envelope.GetSignatures()
+    if policy == ANY_OF:
+      required = 1
+    elif policy == ALL_OF:
+      required = len(sigs)
+    elif policy == THRESHOLD:
+      if not threshold or threshold < 1:
+        raise ValueError('THRESHOLD needs a positive threshold, not %r' %
+                         threshold)
+      required = threshold
+    else:
+      raise ValueError('Unknown signature policy %r' % policy)
+    if required > len(sigs):
+      return False
+
+    decoded_data = self.encoder.Decode(envelope.data, envelope.encoding)
     author_uris = self.author_extractor.ExtractAuthors(
         decoded_data, envelope.data_type)
     if not author_uris:
       raise exceptions.AuthorNotFoundError(
           'Author not extracted from data: ', decoded_data)
 
-    # Just uses the first author.
-    # TODO: Support multiple signers?
-    author_uri = author_uris[0]
-
-    public_key = self.key_retriever.LookupPublicKey(author_uri)
-    if not public_key:
+    signer_uris = list(author_uris)
+    for sig in sigs:
+      if sig.signer_uri and sig.signer_uri not in signer_uris:
+        signer_uris.append(sig.signer_uri)
+    keys_by_signer = dict(zip(signer_uris,
+                              self._LookupPublicKeys(signer_uris, executor)))
+    if not _MergeKeys(keys_by_signer.values()):
       raise exceptions.KeyNotFoundError(
-          'Public Key could not be found for author: ', author_uri)
-
-    result = self.algs.Verify(public_key,
-                              envelope.data,
-                              envelope.sig,
-                              envelope.alg)
+          'Public Key could not be found for signers: ', signer_uris)
+    author_keys = _MergeKeys([keys_by_signer[uri] for uri in author_uris])
+
+    checks = []
+    # Only the primary signature can cover a Signature Base String;
+    # countersignatures cover data.
+    signed_bytes = envelope.GetSignedBytes()
+    for sig in sigs:
+      if sig.signer_uri:
+        public_keys = _MergeKeys([keys_by_signer[sig.signer_uri]])
+      else:
+        public_keys = author_keys
+      if public_keys:
+        public_keys = self._CandidateKeys(public_keys, sig.key_id)
+      checks.append((public_keys, envelope.alg, signed_bytes, sig.value))
+      signed_bytes = envelope.data
+    result = self._CountVerified(checks, required, executor) >= required
 
     if result:
-      self._last_verified[envelope] = time.time()
+      self._SetLastVerified(envelope, time.time())
 
     return result
 
+  def _ExtractFirstAuthor(self, data, data_type):
+    """Returns the first author URI of data, or None if there isn't one.
+
+    Extractors derived from utils.AuthorExtractor answer this through
+    ExtractFirstAuthor; others only need ExtractAuthors.
+    """
+    extract_first = getattr(self.author_extractor, 'ExtractFirstAuthor', None)
+    if extract_first is not None:
+      return extract_first(data, data_type)
+    author_uris = self.author_extractor.ExtractAuthors(data, data_type)
+    if author_uris:
+      return author_uris[0]
+    return None
+
+  def _LookupPublicKeys(self, signer_uris, executor):
+    """Looks up public keys for several signers, concurrently if possible.
+
+    Returns:
+      A list with LookupPublicKey's result for each of signer_uris.
+    """
+    if len(signer_uris) == 1:
+      return [self.key_retriever.LookupPublicKey(signer_uris[0])]
+
+    pool = executor
+    if pool is None and futures:
+      pool = self._GetPool('thread', futures.ThreadPoolExecutor,
+                           _LOOKUP_WORKERS)
+    if pool is None:
+      return [self.key_retriever.LookupPublicKey(uri) for uri in signer_uris]
+    pending = [pool.submit(self.key_retriever.LookupPublicKey, uri)
+               for uri in signer_uris]
+    return [future.result() for future in pending]
+
+  def _CountVerified(self, checks, required, executor):
+    """Runs signature checks until enough pass, or too many fail.
+
+    A check passes only if it is verified by a key no earlier check
+    was; a signature repeated under the same key counts once.
+
+    Args:
+      checks: List of (public_keys, alg, data, sig) tuples.
+      required: Number of checks that need to pass.
+      executor: Optional executor to run the checks on.
+    Returns:
+      The number of distinct keys seen to verify a check; at least
+      required iff the policy is satisfied.
+    """
+    allowed_failures = len(checks) - required
+    verified_ids = set()
+    failed = 0
+
+    pool = executor
+    if pool is None and len(checks) > 1:
+      pool = self._GetProcessPool()
+
+    if pool is None:
+      for public_keys, alg, data, sig in checks:
+        verified_key = None
+        for public_key in public_keys:
+          if _VerifyOrFalse(self.algs, public_key, data, sig, alg):
+            verified_key = public_key
+            break
+        if not self._CountKey(verified_key, verified_ids):
+          failed += 1
+        if len(verified_ids) >= required or failed > allowed_failures:
+          break
+      return len(verified_ids)
+
+    pending = [pool.submit(_VerifyWithAnyKey, check) for check in checks]
+    try:
+      for future in _AsCompleted(pending):
+        if not self._CountKey(future.result(), verified_ids):
+          failed += 1
+        if len(verified_ids) >= required or failed > allowed_failures:
+          break
+    finally:
+      # Checks still running are left to finish in the background.
+      for future in pending:
+        future.cancel()
+    return len(verified_ids)
+
+  def _CountKey(self, public_key, verified_ids):
+    """Adds a verifying key's id to verified_ids.
+
+    Returns:
+      True iff public_key verified a check and wasn't already counted.
+    """
+    if public_key is None:
+      return False
+    key_id = public_key
+    if hasattr(self.algs, 'GetKeyId'):
+      key_id = self.algs.GetKeyId(public_key)
+    if key_id in verified_ids:
+      return False
+    verified_ids.add(key_id)
+    return True
+
+  def _CandidateKeys(self, public_keys, key_id):
+    """Returns the keys to try, in order, for a signature.
+
+    Args:
+      public_keys: A key string or list of key strings for the signer.
+      key_id: The envelope's keyhash, or '' if it has none.
+    Returns:
+      A one element list holding the key named by key_id if it is among
+      public_keys; otherwise all of public_keys.
+    """
+    if isinstance(public_keys, basestring):
+      return [public_keys]
+    if key_id and len(public_keys) > 1 and hasattr(self.algs, 'IndexKeys'):
+      public_key = self.algs.IndexKeys(public_keys).get(key_id)
+      if public_key:
+        return [public_key]
+    return list(public_keys)
+
+  def _VerifyChunks(self, chunks, executor):
+    """Runs _VerifyChunk over chunks, in parallel where possible."""
+    if executor is None and len(chunks) > 1:
+      executor = self._GetProcessPool()
+    if executor is not None:
+      return list(executor.map(_VerifyChunk, chunks))
+
+    return [[_VerifyOrFalse(self.algs, public_key, data, sig, alg)
+             for data, sig in pairs]
+            for public_key, alg, pairs in chunks]
+
+  def _GetProcessPool(self):
+    """Returns the shared process pool for RSA checks, or None.
+
+    There is no pool without concurrent.futures, without verify_workers
+    above one, or with algorithms other than the default ones, which
+    are all that worker processes know about.
+    """
+    if not (futures and self.verify_workers and self.verify_workers > 1 and
+            isinstance(self.algs, magicsigalg.DefaultAlgorithms)):
+      return None
+    return self._GetPool('process', futures.ProcessPoolExecutor,
+                         self.verify_workers)
+
+  def _GetPool(self, kind, factory, max_workers):
+    """Returns the pool of the given kind, creating it on first use."""
+    self._pools_lock.acquire()
+    try:
+      pool = self._pools.get(kind)
+      if pool is None:
+        pool = self._pools[kind] = factory(max_workers=max_workers)
+      return pool
+    finally:
+      self._pools_lock.release()
+
   def FromString(self,
                  text,
                  mime_type=utils.Mimes.XML_ME):
@@ -204,7 +761,7 @@ class MagicEnvelopeProtocol(object):
     if mime_type == utils.Mimes.XML_ME:
       xml = et.XML(text)
 
-      return Envelope.FromXmlElement(xml.get_root())
+      return self.FromXmlElement(xml)
     elif mime_type == utils.Mimes.ATOM:
       xml = et.XML(text)
 
@@ -212,12 +769,51 @@ class MagicEnvelopeProtocol(object):
       # itself is discarded. Validity decisions are made based on the
       # contents of the me:provenance element alone. Anything outside
       # that element is unsigned and may be bogus.
-      provenance = xml.get_root().find(utils.Namespaces.ME_NS+'provenance')
+      provenance = xml.find(utils.Namespaces.ME_NS+'provenance')
 
-      return Envelope.FromXmlElement(provenance)
+      return self.FromXmlElement(provenance)
     else:
-      # TODO: Implement JSON
-      raise NotImplementedError('JSON parsing not implemented')
+      try:
+        obj = json.loads(text)
+      except ValueError, e:
+        raise exceptions.EnvelopeFormatError('Invalid JSON envelope: %s' % e)
+
+      return self.FromJsonObject(obj)
+
+  def FromJsonObject(self, obj):
+    """Builds an envelope from a decoded application/magic-env+json object.
+
+    Args:
+      obj: dict following schema/magicsig.json.
+
+    Returns:
+      A verified instance of Envelope.
+
+    Raises:
+      EnvelopeFormatError: If obj is not a valid JSON envelope.
+      EnvelopeProtocolError: If verification of the envelope fails.
+    """
+    try:
+      sigs = [Signature(_JsonStr(sig['value']), _JsonStr(sig.get('key_id')),
+                        _JsonStr(sig.get('signer')))
+              for sig in obj['sigs']]
+      if not sigs:
+        raise exceptions.EnvelopeFormatError('JSON envelope has no sigs')
+
+      envelope = Envelope(data=_JsonStr(obj['data']),
+                          data_type=_JsonStr(obj['data_type']),
+                          sig=sigs[0].value,
+                          keyhash=sigs[0].key_id,
+                          encoding=_JsonStr(obj.get('encoding', 'base64url')),
+                          alg=_JsonStr(obj.get('alg', 'RSA-SHA256')),
+                          extra_sigs=sigs[1:])
+    except (KeyError, TypeError, AttributeError), e:
+      raise exceptions.EnvelopeFormatError(
+          'Malformed JSON envelope, %s: %r' % (e.__class__.__name__, e))
+
+    self._VerifyOrDie(envelope)
+
+    return envelope
 
   def FromXmlElement(self, element):
     """Parses an envelope from an elementtree.Element instance.
@@ -231,23 +827,128 @@ class MagicEnvelopeProtocol(object):
     Raises:
       EnvelopeProtocolError: If verification of the envelope fails.
     """
-    data_element = element.find('data')
-    data = Squeeze(data_element.text)
-    data_type = Squeeze(data_element.get('type'))
+    ns = utils.Namespaces.ME_NS
+
+    data_element = element.find(ns+'data')
+    data = utils.Squeeze(data_element.text)
+    data_type = utils.Squeeze(data_element.get('type'))
 
-    sig_element = element.find('sig')
-    sig = Squeeze(sig_element.text)
-    keyhash = Squeeze(sig_element.get('keyhash'))
+    sigs = []
+    for sig_element in element.findall(ns+'sig'):
+      key_id = sig_element.get(ns+'key_id', sig_element.get('keyhash', ''))
+      sigs.append(Signature(sig_element.text, key_id,
+                            sig_element.get(ns+'signer', '')))
 
-    encoding = Squeeze(element.find('encoding').text)
-    alg = Squeeze(element.find('alg').text)
+    encoding = utils.Squeeze(element.find(ns+'encoding').text)
+    alg = utils.Squeeze(element.find(ns+'alg').text)
 
     envelope = Envelope(data=data,
                         data_type=data_type,
-                        sig=sig,
-                        keyhash=keyhash,
+                        sig=sigs[0].value,
+                        keyhash=sigs[0].key_id,
                         encoding=encoding,
-                        alg=alg)
+                        alg=alg,
+                        extra_sigs=sigs[1:])
+
+    self._VerifyOrDie(envelope)
+
+    return envelope
+
+  def FromStream(self, stream, chunk_size=_STREAM_CHUNK_SIZE):
+    """Parses an XML envelope or Atom entry from a file-like object.
+
+    The body is fed to the XML parser chunk_size bytes at a time and
+    only the envelope fields are kept, so peak memory stays close to
+    one copy of the payload however large the document is.
+
+    Args:
+      stream: File-like object with a read(size) method.
+      chunk_size: Number of bytes to read per call.
+
+    Returns:
+      A verified instance of Envelope.
+
+    Raises:
+      EnvelopeFormatError: If the body isn't well formed XML or no
+          complete envelope was found.
+      EnvelopeProtocolError: If verification of the envelope fails.
+    """
+    target = _EnvelopeStreamTarget()
+    parser = et.XMLParser(target=target)
+    try:
+      while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+          break
+        parser.feed(chunk)
+      parser.close()
+    except SyntaxError, e:  # ElementTree's ParseError
+      raise exceptions.EnvelopeFormatError('Malformed XML envelope: %s' % e)
+
+    data = target.GetField('data')
+    encoding = target.GetField('encoding')
+    alg = target.GetField('alg')
+    if not target.found:
+      raise exceptions.EnvelopeFormatError('No magic envelope found')
+    if (data is None or encoding is None or alg is None or
+        not target.data_type or not target.sigs):
+      raise exceptions.EnvelopeFormatError('Incomplete magic envelope')
+
+    sigs = [Signature(''.join(chunks), key_id, signer_uri)
+            for chunks, key_id, signer_uri in target.sigs]
+
+    envelope = Envelope(data=data,
+                        data_type=target.data_type,
+                        sig=sigs[0].value,
+                        keyhash=sigs[0].key_id,
+                        encoding=encoding,
+                        alg=alg,
+                        extra_sigs=sigs[1:])
+
+    self._VerifyOrDie(envelope)
+
+    return envelope
+
+  def FromCompactString(self, text):
+    """Parses an envelope from the Compact Serialization, and verifies.
+
+    The token is key_id.sig.sbs, where sbs is the draft's Signature
+    Base String data.b64(data_type).b64(encoding).b64(alg) and sig is a
+    signature over all of it, so the metadata can't be swapped either.
+    An empty encoding or alg slot means base64url or RSA-SHA256; base64
+    padding is optional.  The envelope keeps the signed tail (see
+    Envelope.sig_base), so it re-verifies like any other, but can only
+    be serialized back to the compact form.
+
+    Args:
+      text: The token, e.g. from an HTTP header.
+
+    Returns:
+      A verified instance of Envelope.
+
+    Raises:
+      EnvelopeFormatError: If text is not a valid compact envelope.
+      EnvelopeProtocolError: If verification of the envelope fails.
+    """
+    fields = text.strip().split('.')
+    if len(fields) != 6:
+      raise exceptions.EnvelopeFormatError(
+          'Compact envelope needs 6 fields, not %d' % len(fields))
+    key_id, sig, data = fields[:3]
+    try:
+      data_type, encoding, alg = [_B64UrlDecode(field)
+                                  for field in fields[3:]]
+    except TypeError, e:
+      raise exceptions.EnvelopeFormatError(
+          'Bad base64 in compact envelope: %s' % e)
+
+    envelope = Envelope(data=data,
+                        data_type=data_type,
+                        sig=sig,
+                        keyhash=key_id,
+                        encoding=encoding or 'base64url',
+                        alg=alg or 'RSA-SHA256',
+                        sig_base='.'.join(fields[3:]))
 
     self._VerifyOrDie(envelope)
 
@@ -261,30 +962,50 @@ class MagicEnvelopeProtocol(object):
 
     Returns:
       The time at which this Protocol object last verified the
-      envelope, or 0 if it hasn't.
+      envelope (or an equal one), or 0 if it hasn't or has forgotten.
     """
-    return self._last_verified.get(envelope, 0)
+    return self._envelope_cache.Get(('verified', envelope.GetDigest()), 0)
+
+  def GetEnvelopeCacheStats(self):
+    """Returns size, memory and hit/miss statistics for the envelope cache."""
+    return self._envelope_cache.Stats()
+
+  def ForgetVerified(self, envelope):
+    """Forgets that envelope (or any equal one) was ever verified."""
+    self._envelope_cache.Delete(('verified', envelope.GetDigest()))
+    if self.reverify_scheduler is not None:
+      self.reverify_scheduler.Untrack(envelope)
+
+  def _SetLastVerified(self, envelope, when):
+    self._envelope_cache.Put(('verified', envelope.GetDigest()), when)
+    if self.reverify_scheduler is not None:
+      self.reverify_scheduler.Track(envelope, when)
 
   def GetDataAsRawString(self, envelope):
     """Simply decodes the data of the given envelope. Memoized."""
     self._VerifyOrDie(envelope)
 
-    if envelope not in self._decoded_cache:
-      self._decoded_cache[envelope] = self.encoder.Decode(
-          envelope.data, envelope.encoding)
+    key = ('decoded', envelope.GetDigest())
+    decoded = self._envelope_cache.Get(key)
+    if decoded is None:
+      decoded = self.encoder.Decode(envelope.data, envelope.encoding)
+      self._envelope_cache.Put(key, decoded, size=len(decoded))
 
-    return self._decoded_cache[envelope]
+    return decoded
 
   def GetDataAsXmlElementTree(self, envelope):
     """Decode the data of the given envelope and make an XML tree. Memoized."""
     self._VerifyOrDie(envelope)
 
-    if envelope not in self._xml_tree_cache:
+    key = ('xml', envelope.GetDigest())
+    tree = self._envelope_cache.Get(key)
+    if tree is None:
       decoded = self.GetDataAsRawString(envelope)
+      tree = et.XML(decoded)
+      self._envelope_cache.Put(key, tree,
+                               size=len(decoded) * _XML_TREE_SIZE_FACTOR)
 
-      self._xml_tree_cache[envelope] = et.XML(decoded)
-
-    return self._xml_tree_cache[envelope]
+    return tree
 
   def ToAtomString(self, envelope, fulldoc=True, indentation=0):
     """Turns envelope into serialized Atom entry.
@@ -298,6 +1019,7 @@ class MagicEnvelopeProtocol(object):
       containing the original magic signature data.
     """
     self._VerifyOrDie(envelope)
+    _CheckSignsData(envelope)
 
     if envelope.data_type != utils.Mimes.ATOM:
       raise TypeError('mime type of envelope is %s, not %s'
@@ -314,10 +1036,13 @@ class MagicEnvelopeProtocol(object):
     data_el.set('type', envelope.data_type)
     data_el.text = '\n'+utils.ToPretty(envelope.data, indentation+6, 60)
     et.SubElement(prov_el, me_ns + 'encoding').text = envelope.encoding
-    et.SubElement(prov_el, me_ns + 'sig').text = (
-        '\n' + utils.ToPretty(envelope.sig,
-                         indentation+6,
-                         60))
+    for sig in envelope.GetSignatures():
+      sig_el = et.SubElement(prov_el, me_ns + 'sig')
+      if sig.key_id:
+        sig_el.set(me_ns + 'key_id', sig.key_id)
+      if sig.signer_uri:
+        sig_el.set(me_ns + 'signer', sig.signer_uri)
+      sig_el.text = '\n' + utils.ToPretty(sig.value, indentation+6, 60)
 
     # Add in the provenance element:
     d.append(prov_el)
@@ -339,8 +1064,79 @@ class MagicEnvelopeProtocol(object):
     return indented_text
 
   def ToJsonString(self, envelope):
-    # TODO: Implement JSON
-    raise NotImplementedError('JSON not implemented')
+    """Turns envelope into serialized application/magic-env+json.
+
+    Args:
+      envelope: the envelope to serialize.
+    Returns:
+      A JSON document following schema/magicsig.json.
+    """
+    self._VerifyOrDie(envelope)
+    _CheckSignsData(envelope)
+
+    sigs = []
+    for sig in envelope.GetSignatures():
+      sig_obj = dict(value=sig.value)
+      if sig.key_id:
+        sig_obj['key_id'] = sig.key_id
+      if sig.signer_uri:
+        sig_obj['signer'] = sig.signer_uri
+      sigs.append(sig_obj)
+
+    return json.dumps(dict(data=envelope.data,
+                           data_type=envelope.data_type,
+                           encoding=envelope.encoding,
+                           alg=envelope.alg,
+                           sigs=sigs),
+                      sort_keys=True)
+
+  def ToCompactString(self, envelope):
+    """Turns envelope into the Compact Serialization (see FromCompactString).
+
+    An envelope's own sig covers only its data, so unless envelope came
+    from a compact token, the Signature Base String is signed afresh
+    with the author's private key.
+
+    Args:
+      envelope: the envelope to serialize.
+    Returns:
+      A single line token suitable for HTTP headers and queue payloads.
+
+    Raises:
+      AuthorNotFoundError: If the author's UID could not be extracted
+          from the decoded data.
+      EnvelopeFormatError: If envelope has more than one signature, which
+          the compact form can not carry.
+      KeyNotFoundError: If the author's private key could not be found.
+    """
+    self._VerifyOrDie(envelope)
+
+    if envelope.extra_sigs:
+      raise exceptions.EnvelopeFormatError(
+          'Compact envelopes carry a single signature, not %d' %
+          len(envelope.GetSignatures()))
+
+    if envelope.sig_base is not None:
+      return '.'.join((envelope.keyhash, envelope.sig,
+                       envelope.GetSignedBytes()))
+
+    decoded_data = self.encoder.Decode(envelope.data, envelope.encoding)
+    author_uri = self._ExtractFirstAuthor(decoded_data, envelope.data_type)
+    if not author_uri:
+      raise exceptions.AuthorNotFoundError(
+          'Author not extracted from data: ', decoded_data)
+
+    private_key = self.key_retriever.LookupPrivateKey(author_uri)
+    if not private_key:
+      raise exceptions.KeyNotFoundError(
+          'Private Key could not be found for author: ', author_uri)
+
+    sbs = '.'.join((envelope.data,
+                    _SignatureBase(envelope.data_type, envelope.encoding,
+                                   envelope.alg)))
+    return '.'.join((self.algs.GetKeyId(private_key),
+                     self.algs.Sign(private_key, sbs, envelope.alg),
+                     sbs))
 
   def ToXmlString(self, envelope, fulldoc=True, indentation=0):
     """Turns envelope into serialized XML suitable for transmission.
@@ -352,6 +1148,7 @@ class MagicEnvelopeProtocol(object):
       An XML document or fragment in string form.
     """
     self._VerifyOrDie(envelope)
+    _CheckSignsData(envelope)
 
     # Template for a Magic Envelope:
     if fulldoc:
@@ -365,16 +1162,26 @@ class MagicEnvelopeProtocol(object):
     %s
   </me:data>
   <me:alg>%s</me:alg>
-  <me:sig>
-    %s
-  </me:sig>
+%s
 </me:env>
     """
+    sig_template = """  <me:sig%s>
+    %s
+  </me:sig>"""
+    sig_elements = []
+    for sig in envelope.GetSignatures():
+      key_id_attr = ''
+      if sig.key_id:
+        key_id_attr = " me:key_id=%s" % saxutils.quoteattr(sig.key_id)
+      if sig.signer_uri:
+        key_id_attr += " me:signer=%s" % saxutils.quoteattr(sig.signer_uri)
+      sig_elements.append(sig_template % (key_id_attr,
+                                          utils.ToPretty(sig.value, 4, 60)))
     text = template % (envelope.encoding,
                        envelope.data_type,
                        utils.ToPretty(envelope.data, 4, 60),
                        envelope.alg,
-                       utils.ToPretty(envelope.sig, 4, 60))
+                       '\n'.join(sig_elements))
     indented_text = ''
     for line in text.strip().split('\n'):
       indented_text += ' '*indentation + line + '\n'
@@ -385,16 +1192,107 @@ class MagicEnvelopeProtocol(object):
     if not self.auto_verify:
       return
 
-    last_verified = self._last_verified.get(envelope, 0)
-    if time.time() - last_verified > self.reverify_period:
+    # Still fresh?  With a reverify_scheduler attached, envelopes that
+    # have verified once are kept fresh in the background, so only ones
+    # never seen before are verified here.
+    last_verified = self.GetDateLastVerified(envelope)
+    if time.time() - last_verified <= self.reverify_period:
       return
 
     if not self.VerifyEnvelope(envelope):
       raise exceptions.EnvelopeProtocolError('Envelope does not verify: ',
                                              envelope)
 
+class Signature(object):
+  """One signature over a Magic Envelope's data."""
+
+  def __init__(self, value, key_id='', signer_uri=''):
+    """Creates a signature.
+
+    Args:
+      value: The signature string.
+      key_id: Fingerprint of the signing key, or '' if not known.
+      signer_uri: URI of the signer, for signers other than the data's
+          authors (such as relays), or ''.
+    """
+    self.value = utils.Squeeze(value)
+    self.key_id = utils.Squeeze(key_id or '')
+    self.signer_uri = utils.Squeeze(signer_uri or '')
+
+  def __repr__(self):
+    return 'Signature(%r, %r, %r)' % (self.value, self.key_id,
+                                      self.signer_uri)
+
+  def __eq__(self, other):
+    return (self.value == other.value and self.key_id == other.key_id and
+            self.signer_uri == other.signer_uri)
+
+  def __ne__(self, other):
+    return not self == other
+
+
+def _MergeKeys(key_lists):
+  """Flattens LookupPublicKey results into one list without duplicates."""
+  merged = []
+  for keys in key_lists:
+    if isinstance(keys, basestring):
+      keys = [keys]
+    for key in keys or []:
+      if key not in merged:
+        merged.append(key)
+  return merged
+
+
+def _SignatureBase(data_type, encoding, alg):
+  """Returns b64(data_type).b64(encoding).b64(alg), the part of a
+  Signature Base String that follows the armored data."""
+  return '.'.join([base64.urlsafe_b64encode(field)
+                   for field in (data_type, encoding, alg)])
+
+
+def _B64UrlDecode(text):
+  """urlsafe_b64decode that also takes text stripped of its padding."""
+  return base64.urlsafe_b64decode(str(text) + '=' * (-len(text) % 4))
+
+
+def _CheckSignsData(envelope):
+  """Raises EnvelopeFormatError unless envelope's sig covers just data.
+
+  The XML, JSON and Atom forms have nowhere to say that a signature
+  covers a Signature Base String.
+  """
+  if envelope.sig_base is not None:
+    raise exceptions.EnvelopeFormatError(
+        'Envelope signed in compact form only serializes to compact form')
+
+
+def _Compact(text, intern_it=False):
+  """Squeezes an envelope field into a plain (byte) string.
+
+  Envelope fields are all ASCII, so unicode input (from JSON) is
+  narrowed to str, which takes a quarter of the memory of Python's
+  wide unicode.  Fields drawn from a small set of values (alg,
+  encoding, data_type, keyhash) are interned, so a backlog of envelopes
+  shares one copy of each.
+  """
+  text = utils.Squeeze(text)
+  if isinstance(text, unicode):
+    text = text.encode('ascii')
+  if intern_it:
+    text = intern(text)
+  return text
+
+
 class Envelope(object):
-  """Represents a Magic Envelope."""
+  """Represents a Magic Envelope.
+
+  Envelopes are often held in bulk (e.g. a backlog waiting for
+  VerifyMany), so instances use __slots__ rather than a per-instance
+  dict, and repeated field values are interned.
+  """
+
+  __slots__ = ('data', 'data_type', 'sig', 'keyhash', 'encoding', 'alg',
+               'extra_sigs', 'sig_base', '_digest', '_digest_fields')
 
   def __init__(self,
                data,
@@ -402,7 +1300,9 @@ class Envelope(object):
                sig,
                keyhash='',
                encoding='base64url',
-               alg='RSA-SHA256'):
+               alg='RSA-SHA256',
+               extra_sigs=(),
+               sig_base=None):
     """PRIVATE Constructor. Use factory methods from MagicEnvelopeProtocol.
 
     Args:
@@ -411,35 +1311,90 @@ class Envelope(object):
       encoding: The encoding to use ("base64url")
       alg: The algorithm used ("RSA-SHA256")
       sig: The signature string
+      keyhash: key_id of the key that made sig, if known.
+      extra_sigs: Signature instances for any further signatures, such
+          as those added by relays.
+      sig_base: For an envelope read from the Compact Serialization, the
+          b64(data_type).b64(encoding).b64(alg) tail of the Signature
+          Base String exactly as signed; sig then covers
+          data + '.' + sig_base.  None when sig covers data alone.
 
     Raises:
       EnvelopeFormatError: If the envelope is missing data or not supported
           (envelopes that don't verify are accepted at this stage).
     """
-    self.data = utils.Squeeze(data)
-    self.data_type = utils.Squeeze(data_type)
-    self.sig = utils.Squeeze(sig)
-    self.keyhash = utils.Squeeze(keyhash)
-    self.encoding = utils.Squeeze(encoding)
-    self.alg = utils.Squeeze(alg)
+    try:
+      self.data = _Compact(data)
+      self.data_type = _Compact(data_type, intern_it=True)
+      self.sig = _Compact(sig)
+      self.keyhash = _Compact(keyhash, intern_it=True)
+      self.encoding = _Compact(encoding, intern_it=True)
+      self.alg = _Compact(alg, intern_it=True)
+      if sig_base is not None:
+        sig_base = _Compact(sig_base)
+    except UnicodeError:
+      raise exceptions.EnvelopeFormatError('Non-ASCII envelope field')
+    self.extra_sigs = tuple(extra_sigs)
+    self.sig_base = sig_base
+    self._digest = None
+    self._digest_fields = None
 
     # Sanity checks:
     if not data_type:
-      raise EnvelopeFormatError('Missing data_type: ', self)
+      raise exceptions.EnvelopeFormatError('Missing data_type: ', self)
     if alg != 'RSA-SHA256':
-      raise EnvelopeFormatError('Unknown alg %s; must be RSA-SHA256' %
-                                self._alg, self)
+      raise exceptions.EnvelopeFormatError(
+          'Unknown alg %s; must be RSA-SHA256' % self.alg, self)
     if encoding != 'base64url':
-      raise EnvelopeFormatError('Unknown encoding %s; must be base64url' %
-                                self._encoding, self)
+      raise exceptions.EnvelopeFormatError(
+          'Unknown encoding %s; must be base64url' % self.encoding, self)
 
   def __str__(self):
-    return str(vars(self))
+    return str(dict((name, getattr(self, name)) for name in self.__slots__
+                    if not name.startswith('_')))
+
+  def GetDigest(self):
+    """Returns a hex SHA-256 digest of the envelope's content.
+
+    Equal envelopes have equal digests.  The digest is memoized, and
+    recomputed if any field has been changed since.
+    """
+    fields = (self.data, self.data_type, self.encoding, self.alg,
+              self.sig, self.keyhash, self.sig_base or '',
+              tuple((sig.value, sig.key_id, sig.signer_uri)
+                    for sig in self.extra_sigs))
+    if fields != self._digest_fields:
+      digest = hashlib.sha256()
+      for field in fields[:-1] + sum(fields[-1], ()):
+        if isinstance(field, unicode):
+          field = field.encode('utf-8')
+        digest.update('%d:%s' % (len(field), field))
+      self._digest = digest.hexdigest()
+      self._digest_fields = fields
+    return self._digest
+
+  def GetSignedBytes(self):
+    """Returns what the primary signature covers (see sig_base)."""
+    if self.sig_base is None:
+      return self.data
+    return self.data + '.' + self.sig_base
+
+  def GetSignatures(self):
+    """Returns all signatures as Signature instances, primary first."""
+    return [Signature(self.sig, self.keyhash)] + list(self.extra_sigs)
 
   def __eq__(self, other):
     return (self.data == other.data and
             self.data_type == other.data_type and
             self.sig == other.sig and
             self.keyhash == other.keyhash and
+            tuple(self.extra_sigs) == tuple(other.extra_sigs) and
             self.encoding == other.encoding and
-            self.alg == other.alg)
+            self.alg == other.alg and
+            self.sig_base == other.sig_base)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.GetDigest())
@@ -0,0 +1,175 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Small in-process caches used by the magicsig package."""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import threading
+import time
+
+
+class LruCache(object):
+  """Thread-safe, size-bounded mapping with least recently used eviction.
+
+  Entries may optionally expire after a time to live; expired entries
+  are treated as misses and dropped on access.  The cache may also be
+  given a memory budget, in which case entries are evicted until the
+  sum of their (caller supplied) sizes fits in it.
+  """
+
+  def __init__(self, max_size=1000, ttl=None, clock=time.time,
+               max_bytes=None):
+    """Creates an empty cache.
+
+    Args:
+      max_size: Maximum number of entries held before evicting.
+      ttl: Default time to live in seconds, or None for no expiry.
+      clock: Function returning the current time in seconds.
+      max_bytes: Memory budget in bytes, or None for no budget.
+    """
+    if max_size < 1:
+      raise ValueError('max_size must be positive, not %s' % max_size)
+    self.max_size = max_size
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self._clock = clock
+    self._lock = threading.Lock()
+    # key -> [prev, next, key, expiry, value, size], linked in use order
+    # from the sentinel's next (least recent) to its prev (most recent).
+    # A dict plus a linked list rather than collections.OrderedDict,
+    # which needs Python 2.7.
+    self._entries = {}
+    self._root = root = []
+    root[:] = [root, root, None, None, None, 0]
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def Get(self, key, default=None):
+    """Returns the cached value for key, or default if absent or expired."""
+    self._lock.acquire()
+    try:
+      node = self._entries.get(key)
+      if node is None:
+        self.misses += 1
+        return default
+      expiry = node[3]
+      if expiry is not None and expiry <= self._clock():
+        self._Remove(key)
+        self.misses += 1
+        return default
+      # Move to the most recently used end.
+      self._Unlink(node)
+      self._Append(node)
+      self.hits += 1
+      return node[4]
+    finally:
+      self._lock.release()
+
+  def Put(self, key, value, ttl=None, size=0):
+    """Stores value under key.
+
+    Args:
+      key: Hashable cache key.
+      value: Value to store.
+      ttl: Time to live in seconds for this entry; defaults to self.ttl.
+      size: Approximate size of value in bytes, counted against max_bytes.
+    """
+    if self.max_bytes is not None and size > self.max_bytes:
+      self.Delete(key)
+      return  # Would evict everything else and still not fit.
+    if ttl is None:
+      ttl = self.ttl
+    if ttl is None:
+      expiry = None
+    else:
+      expiry = self._clock() + ttl
+    self._lock.acquire()
+    try:
+      self._Remove(key)
+      node = [None, None, key, expiry, value, size]
+      self._Append(node)
+      self._entries[key] = node
+      self._bytes += size
+      while (len(self._entries) > self.max_size or
+             (self.max_bytes is not None and self._bytes > self.max_bytes)):
+        self._Remove(self._root[1][2])
+        self.evictions += 1
+    finally:
+      self._lock.release()
+
+  def Delete(self, key):
+    """Removes key from the cache if present."""
+    self._lock.acquire()
+    try:
+      self._Remove(key)
+    finally:
+      self._lock.release()
+
+  def _Remove(self, key):
+    """Drops key, keeping the byte count right.  Caller holds the lock."""
+    node = self._entries.pop(key, None)
+    if node is not None:
+      self._Unlink(node)
+      self._bytes -= node[5]
+
+  def _Append(self, node):
+    """Links node in as the most recently used.  Caller holds the lock."""
+    root = self._root
+    last = root[0]
+    node[0] = last
+    node[1] = root
+    last[1] = root[0] = node
+
+  def _Unlink(self, node):
+    """Takes node out of the use order.  Caller holds the lock."""
+    node[0][1] = node[1]
+    node[1][0] = node[0]
+
+  def Clear(self):
+    """Removes all entries; statistics are kept."""
+    self._lock.acquire()
+    try:
+      self._entries.clear()
+      self._root[:] = [self._root, self._root, None, None, None, 0]
+      self._bytes = 0
+    finally:
+      self._lock.release()
+
+  def Stats(self):
+    """Returns a dict of size and hit/miss statistics."""
+    self._lock.acquire()
+    try:
+      lookups = self.hits + self.misses
+      hit_rate = 0.0
+      if lookups:
+        hit_rate = float(self.hits) / lookups
+      return dict(size=len(self._entries),
+                  max_size=self.max_size,
+                  bytes=self._bytes,
+                  max_bytes=self.max_bytes,
+                  hits=self.hits,
+                  misses=self.misses,
+                  evictions=self.evictions,
+                  hit_rate=hit_rate)
+    finally:
+      self._lock.release()
+
+  def __len__(self):
+    return len(self._entries)
@@ -0,0 +1,89 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+
+"""Tests for cache."""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import unittest
+import cache
+
+
+class FakeClock(object):
+  """Manually advanced clock for expiry tests."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class LruCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.cache = cache.LruCache(max_size=2, clock=self.clock)
+
+  def testGetAndPut(self):
+    self.assertEquals(None, self.cache.Get('a'))
+    self.cache.Put('a', 1)
+    self.assertEquals(1, self.cache.Get('a'))
+    self.assertEquals('dflt', self.cache.Get('b', 'dflt'))
+    stats = self.cache.Stats()
+    self.assertEquals(1, stats['hits'])
+    self.assertEquals(2, stats['misses'])
+    self.assertEquals(1, stats['size'])
+
+  def testEvictsLeastRecentlyUsed(self):
+    self.cache.Put('a', 1)
+    self.cache.Put('b', 2)
+    self.cache.Get('a')  # b is now least recently used
+    self.cache.Put('c', 3)
+    self.assertEquals(1, self.cache.Get('a'))
+    self.assertEquals(None, self.cache.Get('b'))
+    self.assertEquals(3, self.cache.Get('c'))
+    self.assertEquals(1, self.cache.Stats()['evictions'])
+
+  def testExpiry(self):
+    self.cache.Put('a', 1, ttl=10)
+    self.cache.Put('b', 2)
+    self.clock.now += 11
+    self.assertEquals(None, self.cache.Get('a'))
+    self.assertEquals(2, self.cache.Get('b'))
+    self.assertEquals(1, len(self.cache))
+
+  def testDeleteAndClear(self):
+    self.cache.Put('a', 1)
+    self.cache.Put('b', 2)
+    self.cache.Delete('a')
+    self.assertEquals(None, self.cache.Get('a'))
+    self.cache.Clear()
+    self.assertEquals(0, len(self.cache))
+
+  def testMemoryBudget(self):
+    budgeted = cache.LruCache(max_size=10, max_bytes=100, clock=self.clock)
+    budgeted.Put('a', 'A', size=40)
+    budgeted.Put('b', 'B', size=40)
+    budgeted.Put('c', 'C', size=40)  # Over budget; a goes
+    self.assertEquals(None, budgeted.Get('a'))
+    self.assertEquals('B', budgeted.Get('b'))
+    self.assertEquals(80, budgeted.Stats()['bytes'])
+
+    budgeted.Put('b', 'B', size=10)  # Replacing recounts the size
+    self.assertEquals(50, budgeted.Stats()['bytes'])
+
+    budgeted.Put('huge', 'H', size=1000)  # Never fits; evicts nothing
+    self.assertEquals(None, budgeted.Get('huge'))
+    self.assertEquals(2, len(budgeted))
+
+    budgeted.Clear()
+    self.assertEquals(0, budgeted.Stats()['bytes'])
+
+  def testBadSize(self):
+    self.assertRaises(ValueError, cache.LruCache, max_size=0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,298 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Durable store of discovered public keys, refreshed ahead of expiry.
+
+Discovering a signer's public key means a webfinger round trip (host-meta,
+LRDD, XRD).  An in-memory cache loses everything on restart, and a cold
+process then sends a burst of discovery requests to every remote server
+it hears from.  PersistentKeyRetriever keeps each key in a sqlite file
+along with the XRD it came from and when it expires, and re-discovers
+keys that are in use shortly before they expire, from a background
+thread or whatever periodic hook calls RefreshDue.  Lookups only wait on
+the network for signers never seen before or whose keys have expired.
+"""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS public_keys (
+  signer_uri TEXT PRIMARY KEY,
+  key TEXT,
+  source TEXT,
+  expires REAL NOT NULL,
+  fetched REAL NOT NULL
+)"""
+
+
+class KeyRecord(object):
+  """A stored public key; key is None when the signer has none."""
+
+  __slots__ = ('key', 'source', 'expires', 'fetched', 'used')
+
+  def __init__(self, key, source, expires, fetched, used=0):
+    self.key = key
+    self.source = source
+    self.expires = expires
+    self.fetched = fetched
+    self.used = used
+
+
+class PersistentKeyRetriever(object):
+  """A KeyRetriever that keeps another's public keys in a sqlite file.
+
+  The wrapped retriever may offer, in order of preference:
+    LookupPublicKeyWithSource(signer_uri) -> (key, expires, source)
+    LookupPublicKeyAndExpiry(signer_uri) -> (key, expires)
+    LookupPublicKey(signer_uri) -> key
+  where expires is in seconds since epoch (None if unknown) and source
+  is the XRD the key was found in.  Keys are kept until they expire, at
+  most max_ttl, or default_ttl if the retriever doesn't say; a signer
+  with no key is remembered for negative_ttl.  Private key lookups are
+  passed straight through.
+
+  All records are held in memory too, so a lookup that hits is a dict
+  access under a lock; sqlite is only written when keys change.
+  """
+
+  def __init__(self, retriever, path, default_ttl=3600, max_ttl=24 * 3600,
+               negative_ttl=300, lead_time=None, clock=time.time):
+    """Opens (creating if need be) the store at path.
+
+    Args:
+      retriever: The KeyRetriever that discovers keys.
+      path: Filename of the sqlite database, or ':memory:'.
+      default_ttl: Seconds to keep a key whose expiry is unknown.
+      max_ttl: Most seconds to keep any key.
+      negative_ttl: Seconds to remember that a signer has no key.
+      lead_time: Seconds before expiring that a key in use is refreshed;
+          defaults to a tenth of default_ttl.
+      clock: Function returning the current time in seconds.
+    """
+    if lead_time is None:
+      lead_time = default_ttl / 10.0
+    self.retriever = retriever
+    self.default_ttl = default_ttl
+    self.max_ttl = max_ttl
+    self.negative_ttl = negative_ttl
+    self.lead_time = lead_time
+    # How often Start's thread calls RefreshDue.
+    self.refresh_interval = lead_time / 2.0
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._db = sqlite3.connect(path, check_same_thread=False)
+    self._db.execute(_SCHEMA)
+    self._db.commit()
+    self._records = {}  # signer_uri -> KeyRecord
+    for signer_uri, key, source, expires, fetched in self._db.execute(
+        'SELECT signer_uri, key, source, expires, fetched FROM public_keys'):
+      self._records[signer_uri] = KeyRecord(_DecodeKey(key), source,
+                                            expires, fetched)
+    self._thread = None
+    self._stopping = threading.Event()
+    self.hits = 0
+    self.misses = 0
+    self.refreshed = 0
+    self.refresh_failures = 0
+
+  def LookupPublicKey(self, signer_uri):
+    now = self._clock()
+    self._lock.acquire()
+    try:
+      record = self._records.get(signer_uri)
+      if record is not None and record.expires > now:
+        record.used = now
+        self.hits += 1
+        return record.key
+      self.misses += 1
+    finally:
+      self._lock.release()
+    return self._Fetch(signer_uri, now).key
+
+  def LookupPrivateKey(self, signer_uri):
+    return self.retriever.LookupPrivateKey(signer_uri)
+
+  def GetRecord(self, signer_uri):
+    """Returns the stored KeyRecord for signer_uri, or None."""
+    self._lock.acquire()
+    try:
+      return self._records.get(signer_uri)
+    finally:
+      self._lock.release()
+
+  def Forget(self, signer_uri):
+    """Drops any stored key for signer_uri, e.g. after a failed verify."""
+    self._lock.acquire()
+    try:
+      self._records.pop(signer_uri, None)
+      self._db.execute('DELETE FROM public_keys WHERE signer_uri = ?',
+                       (signer_uri,))
+      self._db.commit()
+    finally:
+      self._lock.release()
+
+  def RefreshDue(self, limit=None):
+    """Re-discovers keys that are in use and about to expire.
+
+    A key counts as in use if it was looked up since it was last
+    fetched.  Keys nobody asks for are left to expire.  If discovery
+    fails outright the old key is kept until it expires; if it finds no
+    key, the old one is kept and tried again after negative_ttl plus
+    refresh_interval (until max_ttl after it was found).
+
+    Args:
+      limit: Most keys to refresh in this call; None for all that are due.
+    Returns:
+      The number of keys refreshed (successfully or not).
+    """
+    now = self._clock()
+    self._lock.acquire()
+    try:
+      due = [(record.expires, signer_uri)
+             for signer_uri, record in self._records.iteritems()
+             if record.used > record.fetched and
+             record.expires - self.lead_time <= now]
+    finally:
+      self._lock.release()
+    due.sort()
+    if limit is not None:
+      due = due[:limit]
+    for _, signer_uri in due:
+      try:
+        self._Fetch(signer_uri, self._clock())
+        self.refreshed += 1
+      except Exception:
+        self.refresh_failures += 1
+    return len(due)
+
+  def Start(self, interval=None):
+    """Runs RefreshDue every interval seconds on a daemon thread.
+
+    interval defaults to half of lead_time, so that keys in use are
+    refreshed before they expire.
+    """
+    if self._thread is not None:
+      return
+    if interval is None:
+      interval = self.refresh_interval
+    self.refresh_interval = interval
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._Run, args=(interval,),
+                                    name='magicsig-key-refresh')
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    """Stops the background thread started by Start, waiting for it."""
+    if self._thread is None:
+      return
+    self._stopping.set()
+    self._thread.join()
+    self._thread = None
+
+  def Close(self):
+    """Stops any background thread and closes the database."""
+    self.Stop()
+    self._lock.acquire()
+    try:
+      self._db.close()
+    finally:
+      self._lock.release()
+
+  def Stats(self):
+    """Returns a dict of store size and lookup/refresh counts."""
+    self._lock.acquire()
+    try:
+      return dict(size=len(self._records),
+                  hits=self.hits,
+                  misses=self.misses,
+                  refreshed=self.refreshed,
+                  refresh_failures=self.refresh_failures)
+    finally:
+      self._lock.release()
+
+  def _Run(self, interval):
+    while not self._stopping.isSet():
+      self.RefreshDue()
+      self._stopping.wait(interval)
+
+  def _Lookup(self, signer_uri):
+    """Asks the wrapped retriever; returns (key, expires, source)."""
+    lookup = getattr(self.retriever, 'LookupPublicKeyWithSource', None)
+    if lookup is not None:
+      return lookup(signer_uri)
+    lookup = getattr(self.retriever, 'LookupPublicKeyAndExpiry', None)
+    if lookup is not None:
+      key, expires = lookup(signer_uri)
+      return key, expires, None
+    return self.retriever.LookupPublicKey(signer_uri), None, None
+
+  def _Fetch(self, signer_uri, now):
+    """Discovers signer_uri's key and stores it; returns the KeyRecord."""
+    # Discovered outside the lock, so other signers' lookups never wait.
+    key, expires, source = self._Lookup(signer_uri)
+    if key is None:
+      ttl = self.negative_ttl
+    elif expires is None:
+      ttl = self.default_ttl
+    else:
+      ttl = min(expires - now, self.max_ttl)
+    record = KeyRecord(key, source, now + ttl, now)
+    if ttl <= 0:
+      return record
+    self._lock.acquire()
+    try:
+      old = self._records.get(signer_uri)
+      if old is not None:
+        record.used = old.used
+        if (key is None and old.key is not None and
+            old.fetched + self.max_ttl > now):
+          # Finding nothing where there was a key is more likely a
+          # broken XRD than a revoked key: keep serving the old one, not
+          # much past max_ttl from when it was found.  It falls due
+          # again no sooner than negative_ttl from now, and one refresh
+          # pass before it expires.
+          record = KeyRecord(old.key, old.source,
+                             now + self.negative_ttl + self.lead_time +
+                             self.refresh_interval,
+                             old.fetched, old.used)
+      self._records[signer_uri] = record
+      self._db.execute(
+          'INSERT OR REPLACE INTO public_keys VALUES (?, ?, ?, ?, ?)',
+          (signer_uri, _EncodeKey(record.key), record.source,
+           record.expires, record.fetched))
+      self._db.commit()
+    finally:
+      self._lock.release()
+    return record
+
+
+def _EncodeKey(key):
+  """Flattens a key, or a signer's list of keys, to one string."""
+  if isinstance(key, (list, tuple)):
+    return '\n'.join(key)
+  return key
+
+
+def _DecodeKey(text):
+  if text is not None and '\n' in text:
+    return text.split('\n')
+  return text
@@ -0,0 +1,185 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for keystore.py."""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import keystore
+import magicsig_test
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000000000
+
+  def __call__(self):
+    return self.now
+
+
+class FakeKeyRetriever(object):
+  """Serves one key with a fixed lifetime, counting lookups."""
+
+  def __init__(self, clock, key=magicsig_test.TEST_PUBLIC_KEY, ttl=1000):
+    self.clock = clock
+    self.key = key
+    self.ttl = ttl
+    self.lookups = []
+
+  def LookupPublicKeyWithSource(self, signer_uri):
+    self.lookups.append(signer_uri)
+    if isinstance(self.key, Exception):
+      raise self.key
+    return (self.key, self.clock() + self.ttl,
+            '<XRD><Subject>%s</Subject></XRD>' % signer_uri)
+
+  def LookupPrivateKey(self, signer_uri):
+    return magicsig_test.TEST_PRIVATE_KEY
+
+
+class PersistentKeyRetrieverTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'keys.db')
+    self.clock = FakeClock()
+    self.remote = FakeKeyRetriever(self.clock)
+    self.stores = []
+
+  def tearDown(self):
+    for store in self.stores:
+      store.Close()
+    shutil.rmtree(self.dir)
+
+  def _Open(self, **kwargs):
+    store = keystore.PersistentKeyRetriever(self.remote, self.path,
+                                            lead_time=100, clock=self.clock,
+                                            **kwargs)
+    self.stores.append(store)
+    return store
+
+  def testCachesKeyWithSource(self):
+    store = self._Open()
+    for _ in range(3):
+      self.assertEquals(magicsig_test.TEST_PUBLIC_KEY,
+                        store.LookupPublicKey('acct:bob@example.com'))
+    self.assertEquals(1, len(self.remote.lookups))
+    record = store.GetRecord('acct:bob@example.com')
+    self.assertEquals('<XRD><Subject>acct:bob@example.com</Subject></XRD>',
+                      record.source)
+    self.assertEquals(self.clock.now + 1000, record.expires)
+
+  def testSurvivesRestart(self):
+    self._Open().LookupPublicKey('acct:bob@example.com')
+    store = self._Open()
+    self.assertEquals(magicsig_test.TEST_PUBLIC_KEY,
+                      store.LookupPublicKey('acct:bob@example.com'))
+    self.assertEquals(1, len(self.remote.lookups))
+
+  def testKeyListsSurviveRestart(self):
+    self.remote.key = ['RSA.a.AQAB', 'RSA.b.AQAB']
+    self._Open().LookupPublicKey('acct:bob@example.com')
+    self.assertEquals(['RSA.a.AQAB', 'RSA.b.AQAB'],
+                      self._Open().LookupPublicKey('acct:bob@example.com'))
+
+  def testExpiredKeysAreFetchedAgain(self):
+    store = self._Open()
+    store.LookupPublicKey('acct:bob@example.com')
+    self.clock.now += 1000
+    store.LookupPublicKey('acct:bob@example.com')
+    self.assertEquals(2, len(self.remote.lookups))
+
+  def testNegativeResultsExpireSooner(self):
+    self.remote.key = None
+    store = self._Open(negative_ttl=10)
+    self.assertEquals(None, store.LookupPublicKey('acct:bob@example.com'))
+    self.assertEquals(None, store.LookupPublicKey('acct:bob@example.com'))
+    self.assertEquals(1, len(self.remote.lookups))
+    self.clock.now += 10
+    store.LookupPublicKey('acct:bob@example.com')
+    self.assertEquals(2, len(self.remote.lookups))
+
+  def testRefreshesKeysInUseBeforeExpiry(self):
+    store = self._Open()
+    store.LookupPublicKey('acct:bob@example.com')
+    store.LookupPublicKey('acct:alice@example.com')
+
+    # Nothing is due yet:
+    self.clock.now += 800
+    self.assertEquals(0, store.RefreshDue())
+
+    # Only the key looked up since it was fetched is refreshed:
+    store.LookupPublicKey('acct:bob@example.com')
+    self.clock.now += 150
+    self.assertEquals(1, store.RefreshDue())
+    self.assertEquals(self.clock.now + 1000,
+                      store.GetRecord('acct:bob@example.com').expires)
+
+    # And the lookup after the old expiry doesn't touch the network:
+    self.clock.now += 100
+    store.LookupPublicKey('acct:bob@example.com')
+    self.assertEquals(['acct:bob@example.com', 'acct:alice@example.com',
+                       'acct:bob@example.com'], self.remote.lookups)
+
+  def testFailedRefreshKeepsOldKey(self):
+    store = self._Open()
+    store.LookupPublicKey('acct:bob@example.com')
+    self.clock.now += 950
+    store.LookupPublicKey('acct:bob@example.com')
+    self.remote.key = IOError('unreachable')
+    self.assertEquals(1, store.RefreshDue())
+    self.assertEquals(1, store.Stats()['refresh_failures'])
+    self.assertEquals(magicsig_test.TEST_PUBLIC_KEY,
+                      store.LookupPublicKey('acct:bob@example.com'))
+
+  def testRefreshFindingNoKeyKeepsOldKey(self):
+    store = self._Open(negative_ttl=10)
+    store.LookupPublicKey('acct:bob@example.com')
+    self.clock.now += 950
+    store.LookupPublicKey('acct:bob@example.com')
+    self.remote.key = None
+    self.assertEquals(1, store.RefreshDue())
+
+    # Kept, on disk too:
+    record = self._Open().GetRecord('acct:bob@example.com')
+    self.assertEquals(magicsig_test.TEST_PUBLIC_KEY, record.key)
+
+    # Not due again straight away, only after negative_ttl plus a
+    # refresh interval, and still one pass before it expires:
+    self.assertEquals(0, store.RefreshDue())
+    self.clock.now += 10 + 49
+    self.assertEquals(0, store.RefreshDue())
+    self.clock.now += 1
+    self.assertEquals(1, store.RefreshDue())
+    self.assertEquals(self.clock.now + 10 + 100 + 50,
+                      store.GetRecord('acct:bob@example.com').expires)
+    self.assertEquals(3, len(self.remote.lookups))
+
+  def testForget(self):
+    store = self._Open()
+    store.LookupPublicKey('acct:bob@example.com')
+    store.Forget('acct:bob@example.com')
+    self.assertEquals(None, self._Open().GetRecord('acct:bob@example.com'))
+
+
+if __name__ == '__main__':
+  unittest.main()
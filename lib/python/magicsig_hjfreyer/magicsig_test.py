@@ -20,8 +20,10 @@ __author__ = 'jpanzer@google.com (John Panzer)'
 
 import mox
 
+import base64
 import copy
 import re
+import StringIO
 import time
 import unittest
 try:
@@ -57,6 +59,12 @@ TEST_ATOM = """<?xml version='1.0' encoding='UTF-8'?>
 </entry>
 """
 
+RELAY_KEY = ('RSA.qptGBypMyhL3G7F3WkmU5nI5_oY6d1Jq_I0bgVE-cpSzS7gVV88K2EytO'
+             'NEEgXsiVkxXQ6VTKXkyLhP6CQYv0Q=='
+             '.AQAB'
+             '.KpP98iPYbkY1ba_ovZvHkYvIdYFCbi0fjlAZITkJgMa63nGSODpZ7fxcno2l'
+             'R8Tdb37SkcmkSPi4tt7R0qH6EQ==')
+
 TEST_NON_ATOM = 'Some aribtrary string.'
 
 TEST_ENVELOPE = magicsig.Envelope(
@@ -96,9 +104,9 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
     self.mox.VerifyAll()
 
   def testSigning(self):
-    self.extractor.ExtractAuthors(TEST_ATOM,
-                                  'application/atom+xml').AndReturn(
-        ['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml').AndReturn(
+        'acct:test@example.com')
     self.key_get.LookupPrivateKey('acct:test@example.com').AndReturn(
         TEST_PRIVATE_KEY)
     self.mox.ReplayAll()
@@ -109,13 +117,13 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
     self.assertEquals(TEST_ENVELOPE, envelope)
 
   def testSigningNonAtom(self):
-    self.extractor.ExtractAuthors(TEST_NON_ATOM, 'text/plain').AndReturn(
-        ['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_NON_ATOM, 'text/plain').AndReturn(
+        'acct:test@example.com')
     self.key_get.LookupPrivateKey('acct:test@example.com').AndReturn(
         TEST_PRIVATE_KEY)
 
-    self.extractor.ExtractAuthors(TEST_NON_ATOM, 'text/plain').AndReturn(
-        ['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_NON_ATOM, 'text/plain').AndReturn(
+        'acct:test@example.com')
     self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
         TEST_PUBLIC_KEY)
     self.mox.ReplayAll()
@@ -129,9 +137,9 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
     assert self.protocol.VerifyEnvelope(envelope)
 
   def testVerify(self):
-    self.extractor.ExtractAuthors(TEST_ATOM,
-                                  'application/atom+xml'
-                                  ).AndReturn(['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
     self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
         TEST_PUBLIC_KEY)
     self.mox.ReplayAll()
@@ -139,9 +147,9 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
     self.assertTrue(self.protocol.VerifyEnvelope(TEST_ENVELOPE))
 
   def testVerifyWithWrongPublicKey(self):
-    self.extractor.ExtractAuthors(TEST_ATOM,
-                                  'application/atom+xml'
-                                  ).AndReturn(['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
     self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
         TEST_PUBLIC_KEY.replace('B', 'b'))
     self.mox.ReplayAll()
@@ -149,9 +157,9 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
     self.assertFalse(self.protocol.VerifyEnvelope(TEST_ENVELOPE))
 
   def testVerifyNoPublicKeyFound(self):
-    self.extractor.ExtractAuthors(TEST_ATOM,
-                                  'application/atom+xml'
-                                  ).AndReturn(['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
     self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(None)
     self.mox.ReplayAll()
 
@@ -160,9 +168,9 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
                       TEST_ENVELOPE)
 
   def testTampering(self):
-    self.extractor.ExtractAuthors(TEST_ATOM,
-                                  'application/atom+xml'
-                                  ).AndReturn(['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
     self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
         TEST_PUBLIC_KEY)
     self.mox.ReplayAll()
@@ -172,6 +180,428 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
 
     self.assertFalse(self.protocol.VerifyEnvelope(envelope))
 
+  def testExtractAuthorsOverrideIsUsed(self):
+    class RelabelingExtractor(utils.DefaultAuthorExtractor):
+      def ExtractAuthors(self, text, mime_type):
+        return ['acct:alias@example.com']
+
+    self.key_get.LookupPublicKey('acct:alias@example.com').AndReturn(
+        TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+
+    self.protocol.author_extractor = RelabelingExtractor()
+    self.assertTrue(self.protocol.VerifyEnvelope(TEST_ENVELOPE))
+
+  def testVerifyMemoKeepsAuthorBinding(self):
+    for author, public_key in (('acct:test@example.com', TEST_PUBLIC_KEY),
+                               ('acct:test@example.com', TEST_PUBLIC_KEY),
+                               ('acct:mallory@example.com', RELAY_KEY)):
+      self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                        ).AndReturn(author)
+      self.key_get.LookupPublicKey(author).AndReturn(public_key)
+    self.mox.ReplayAll()
+
+    algs = magicsig.magicsigalg.DefaultAlgorithms(verify_cache_size=10)
+    self.protocol.algs = algs
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.keyhash = algs.GetKeyId(TEST_PUBLIC_KEY)
+
+    # The author's key is looked up every time; only the RSA is memoized:
+    self.assertTrue(self.protocol.VerifyEnvelope(envelope))
+    self.assertTrue(self.protocol.VerifyEnvelope(envelope))
+    self.assertEquals(1, algs.GetVerifyCacheStats()['hits'])
+
+    # A remembered signature doesn't pass for another author's key:
+    self.assertFalse(self.protocol.VerifyEnvelope(envelope))
+
+  def _ExpectRotatedKeys(self):
+    old_key = TEST_PUBLIC_KEY.replace('B', 'b')
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        [old_key, TEST_PUBLIC_KEY])
+    self.mox.ReplayAll()
+    return old_key
+
+  def testVerifyRotatedKeysByKeyhash(self):
+    self._ExpectRotatedKeys()
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.keyhash = self.protocol.algs.GetKeyId(TEST_PUBLIC_KEY)
+
+    self.assertTrue(self.protocol.VerifyEnvelope(envelope))
+
+  def testVerifyRotatedKeysOnlyTriesNamedKey(self):
+    old_key = self._ExpectRotatedKeys()
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.keyhash = self.protocol.algs.GetKeyId(old_key)
+
+    self.assertFalse(self.protocol.VerifyEnvelope(envelope))
+
+  def testVerifyRotatedKeysWithoutKeyhash(self):
+    self._ExpectRotatedKeys()
+
+    self.assertTrue(self.protocol.VerifyEnvelope(TEST_ENVELOPE))
+
+  def testVerifyManyRotatedKeys(self):
+    old_key = TEST_PUBLIC_KEY.replace('B', 'b')
+    named = copy.copy(TEST_ENVELOPE)
+    named.keyhash = self.protocol.algs.GetKeyId(TEST_PUBLIC_KEY)
+    envelopes = [TEST_ENVELOPE, named]
+
+    for _ in envelopes:
+      self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                        ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        [old_key, TEST_PUBLIC_KEY])
+    self.mox.ReplayAll()
+
+    self.assertEquals([True, True], self.protocol.VerifyMany(envelopes))
+
+  def _ExpectBatch(self):
+    tampered = copy.copy(TEST_ENVELOPE)
+    tampered.sig = tampered.sig.replace('DNgwHrN', 'ANgwHrN')
+    envelopes = [TEST_ENVELOPE, tampered, TEST_NON_ATOM_ENVELOPE]
+
+    self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.extractor.ExtractFirstAuthor(TEST_NON_ATOM, 'text/plain'
+                                      ).AndReturn('acct:test@example.com')
+    # Only one key lookup for the shared author:
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+    return envelopes
+
+  def testVerifyMany(self):
+    envelopes = self._ExpectBatch()
+
+    self.assertEquals([True, False, True],
+                      self.protocol.VerifyMany(envelopes))
+    self.assertTrue(0 < self.protocol.GetDateLastVerified(TEST_ENVELOPE))
+    self.assertEquals(0, self.protocol.GetDateLastVerified(envelopes[1]))
+
+  def testVerifyManyWithExecutor(self):
+    class InlineExecutor(object):
+      def map(self, fn, items):
+        return [fn(item) for item in items]
+
+    envelopes = self._ExpectBatch()
+    self.protocol.verify_chunk_size = 1
+
+    self.assertEquals([True, False, True],
+                      self.protocol.VerifyMany(envelopes, InlineExecutor()))
+
+  def testVerifyManyNoAuthor(self):
+    self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                      ).AndReturn(None)
+    self.mox.ReplayAll()
+
+    self.assertEquals([False], self.protocol.VerifyMany([TEST_ENVELOPE]))
+
+  def testVerifyManyUndecodable(self):
+    undecodable = copy.copy(TEST_ENVELOPE)
+    undecodable.data = 'abc'
+    self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+
+    self.assertEquals([False, True],
+                      self.protocol.VerifyMany([undecodable, TEST_ENVELOPE]))
+
+  def _ExpectGarbledBatch(self):
+    garbled = copy.copy(TEST_ENVELOPE)
+    garbled.sig = TEST_ENVELOPE.sig.rstrip('=')[:-1] + 'A'
+    for _ in range(2):
+      self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                        ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+    return [TEST_ENVELOPE, garbled]
+
+  def testVerifyManyGarbledSig(self):
+    envelopes = self._ExpectGarbledBatch()
+
+    self.assertEquals([True, False], self.protocol.VerifyMany(envelopes))
+
+  def testVerifyManyGarbledSigWithExecutor(self):
+    class InlineExecutor(object):
+      def map(self, fn, items):
+        return [fn(item) for item in items]
+
+    envelopes = self._ExpectGarbledBatch()
+    self.protocol.verify_chunk_size = 1
+
+    self.assertEquals([True, False],
+                      self.protocol.VerifyMany(envelopes, InlineExecutor()))
+
+  def _RelayedEnvelope(self, relay_sig=None):
+    if relay_sig is None:
+      relay_sig = magicsig.magicsigalg.SignatureAlgRsaSha256(
+          RELAY_KEY).Sign(TEST_ENVELOPE.data)
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.extra_sigs = [magicsig.Signature(
+        relay_sig, self.protocol.algs.GetKeyId(RELAY_KEY),
+        'acct:relay@example.com')]
+    return envelope
+
+  def _ExpectSigners(self):
+    # The relay isn't an author; its key is found through the signer
+    # named on its signature.
+    self.extractor.ExtractAuthors(TEST_ATOM, 'application/atom+xml'
+                                  ).MultipleTimes().AndReturn(
+        ['acct:test@example.com'])
+    self.key_get.LookupPublicKey('acct:test@example.com').MultipleTimes(
+        ).AndReturn(TEST_PUBLIC_KEY)
+    self.key_get.LookupPublicKey('acct:relay@example.com').MultipleTimes(
+        ).AndReturn(RELAY_KEY)
+    self.mox.ReplayAll()
+
+  def testAddSignature(self):
+    self.key_get.LookupPrivateKey('acct:relay@example.com').AndReturn(
+        RELAY_KEY)
+    self._ExpectSigners()
+
+    envelope = self.protocol.AddSignature(TEST_ENVELOPE,
+                                          'acct:relay@example.com')
+
+    self.assertEquals(self._RelayedEnvelope(), envelope)
+    self.assertTrue(self.protocol.VerifySignatures(envelope))
+
+  def testVerifySignaturesPolicies(self):
+    self._ExpectSigners()
+    envelope = self._RelayedEnvelope(relay_sig=TEST_ENVELOPE.sig)
+
+    self.assertTrue(self.protocol.VerifySignatures(envelope,
+                                                   magicsig.ANY_OF))
+    self.assertFalse(self.protocol.VerifySignatures(envelope,
+                                                    magicsig.ALL_OF))
+    self.assertTrue(self.protocol.VerifySignatures(
+        envelope, magicsig.THRESHOLD, threshold=1))
+    self.assertFalse(self.protocol.VerifySignatures(
+        envelope, magicsig.THRESHOLD, threshold=2))
+
+  def testVerifySignaturesCountsDistinctKeys(self):
+    self.extractor.ExtractAuthors(TEST_ATOM, 'application/atom+xml'
+                                  ).MultipleTimes().AndReturn(
+        ['acct:test@example.com'])
+    self.key_get.LookupPublicKey('acct:test@example.com').MultipleTimes(
+        ).AndReturn(TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.extra_sigs = [magicsig.Signature(TEST_ENVELOPE.sig),
+                           magicsig.Signature(TEST_ENVELOPE.sig)]
+
+    self.assertTrue(self.protocol.VerifySignatures(envelope,
+                                                   magicsig.ANY_OF))
+    self.assertFalse(self.protocol.VerifySignatures(envelope,
+                                                    magicsig.ALL_OF))
+    self.assertFalse(self.protocol.VerifySignatures(
+        envelope, magicsig.THRESHOLD, threshold=2))
+
+  def testVerifySignaturesRelayChecksOnlyItsOwnKeys(self):
+    self._ExpectSigners()
+    # The author's signature, relabelled as the relay's, doesn't count:
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.extra_sigs = [magicsig.Signature(TEST_ENVELOPE.sig, '',
+                                              'acct:relay@example.com')]
+
+    self.assertFalse(self.protocol.VerifySignatures(envelope,
+                                                    magicsig.ALL_OF))
+
+  def testVerifySignaturesAnyOfShortCircuits(self):
+    calls = []
+    class CountingAlgorithms(magicsig.magicsigalg.DefaultAlgorithms):
+      def Verify(self, *args):
+        calls.append(args)
+        return magicsig.magicsigalg.DefaultAlgorithms.Verify(self, *args)
+
+    self._ExpectSigners()
+    self.protocol.algs = CountingAlgorithms()
+
+    self.assertTrue(self.protocol.VerifySignatures(self._RelayedEnvelope(),
+                                                   magicsig.ANY_OF))
+    self.assertEquals(1, len(calls))
+
+  def testVerifySignaturesWithExecutor(self):
+    class DoneFuture(object):
+      def __init__(self, value):
+        self.value = value
+      def result(self):
+        return self.value
+      def cancel(self):
+        return False
+
+    class InlineExecutor(object):
+      def submit(self, fn, *args):
+        return DoneFuture(fn(*args))
+
+    self._ExpectSigners()
+
+    self.assertTrue(self.protocol.VerifySignatures(self._RelayedEnvelope(),
+                                                   executor=InlineExecutor()))
+
+  def testVerifySignaturesBadPolicy(self):
+    self.mox.ReplayAll()
+
+    self.assertRaises(ValueError, self.protocol.VerifySignatures,
+                      TEST_ENVELOPE, 'most-of')
+    self.assertRaises(ValueError, self.protocol.VerifySignatures,
+                      TEST_ENVELOPE, magicsig.THRESHOLD)
+
+  def testMultipleSignaturesXmlRoundTrip(self):
+    self.mox.ReplayAll()
+    envelope = self._RelayedEnvelope()
+
+    text = self.protocol.ToXmlString(envelope)
+
+    self.assertEquals(2, text.count('<me:sig'))
+    self.assertEquals(envelope, self.protocol.FromString(text))
+
+  def testJsonRoundTrip(self):
+    self.mox.ReplayAll()
+    for envelope in (TEST_ENVELOPE, self._RelayedEnvelope()):
+      text = self.protocol.ToJsonString(envelope)
+
+      self.assertEquals(envelope,
+                        self.protocol.FromString(text, utils.Mimes.JSON_ME))
+
+  def testFromJsonString(self):
+    self.mox.ReplayAll()
+    text = """{"data": "%s",
+               "data_type": "application/atom+xml",
+               "encoding": "base64url",
+               "alg": "RSA-SHA256",
+               "sigs": [{"value": "%s"}]}""" % (TEST_ENVELOPE.data,
+                                                TEST_ENVELOPE.sig)
+
+    envelope = self.protocol.FromString(text, utils.Mimes.JSON)
+
+    self.assertEquals(TEST_ENVELOPE, envelope)
+    self.assertTrue(isinstance(envelope.data, str))
+
+  def testFromJsonStringMalformed(self):
+    self.mox.ReplayAll()
+    for text in ('{"data": ', '[]', '{"data_type": "text/plain"}',
+                 '{"data": "x", "data_type": "text/plain", "sigs": []}',
+                 '{"data": 5, "data_type": "text/plain", '
+                 '"sigs": [{"value": "x"}]}'):
+      self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                        self.protocol.FromString, text, utils.Mimes.JSON_ME)
+
+  def _CompactToken(self, data_type='application/atom+xml'):
+    # Built the way genjsontoken.py does, but leaving off the metadata
+    # padding as the draft's example does.
+    sbs = '.'.join([base64.urlsafe_b64encode(TEST_ATOM)] +
+                   [base64.urlsafe_b64encode(field).rstrip('=')
+                    for field in (data_type, 'base64url', 'RSA-SHA256')])
+    sig = magicsig.magicsigalg.SignatureAlgRsaSha256(
+        TEST_PRIVATE_KEY).Sign(sbs)
+    return '.'.join(('', sig, sbs))
+
+  def testCompactRoundTrip(self):
+    self.extractor.ExtractFirstAuthor(TEST_ATOM, 'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPrivateKey('acct:test@example.com').AndReturn(
+        TEST_PRIVATE_KEY)
+    self.mox.ReplayAll()
+
+    text = self.protocol.ToCompactString(TEST_ENVELOPE)
+
+    key_id, sig, sbs = text.split('.', 2)
+    self.assertEquals(self.protocol.algs.GetKeyId(TEST_PRIVATE_KEY), key_id)
+    self.assertEquals('.'.join((TEST_ENVELOPE.data,
+                                'YXBwbGljYXRpb24vYXRvbSt4bWw=',
+                                'YmFzZTY0dXJs', 'UlNBLVNIQTI1Ng==')), sbs)
+    self.assertNotEquals(TEST_ENVELOPE.sig, sig)
+    envelope = self.protocol.FromCompactString(text)
+    self.assertEquals(sbs, envelope.GetSignedBytes())
+    self.assertEquals(text, self.protocol.ToCompactString(envelope))
+
+  def testCompactStringVerifies(self):
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+
+    envelope = self.protocol.FromCompactString(self._CompactToken() + '\r\n')
+
+    self.assertEquals('application/atom+xml', envelope.data_type)
+    self.assertTrue(self.protocol.VerifyEnvelope(envelope))
+
+  def testCompactStringSignsMetadata(self):
+    self.extractor.ExtractFirstAuthor(TEST_ATOM, 'text/plain'
+                                      ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+        TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+
+    fields = self._CompactToken().split('.')
+    fields[3] = base64.urlsafe_b64encode('text/plain')
+    envelope = self.protocol.FromCompactString('.'.join(fields))
+
+    self.assertFalse(self.protocol.VerifyEnvelope(envelope))
+
+  def testCompactStringMalformed(self):
+    self.mox.ReplayAll()
+    text = self._CompactToken()
+
+    for bad in (text.rsplit('.', 1)[0], text + '.', text + 'A'):
+      self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                        self.protocol.FromCompactString, bad)
+    self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                      self.protocol.ToCompactString, self._RelayedEnvelope())
+    # The XML form can't say its sig covers the Signature Base String:
+    self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                      self.protocol.ToXmlString,
+                      self.protocol.FromCompactString(text))
+
+  def testFromStream(self):
+    self.mox.ReplayAll()
+    for envelope in (TEST_ENVELOPE, self._RelayedEnvelope()):
+      text = self.protocol.ToXmlString(envelope)
+
+      # Tiny chunks split tags, text and whitespace across reads.
+      self.assertEquals(envelope, self.protocol.FromStream(
+          StringIO.StringIO(text), chunk_size=7))
+
+  def testFromStreamAtom(self):
+    self.mox.ReplayAll()
+    text = """<entry xmlns='http://www.w3.org/2005/Atom'
+                     xmlns:me='http://salmon-protocol.org/ns/magic-env'>
+      <title>Unsigned and ignored</title>
+      <me:provenance>
+        <me:data type='application/atom+xml'>%s</me:data>
+        <me:encoding>base64url</me:encoding>
+        <me:alg>RSA-SHA256</me:alg>
+        <me:sig>%s</me:sig>
+      </me:provenance>
+    </entry>""" % (TEST_ENVELOPE.data, TEST_ENVELOPE.sig)
+
+    self.assertEquals(TEST_ENVELOPE,
+                      self.protocol.FromStream(StringIO.StringIO(text)))
+
+  def testFromStreamIncomplete(self):
+    self.mox.ReplayAll()
+    for text in ('<foo/>',
+                 "<me:env xmlns:me='http://salmon-protocol.org/ns/magic-env'>"
+                 "<me:data type='text/plain'>abc</me:data></me:env>"):
+      self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                        self.protocol.FromStream, StringIO.StringIO(text))
+
+  def testFromStreamMalformed(self):
+    self.mox.ReplayAll()
+    for text in ('<me:env', '<a></b>', 'not xml'):
+      self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                        self.protocol.FromStream, StringIO.StringIO(text))
+
   def testToAtom(self):
     text = self.protocol.ToAtomString(TEST_ENVELOPE)
 
@@ -200,10 +630,27 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
 
     self.assertEquals(utils.Squeeze(text), utils.Squeeze(text))
 
+  def testToXmlEscapesKeyId(self):
+    self.mox.ReplayAll()
+    envelope = copy.copy(TEST_ENVELOPE)
+    envelope.keyhash = "k'\"<&>"
+
+    text = self.protocol.ToXmlString(envelope)
+
+    self.assertEquals(envelope, self.protocol.FromString(text))
+
+  def testFromXmlString(self):
+    self.mox.ReplayAll()
+
+    text = self.protocol.ToXmlString(TEST_ENVELOPE)
+    envelope = self.protocol.FromString(text)
+
+    self.assertEquals(TEST_ENVELOPE, envelope)
+
   def testVerifyMakesEnvelopeFresh(self):
-    self.extractor.ExtractAuthors(TEST_ATOM,
-                                  'application/atom+xml'
-                                  ).AndReturn(['acct:test@example.com'])
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
     self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
       TEST_PUBLIC_KEY)
     self.mox.ReplayAll()
@@ -213,6 +660,63 @@ class MagicEnvelopeProtocolTest(unittest.TestCase):
 
     self.assertTrue(0 < self.protocol.GetDateLastVerified(TEST_ENVELOPE))
 
+  def testEqualEnvelopesShareCacheEntries(self):
+    self.extractor.ExtractFirstAuthor(TEST_ATOM,
+                                      'application/atom+xml'
+                                      ).AndReturn('acct:test@example.com')
+    self.key_get.LookupPublicKey('acct:test@example.com').AndReturn(
+      TEST_PUBLIC_KEY)
+    self.mox.ReplayAll()
+
+    copy = magicsig.Envelope(data=TEST_ENVELOPE.data,
+                             data_type=TEST_ENVELOPE.data_type,
+                             sig=TEST_ENVELOPE.sig)
+    self.assertEquals(TEST_ENVELOPE.GetDigest(), copy.GetDigest())
+    self.assertEquals(hash(TEST_ENVELOPE), hash(copy))
+
+    self.protocol.VerifyEnvelope(TEST_ENVELOPE)
+    self.assertTrue(0 < self.protocol.GetDateLastVerified(copy))
+
+    decoded = self.protocol.GetDataAsRawString(TEST_ENVELOPE)
+    self.assertEquals(decoded, self.protocol.GetDataAsRawString(copy))
+    stats = self.protocol.GetEnvelopeCacheStats()
+    self.assertEquals(2, stats['hits'])
+    self.assertEquals(len(decoded), stats['bytes'])
+
+    # Changing a field changes the digest:
+    copy.sig = copy.sig[::-1]
+    self.assertNotEqual(TEST_ENVELOPE.GetDigest(), copy.GetDigest())
+    self.assertEquals(0, self.protocol.GetDateLastVerified(copy))
+
+  def testEnvelopeIsCompact(self):
+    self.mox.ReplayAll()
+    envelope = magicsig.Envelope(data=unicode(TEST_ENVELOPE.data),
+                                 data_type=u'application/atom+xml',
+                                 sig=unicode(TEST_ENVELOPE.sig))
+    self.assertEquals(TEST_ENVELOPE, envelope)
+    self.assertFalse(hasattr(envelope, '__dict__'))
+    self.assertEquals(str, type(envelope.data))
+    self.assertEquals(str, type(envelope.sig))
+    self.assertTrue(envelope.alg is TEST_ENVELOPE.alg)
+    self.assertTrue(envelope.data_type is TEST_ENVELOPE.data_type)
+
+    self.assertRaises(magicsig.exceptions.EnvelopeFormatError,
+                      magicsig.Envelope,
+                      data=TEST_ENVELOPE.data,
+                      data_type=u'application/atom+xml',
+                      sig=u'\u00e9' + TEST_ENVELOPE.sig)
+
+  def testEnvelopeCacheMemoryBudget(self):
+    self.mox.ReplayAll()
+    protocol = magicsig.MagicEnvelopeProtocol(auto_verify=False,
+                                              envelope_cache_bytes=10)
+
+    protocol.GetDataAsRawString(TEST_ENVELOPE)
+    protocol.GetDataAsRawString(TEST_ENVELOPE)
+    stats = protocol.GetEnvelopeCacheStats()
+    self.assertEquals(0, stats['hits'])
+    self.assertEquals(0, stats['bytes'])
+
 
 class ProtocolEndToEndTest(unittest.TestCase):
   """Tests Magic Envelope protocol with default handlers."""
@@ -0,0 +1,216 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Background re-verification of envelopes before they go stale.
+
+A MagicEnvelopeProtocol with auto_verify set re-checks an envelope's
+signature whenever one of its accessors touches it more than
+reverify_period after it was last verified.  That RSA check lands on
+whatever request happens to come along.  A ReverifyScheduler attached
+to the protocol keeps envelopes fresh instead, re-verifying them in
+batches shortly before they expire, from a background thread or from
+whatever periodic hook (cron, task queue) calls RunDue.
+"""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import heapq
+import logging
+import threading
+import time
+
+
+class ReverifyScheduler(object):
+  """Re-verifies tracked envelopes in batches before they go stale.
+
+  Envelopes are tracked by digest in a heap ordered by when they are
+  due.  Re-verifying an envelope (here or anywhere else through the
+  protocol) pushes its due time back; an envelope that no longer
+  verifies is dropped, and the protocol forgets it was ever verified
+  so the next accessor call fails.  An envelope whose author's key
+  can't be looked up right now is dropped too, but keeps its stamp
+  until that expires on its own.
+  """
+
+  def __init__(self, protocol, batch_size=64, lead_time=None,
+               max_tracked=None, clock=time.time):
+    """Creates a scheduler and attaches it to protocol.
+
+    Args:
+      protocol: The MagicEnvelopeProtocol whose envelopes to keep fresh.
+      batch_size: Most envelopes re-verified per VerifyMany call.
+      lead_time: Seconds before going stale that an envelope is due;
+          defaults to a tenth of the protocol's reverify_period.
+      max_tracked: Most envelopes tracked at once; once full, newly
+          verified envelopes are left to the inline check.  Defaults
+          to the size of the protocol's envelope cache, which holds
+          the verification stamps: tracking more envelopes than there
+          are stamps would only re-verify evicted ones.
+      clock: Function returning the current time in seconds.
+    """
+    if lead_time is None:
+      lead_time = protocol.reverify_period / 10.0
+    if max_tracked is None:
+      max_tracked = protocol.GetEnvelopeCacheStats()['max_size']
+    self.protocol = protocol
+    self.batch_size = batch_size
+    self.lead_time = lead_time
+    self.max_tracked = max_tracked
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._heap = []  # (due time, digest); may hold superseded entries
+    self._tracked = {}  # digest -> (due time, envelope)
+    self._thread = None
+    self._stopping = threading.Event()
+    self.reverified = 0
+    self.failed = 0
+    protocol.reverify_scheduler = self
+
+  def Track(self, envelope, verified_at):
+    """Notes that envelope verified at verified_at; called by the protocol."""
+    due = verified_at + self.protocol.reverify_period - self.lead_time
+    digest = envelope.GetDigest()
+    self._lock.acquire()
+    try:
+      if (digest not in self._tracked and
+          len(self._tracked) >= self.max_tracked):
+        return
+      self._tracked[digest] = (due, envelope)
+      heapq.heappush(self._heap, (due, digest))
+    finally:
+      self._lock.release()
+
+  def Untrack(self, envelope):
+    """Stops keeping envelope fresh."""
+    self._lock.acquire()
+    try:
+      self._tracked.pop(envelope.GetDigest(), None)
+    finally:
+      self._lock.release()
+
+  def NextDue(self):
+    """Returns when the next envelope is due, or None if none are tracked."""
+    self._lock.acquire()
+    try:
+      self._DropSuperseded()
+      if self._heap:
+        return self._heap[0][0]
+      return None
+    finally:
+      self._lock.release()
+
+  def RunDue(self, limit=None):
+    """Re-verifies envelopes that are due.
+
+    Args:
+      limit: Most envelopes to re-verify in this call; None for all that
+          are tracked and due when the call starts.
+    Returns:
+      The number of envelopes re-verified (successfully or not).
+    """
+    if limit is None:
+      # Re-verified envelopes are tracked again; never go round twice.
+      limit = len(self._tracked)
+    done = 0
+    while done < limit:
+      batch = self._PopDue(min(self.batch_size, limit - done))
+      if not batch:
+        break
+      self._Reverify(batch)
+      done += len(batch)
+    return done
+
+  def Start(self, interval=60):
+    """Runs RunDue every interval seconds on a daemon thread."""
+    if self._thread is not None:
+      return
+    self._stopping.clear()
+    self._thread = threading.Thread(target=self._Run, args=(interval,),
+                                    name='magicsig-reverify')
+    self._thread.setDaemon(True)
+    self._thread.start()
+
+  def Stop(self):
+    """Stops the background thread started by Start, waiting for it."""
+    if self._thread is None:
+      return
+    self._stopping.set()
+    self._thread.join()
+    self._thread = None
+
+  def Stats(self):
+    """Returns a dict of tracking and re-verification counts."""
+    self._lock.acquire()
+    try:
+      return dict(tracked=len(self._tracked),
+                  reverified=self.reverified,
+                  failed=self.failed)
+    finally:
+      self._lock.release()
+
+  def _Run(self, interval):
+    while not self._stopping.isSet():
+      try:
+        self.RunDue()
+      except Exception:
+        logging.exception('Re-verifying envelopes failed')
+      self._stopping.wait(interval)
+
+  def _DropSuperseded(self):
+    """Pops heap entries whose envelope was untracked or rescheduled."""
+    while self._heap:
+      due, digest = self._heap[0]
+      entry = self._tracked.get(digest)
+      if entry is not None and entry[0] == due:
+        return
+      heapq.heappop(self._heap)
+
+  def _PopDue(self, count):
+    """Removes and returns up to count envelopes that are due."""
+    now = self._clock()
+    batch = []
+    self._lock.acquire()
+    try:
+      while len(batch) < count:
+        self._DropSuperseded()
+        if not self._heap or self._heap[0][0] > now:
+          break
+        _, digest = heapq.heappop(self._heap)
+        batch.append(self._tracked.pop(digest)[1])
+    finally:
+      self._lock.release()
+    return batch
+
+  def _Reverify(self, envelopes):
+    # Envelopes whose stamp was evicted from the envelope cache will be
+    # verified inline on their next access anyway:
+    envelopes = [envelope for envelope in envelopes
+                 if self.protocol.GetDateLastVerified(envelope)]
+    # Successful envelopes are tracked again by the protocol when it
+    # records their new verification time.
+    unresolved = []
+    results = self.protocol.VerifyMany(envelopes, unresolved=unresolved)
+    unresolved = set(unresolved)
+    for i, (envelope, result) in enumerate(zip(envelopes, results)):
+      if result:
+        self.reverified += 1
+      else:
+        self.failed += 1
+        # A key lookup that failed says nothing about the signature;
+        # the old stamp stays good until it expires.
+        if i not in unresolved:
+          self.protocol.ForgetVerified(envelope)
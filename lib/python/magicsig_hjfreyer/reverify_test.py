@@ -0,0 +1,162 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2010 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for reverify.py."""
+
+__author__ = 'jpanzer@google.com (John Panzer)'
+
+import time
+import unittest
+
+import magicsig_hjfreyer as magicsig
+import magicsig_test
+import reverify
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = time.time()
+
+  def __call__(self):
+    return self.now
+
+
+class FakeKeyRetriever(magicsig.KeyRetriever):
+
+  def __init__(self, public_key, private_key):
+    self.public_key = public_key
+    self.private_key = private_key
+
+  def LookupPublicKey(self, signer_uri):
+    return self.public_key
+
+  def LookupPrivateKey(self, signer_uri):
+    return self.private_key
+
+
+class ReverifySchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.key_get = FakeKeyRetriever(magicsig_test.TEST_PUBLIC_KEY,
+                                    magicsig_test.TEST_PRIVATE_KEY)
+    self.protocol = magicsig.MagicEnvelopeProtocol(
+        key_retriever=self.key_get,
+        reverify_period=100)
+    self.scheduler = reverify.ReverifyScheduler(self.protocol, lead_time=10,
+                                                clock=self.clock)
+    self.envelope = magicsig_test.TEST_ENVELOPE
+
+  def _SignAnother(self):
+    return self.protocol.WrapAndSign(
+        magicsig_test.TEST_ATOM.replace('cmt-0.', 'cmt-1.'),
+        'application/atom+xml')
+
+  def testTracksVerifiedEnvelopes(self):
+    self.assertEquals(None, self.scheduler.NextDue())
+    self.assertTrue(self.protocol.VerifyEnvelope(self.envelope))
+    verified_at = self.protocol.GetDateLastVerified(self.envelope)
+    self.assertEquals(verified_at + 90, self.scheduler.NextDue())
+
+    # Nothing is due yet:
+    self.assertEquals(0, self.scheduler.RunDue())
+
+  def testReverifiesDueEnvelopes(self):
+    self.protocol.VerifyEnvelope(self.envelope)
+    first_due = self.scheduler.NextDue()
+
+    self.clock.now = first_due + 1
+    self.assertEquals(1, self.scheduler.RunDue())
+    self.assertTrue(self.scheduler.NextDue() >= first_due)
+    self.assertEquals(dict(tracked=1, reverified=1, failed=0),
+                      self.scheduler.Stats())
+
+  def testForgetsEnvelopesThatNoLongerVerify(self):
+    self.protocol.VerifyEnvelope(self.envelope)
+    self.key_get.public_key = magicsig_test.TEST_PUBLIC_KEY.replace('B', 'b')
+
+    self.clock.now = self.scheduler.NextDue()
+    self.assertEquals(1, self.scheduler.RunDue())
+    self.assertEquals(dict(tracked=0, reverified=0, failed=1),
+                      self.scheduler.Stats())
+    self.assertEquals(0, self.protocol.GetDateLastVerified(self.envelope))
+    self.assertEquals(None, self.scheduler.NextDue())
+
+  def testKeepsStampWhenKeyLookupFails(self):
+    self.protocol.VerifyEnvelope(self.envelope)
+    verified_at = self.protocol.GetDateLastVerified(self.envelope)
+    self.key_get.public_key = None
+
+    self.clock.now = self.scheduler.NextDue()
+    self.assertEquals(1, self.scheduler.RunDue())
+    self.assertEquals(dict(tracked=0, reverified=0, failed=1),
+                      self.scheduler.Stats())
+    self.assertEquals(verified_at,
+                      self.protocol.GetDateLastVerified(self.envelope))
+
+  def testSkipsEnvelopesWithEvictedStamps(self):
+    self.protocol.VerifyEnvelope(self.envelope)
+    self.protocol._envelope_cache.Clear()
+
+    self.clock.now += 1000
+    self.assertEquals(1, self.scheduler.RunDue())
+    self.assertEquals(dict(tracked=0, reverified=0, failed=0),
+                      self.scheduler.Stats())
+
+  def testRunLogsErrors(self):
+    calls = []
+    def FailingRunDue():
+      calls.append(1)
+      self.scheduler._stopping.set()
+      raise RuntimeError('boom')
+    self.scheduler.RunDue = FailingRunDue
+    self.scheduler._Run(0)
+    self.assertEquals([1], calls)
+
+  def testRunDueLimit(self):
+    self.protocol.VerifyEnvelope(self.envelope)
+    self._SignAnother()
+
+    self.clock.now += 1000
+    self.assertEquals(1, self.scheduler.RunDue(limit=1))
+    self.assertEquals(1, self.scheduler.Stats()['reverified'])
+    self.assertEquals(1, self.scheduler.RunDue(limit=1))
+    self.assertEquals(2, self.scheduler.Stats()['reverified'])
+
+  def testAccessorsOnlyVerifyUnknownEnvelopes(self):
+    # The first access verifies inline:
+    self.protocol.GetDataAsRawString(self.envelope)
+    self.assertEquals(1, self.scheduler.Stats()['tracked'])
+
+    # After that the envelope is fresh, and no RSA happens in accessors:
+    self.key_get.public_key = None
+    self.protocol.GetDataAsXmlElementTree(self.envelope)
+
+  def testMaxTrackedDefaultsToEnvelopeCacheSize(self):
+    self.assertEquals(
+        self.protocol.GetEnvelopeCacheStats()['max_size'],
+        self.scheduler.max_tracked)
+
+  def testMaxTracked(self):
+    self.scheduler.max_tracked = 1
+    self.protocol.VerifyEnvelope(self.envelope)
+    self._SignAnother()
+    self.assertEquals(1, self.scheduler.Stats()['tracked'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -59,23 +59,142 @@ def Squeeze(s):  # Remove all whitespace
   return re.sub(_WHITESPACE_RE, '', s)
 
 
-class DefaultAuthorExtractor(object):
+# Bytes handed to the author scanner at a time; the scan stops at the
+# first chunk boundary after it has what it needs.
+_AUTHOR_SCAN_CHUNK_SIZE = 8192
+
+
+class _AuthorFound(Exception):
+  """Stops an _AuthorScanTarget parse once the first author is known."""
+
+
+class _AmbiguousAuthor(Exception):
+  """Raised when a scan can't be sure it matches a full parse."""
+
+
+class _AuthorScanTarget(object):
+  """XMLParser target collecting atom:author/atom:uri text under the root.
+
+  Finds the same URIs as findall('author/uri') on a parsed tree without
+  building any elements.  A URI element holding child elements, or no
+  text at all, is ambiguous; the scan gives up and the caller falls
+  back to a full parse.
+  """
+
+  def __init__(self, first_only=False):
+    self.uris = []
+    self._first_only = first_only
+    self._depth = 0
+    self._in_author = False
+    self._uri_chunks = None  # Text chunks of the atom:uri being read
+
+  def start(self, tag, attrib):
+    self._depth += 1
+    if self._uri_chunks is not None:
+      raise _AmbiguousAuthor()
+    if self._depth == 2:
+      self._in_author = tag == Namespaces.ATOM_NS+'author'
+    elif (self._in_author and self._depth == 3
+          and tag == Namespaces.ATOM_NS+'uri'):
+      self._uri_chunks = []
+
+  def data(self, chunk):
+    if self._uri_chunks is not None:
+      self._uri_chunks.append(chunk)
+
+  def end(self, tag):
+    self._depth -= 1
+    if self._uri_chunks is not None:
+      uri = ''.join(self._uri_chunks)
+      self._uri_chunks = None
+      if not uri.strip():
+        raise _AmbiguousAuthor()
+      self.uris.append(uri)
+      if self._first_only:
+        raise _AuthorFound()
+
+  def close(self):
+    return self.uris
+
+
+def _ScanAuthorUris(text, first_only):
+  """Scans Atom text for author URIs, stopping early if first_only.
+
+  Returns:
+    The raw author URI strings, or None if the document is ambiguous
+    and needs a full parse.
+  """
+  target = _AuthorScanTarget(first_only)
+  parser = et.XMLParser(target=target)
+  try:
+    for i in xrange(0, len(text), _AUTHOR_SCAN_CHUNK_SIZE):
+      parser.feed(text[i:i+_AUTHOR_SCAN_CHUNK_SIZE])
+    parser.close()
+  except _AuthorFound:
+    pass
+  except _AmbiguousAuthor:
+    return None
+  return target.uris
+
+
+class AuthorExtractor(object):
+  """Finds the author URIs of a payload.
+
+  MagicEnvelopeProtocol calls ExtractFirstAuthor where one author is
+  all it needs.  By default that is the first of ExtractAuthors, so
+  overriding ExtractAuthors alone is enough; an extractor that can do
+  better overrides ExtractFirstAuthor as well.
+  """
+
   def ExtractAuthors(self, text, mime_type):
-    if mime_type in [Mimes.ATOM]:
-      xml = et.XML(text)
+    raise NotImplementedError()
 
-      auth_uris = xml.findall(Namespaces.ATOM_NS+'author/'
-                              + Namespaces.ATOM_NS+'uri')
+  def ExtractFirstAuthor(self, text, mime_type):
+    """Returns the first author URI in text, or None if there is none."""
+    auth_uris = self.ExtractAuthors(text, mime_type)
+    if auth_uris:
+      return auth_uris[0]
+    return None
 
-      if auth_uris:
-        return [NormalizeUserIdToUri(auth_uri.text) for auth_uri in auth_uris]
-      else:
-        return []
+
+class DefaultAuthorExtractor(AuthorExtractor):
+  def ExtractAuthors(self, text, mime_type):
+    if mime_type in [Mimes.ATOM]:
+      auth_uris = _ScanAuthorUris(text, first_only=False)
+      if auth_uris is None:
+        auth_uris = [auth_uri.text for auth_uri in self._FindAuthorUris(text)]
+      return [NormalizeUserIdToUri(auth_uri) for auth_uri in auth_uris]
     elif mime_type in [Mimes.JSON]:
       raise NotImplementedError('JSON parsing not implemented')
     else:
       return []
 
+  def _FindAuthorUris(self, text):
+    return et.XML(text).findall(Namespaces.ATOM_NS+'author/'
+                                + Namespaces.ATOM_NS+'uri')
+
+
+class EarlyExitAuthorExtractor(DefaultAuthorExtractor):
+  """A DefaultAuthorExtractor whose ExtractFirstAuthor stops reading early.
+
+  ExtractFirstAuthor stops at the first author's URI, so the rest of a
+  large payload isn't parsed just to sign or verify it.  That also
+  means markup broken after the first author goes unnoticed here; it
+  still fails whenever the payload itself is parsed (e.g. by
+  GetDataAsXmlElementTree), and the signature covers all of it either
+  way.  Pass one as author_extractor to opt in.
+  """
+
+  def ExtractFirstAuthor(self, text, mime_type):
+    if mime_type in [Mimes.ATOM]:
+      auth_uris = _ScanAuthorUris(text, first_only=True)
+      if auth_uris is None:
+        auth_uris = [auth_uri.text for auth_uri in self._FindAuthorUris(text)]
+      if auth_uris:
+        return NormalizeUserIdToUri(auth_uris[0])
+      return None
+    return DefaultAuthorExtractor.ExtractFirstAuthor(self, text, mime_type)
+
 
 def NormalizeUserIdToUri(userid):
   """Normalizes a user-provided user id to a reasonable guess at a URI."""
@@ -53,6 +53,48 @@ class UtilsTest(unittest.TestCase):
                                       mime_type=utils.Mimes.ATOM)
     self.assertEquals(['acct:alice@example.com', 'acct:bob@example.com'], a)
 
+  def testExtractFirstAuthor(self):
+    self.assertEquals('acct:test@example.com',
+                      self.extractor.ExtractFirstAuthor(
+                          TEST_ATOM, mime_type=utils.Mimes.ATOM))
+    self.assertEquals('acct:alice@example.com',
+                      self.extractor.ExtractFirstAuthor(
+                          TEST_ATOM_MULTI_AUTHOR, mime_type=utils.Mimes.ATOM))
+    self.assertEquals(None, self.extractor.ExtractFirstAuthor(
+        TEST_ATOM.replace('author>', 'contributor>'),
+        mime_type=utils.Mimes.ATOM))
+
+    # Markup broken after the first author is still rejected:
+    broken = TEST_ATOM.replace('</title>', '</content>')
+    self.assertRaises(SyntaxError, self.extractor.ExtractFirstAuthor,
+                      broken, mime_type=utils.Mimes.ATOM)
+
+  def testEarlyExitExtractFirstAuthor(self):
+    extractor = utils.EarlyExitAuthorExtractor()
+    self.assertEquals('acct:alice@example.com',
+                      extractor.ExtractFirstAuthor(
+                          TEST_ATOM_MULTI_AUTHOR, mime_type=utils.Mimes.ATOM))
+    self.assertEquals(None, extractor.ExtractFirstAuthor(
+        TEST_ATOM.replace('author>', 'contributor>'),
+        mime_type=utils.Mimes.ATOM))
+
+    # The scan stops at the first author, before the broken markup:
+    self.assertEquals('acct:test@example.com',
+                      extractor.ExtractFirstAuthor(
+                          TEST_ATOM.replace('</title>', '</content>'),
+                          mime_type=utils.Mimes.ATOM))
+
+  def testExtractAuthorMatchesFullParse(self):
+    # A uri with child elements needs a full parse to match findall:
+    nested = TEST_ATOM.replace('acct:test@example.com</uri>',
+                               'acct:test@example.com<b>x</b></uri>')
+    self.assertEquals(['acct:test@example.com'],
+                      self.extractor.ExtractAuthors(
+                          nested, mime_type=utils.Mimes.ATOM))
+    self.assertEquals('acct:test@example.com',
+                      utils.EarlyExitAuthorExtractor().ExtractFirstAuthor(
+                          nested, mime_type=utils.Mimes.ATOM))
+
   def testNormalizeUserIds(self):
     id1 = 'http://example.com'
     id2 = 'https://www.example.org/bob'